@@ -1,26 +1,71 @@
 # chatbot/app.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 import os
+import time
 import logging
-import json
-import json
+from datetime import datetime
+import atexit
 from flask_cors import CORS
 
-from services import bot_logic
 from services import whatsapp
+from services import outbound
+from services import inbound
+from services import order_notifications
+from services import campaigns
+from services import inbox
+from services import triage
+from services import delivery_status
 from services import db_manager # Importar el nuevo módulo de DB
+from services import logging_setup
+from services import metrics
+from services import events
+from services import exports
+from services import message_archive
+from services import migrations
+from services import state_store
+from services import tenants
+from services import admission
 
 app = Flask(__name__)
-CORS(app)
+# Exponer las cabeceras de paginación al frontend de administración
+CORS(app, expose_headers=["X-Next-Cursor", "X-Prev-Cursor", "X-Request-ID"])
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Logging estructurado (JSON lines) escrito por un hilo aparte; ver services/logging_setup.py
+logging_setup.configure_logging()
 logger = logging.getLogger(__name__)
 
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
 
-# Inicializar la base de datos al inicio de la aplicación
-with app.app_context():
-    db_manager.initialize_db()
+# El esquema lo crean las migraciones (`python -m services.migrations upgrade`, una vez por
+# despliegue); cada worker solo comprueba la versión con una consulta (ver SCHEMA_CHECK_ON_STARTUP)
+migrations.check_schema_on_startup()
+
+# Escribir los mensajes pendientes y cerrar el pool al terminar el proceso
+atexit.register(db_manager.shutdown)
+
+# Cada petición lleva un request_id (el de la cabecera X-Request-ID o uno nuevo) que se
+# añade a todos sus registros de log, incluidos los de los hilos que procesan sus mensajes.
+@app.before_request
+def start_request():
+    g.request_started = time.perf_counter()
+    g.request_id = logging_setup.new_request_id(request.headers.get("X-Request-ID"))
+    g.request_id_token = logging_setup.set_request_id(g.request_id)
+
+@app.after_request
+def finish_request(response):
+    started = g.get("request_started")
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint, str(response.status_code))
+    if g.get("request_id"):
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+@app.teardown_request
+def clear_request_id(exc):
+    token = g.pop("request_id_token", None)
+    if token is not None:
+        logging_setup.reset_request_id(token)
 
 @app.route("/webhook", methods=["GET", "POST"])
 def webhook():
@@ -35,93 +80,23 @@ def webhook():
         return "Invalid request", 400
 
     elif request.method == "POST":
-        data = request.get_json()
-        logger.info(f"Webhook POST: Datos recibidos: {json.dumps(data, indent=2)}")
-
-        if data and data.get("object") == "whatsapp_business_account":
+        with metrics.WEBHOOK_PARSE_SECONDS.time():
+            data = request.get_json(silent=True)
+            # Clasificar antes de cualquier trabajo: la mayoría de los POST son solo estados de entrega
+            payload = triage.classify(data)
+        # El payload solo se serializa (redactado) si el nivel DEBUG está activo
+        logger.debug("Webhook POST: Datos recibidos: %s", logging_setup.LazyJson(data))
+
+        if payload is not None:
             try:
-                for entry in data.get("entry", []):
-                    for change in entry.get("changes", []):
-                        if change.get("field") == "messages":
-                            value = change.get("value", {})
-                            
-                            for message_data in value.get("messages", []):
-                                message_type_from_whatsapp = message_data.get("type") 
-                                from_phone_number = message_data["from"]
-                                
-                                user_message_content = "" 
-                                msg_db_type = "text" # Tipo para guardar en la DB
-
-                                if message_type_from_whatsapp == "text":
-                                    user_message_content = message_data["text"]["body"]
-                                    msg_db_type = "text"
-                                elif message_type_from_whatsapp == "interactive":
-                                    interactive_response = message_data.get("interactive", {})
-                                    interactive_type = interactive_response.get("type")
-                                    
-                                    if interactive_type == "button_reply":
-                                        user_message_content = interactive_response["button_reply"]["id"]
-                                        msg_db_type = "interactive_button"
-                                        logger.info(f"Respuesta de botón recibida: ID='{user_message_content}'")
-                                    elif interactive_type == "list_reply": 
-                                        user_message_content = interactive_response["list_reply"]["id"]
-                                        msg_db_type = "interactive_list"
-                                        logger.info(f"Respuesta de lista recibida: ID='{user_message_content}'")
-                                    else:
-                                        logger.info(f"Tipo de respuesta interactiva '{interactive_type}' no manejada explícitamente y será ignorada.")
-                                        continue # Ignorar otros tipos interactivos por ahora
-                                else:
-                                    logger.info(f"Mensaje de tipo '{message_type_from_whatsapp}' ignorado.")
-                                    continue # Ignorar otros tipos de mensajes de WhatsApp (audio, imagen, etc.)
-
-                                if not user_message_content: 
-                                    logger.warning("No se pudo extraer contenido del mensaje del usuario.")
-                                    continue
-
-                                logger.info(f"Procesando entrada: '{user_message_content}' de {from_phone_number}")
-
-                                # 1. Obtener o crear el chat en la base de datos
-                                chat_id = db_manager.get_or_create_chat(from_phone_number)
-                                if not chat_id:
-                                    logger.error(f"No se pudo obtener/crear chat_id para {from_phone_number}. No se procesará el mensaje.")
-                                    continue
-
-                                # 2. Guardar el mensaje del usuario en la base de datos
-                                db_manager.save_message(chat_id, 'user', msg_db_type, user_message_content)
-
-                                # 3. Obtener la respuesta del bot (o indicar que está en modo agente)
-                                bot_response_data = bot_logic.get_parsed_bot_response(user_message_content, user_id=from_phone_number)
-                                
-                                response_text_body = bot_response_data.get("text")
-                                response_type = bot_response_data.get("message_type", "text") 
-                                response_buttons = bot_response_data.get("buttons")
-                                response_list_options = bot_response_data.get("list_options")
-
-                                # Solo envía un mensaje si el bot_logic genera uno (no si está en modo agente)
-                                if response_type != "none" and response_text_body: # 'none' es la nueva señal para no responder
-                                    if response_type == "list" and response_list_options:
-                                        whatsapp.send_interactive_list_message(
-                                            recipient_phone_number=from_phone_number,
-                                            body_text=response_text_body,
-                                            list_button_title=response_list_options.get("button_title", "Opciones"),
-                                            sections=response_list_options.get("sections", []),
-                                            header_text=response_list_options.get("header_text"),
-                                            footer_text=response_list_options.get("footer_text")
-                                        )
-                                        db_manager.save_message(chat_id, 'bot', 'interactive_list', response_text_body)
-                                    elif response_type == "buttons" and response_buttons:
-                                        whatsapp.send_interactive_buttons_message(
-                                            recipient_phone_number=from_phone_number,
-                                            body_text=response_text_body,
-                                            buttons=response_buttons
-                                        )
-                                        db_manager.save_message(chat_id, 'bot', 'interactive_button', response_text_body)
-                                    else: 
-                                        whatsapp.send_text_message(from_phone_number, response_text_body)
-                                        db_manager.save_message(chat_id, 'bot', 'text', response_text_body)
-                                else:
-                                    logger.info(f"Bot no generó respuesta para {from_phone_number} (modo agente o respuesta vacía).")
-            
+                if payload.statuses:
+                    # Se agrupan en memoria y se escriben en lote; nunca llegan al pipeline de mensajes
+                    delivery_status.ingest(payload.statuses)
+                if payload.messages:
+                    # Cada mensaje se registra en el inbox (por wamid) antes de procesarse,
+                    # así los reenvíos de Meta no repiten el pipeline. El procesamiento sigue
+                    # en segundo plano, en orden por usuario (ver inbound.InboundEngine).
+                    inbound.handle_messages(payload.messages)
             except Exception as e:
                 logger.error(f"Error procesando el webhook: {e}", exc_info=True)
 
@@ -135,19 +110,77 @@ def webhook():
 
 # --- API para el Frontend de Administración ---
 
-# Endpoint para obtener todos los chats
+def paged_response(page):
+    """
+    Respuesta de una página: el cuerpo sigue siendo la lista de elementos y los cursores
+    van en cabeceras (X-Next-Cursor: más antiguos, X-Prev-Cursor: más recientes).
+    """
+    response = jsonify(page.items)
+    if page.next_cursor:
+        response.headers["X-Next-Cursor"] = page.next_cursor
+    if page.prev_cursor:
+        response.headers["X-Prev-Cursor"] = page.prev_cursor
+    return response, 200
+
+def parse_tenant_arg(value):
+    """`tenant_id` opcional de los listados y filtros (None: todos los números). Lanza ValueError si no es válido."""
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"tenant_id inválido: {value!r}")
+
+# Endpoint para obtener los chats, paginados por cursor (?limit=&before=&status=&control_mode=&tenant_id=)
 @app.route("/api/chats", methods=["GET"])
 def get_all_chats():
     # En un entorno real, aquí se implementaría autenticación y autorización
-    chats = db_manager.get_chats()
-    return jsonify(chats), 200
-
-# Endpoint para obtener mensajes de un chat específico
+    try:
+        page = db_manager.get_chats(
+            status=request.args.get("status"),
+            control_mode=request.args.get("control_mode"),
+            limit=request.args.get("limit"),
+            before=request.args.get("before"),
+            tenant_id=parse_tenant_arg(request.args.get("tenant_id")),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return paged_response(page)
+
+# Endpoint para obtener mensajes de un chat específico (?limit=&before=&after=&since_id=)
 @app.route("/api/chats/<int:chat_id>/messages", methods=["GET"])
 def get_chat_messages(chat_id):
     # En un entorno real, aquí se implementaría autenticación y autorización
-    messages = db_manager.get_messages_for_chat(chat_id)
-    return jsonify(messages), 200
+    try:
+        if request.args.get("include_archived", "false").lower() == "true":
+            # Historial completo hacia atrás: al agotar la DB sigue con los mensajes archivados
+            if request.args.get("after") or request.args.get("since_id"):
+                return jsonify({"error": "include_archived solo admite paginación hacia atrás (before)."}), 400
+            page = message_archive.get_messages_with_archive(
+                chat_id, limit=request.args.get("limit"), before=request.args.get("before")
+            )
+            return paged_response(page)
+        page = db_manager.get_messages_for_chat(
+            chat_id,
+            limit=request.args.get("limit"),
+            before=request.args.get("before"),
+            after=request.args.get("after"),
+            since_id=request.args.get("since_id"),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return paged_response(page)
+
+# Endpoint para marcar como leídos los mensajes de un chat (pone a cero unread_count)
+@app.route("/api/chats/<int:chat_id>/mark_read", methods=["POST"])
+def mark_chat_read(chat_id):
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    result = db_manager.mark_chat_read(chat_id)
+    if result is None:
+        return jsonify({"error": "Error interno del servidor."}), 500
+    if not result:
+        return jsonify({"error": "Chat no encontrado."}), 404
+    return jsonify({"status": "success"}), 200
 
 # Endpoint para que un agente envíe un mensaje a un usuario
 @app.route("/api/chats/<int:chat_id>/send_message", methods=["POST"])
@@ -160,12 +193,24 @@ def send_agent_message(chat_id):
     if not message_text or not sender_whatsapp_id:
         return jsonify({"error": "Mensaje y ID de WhatsApp del remitente son requeridos."}), 400
 
+    # El mensaje sale desde el número (tenant) del chat
+    chat = db_manager.get_chat(chat_id)
+    if chat is None:
+        return jsonify({"error": "Chat no encontrado."}), 404
+    tenant = tenants.get_tenant(chat.tenant_id)
+    if tenant is None:
+        return jsonify({"error": f"El tenant {chat.tenant_id} del chat no existe."}), 500
+
     # Enviar el mensaje a WhatsApp
-    response_whatsapp = whatsapp.send_text_message(sender_whatsapp_id, message_text)
+    response_whatsapp = whatsapp.send_text_message(
+        sender_whatsapp_id, message_text, tenant.phone_number_id, tenant.access_token
+    )
     
     if response_whatsapp:
-        # Guardar el mensaje del agente en la base de datos
-        db_manager.save_message(chat_id, 'agent', 'text', message_text)
+        # Guardar el mensaje del agente en la base de datos (con su wamid para los estados de entrega)
+        db_manager.save_message(
+            chat_id, 'agent', 'text', message_text, durable=True, wamid=whatsapp.extract_wamid(response_whatsapp)
+        )
         return jsonify({"status": "success", "message": "Mensaje enviado y registrado."}), 200
     else:
         return jsonify({"error": "Fallo al enviar mensaje a WhatsApp."}), 500
@@ -181,35 +226,30 @@ def set_chat_control_api(chat_id):
     if new_control_mode not in ['bot', 'agent']:
         return jsonify({"error": "Modo de control inválido. Debe ser 'bot' o 'agent'."}), 400
 
-    # Obtener el whatsapp_user_id del chat_id
-    conn = db_manager.get_db_connection()
-    if not conn:
-        return jsonify({"error": "Error de conexión a la base de datos."}), 500
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT whatsapp_user_id FROM chats WHERE id = %s", (chat_id,))
-            result = cur.fetchone()
-            if not result:
-                return jsonify({"error": "Chat no encontrado."}), 404
-            whatsapp_user_id = result[0]
-    except Exception as e:
-        logger.error(f"Error al buscar whatsapp_user_id para chat_id {chat_id}: {e}")
-        return jsonify({"error": "Error interno del servidor."}), 500
-    finally:
-        if conn:
-            conn.close()
+    # Obtener el whatsapp_user_id y el tenant del chat_id
+    chat = db_manager.get_chat(chat_id)
+    if chat is None:
+        return jsonify({"error": "Chat no encontrado."}), 404
 
-    if db_manager.set_chat_control(whatsapp_user_id, new_control_mode, agent_id):
+    if db_manager.set_chat_control(chat.whatsapp_user_id, new_control_mode, agent_id, tenant_id=chat.tenant_id):
         return jsonify({"status": "success", "message": f"Modo de control del chat cambiado a '{new_control_mode}'."}), 200
     else:
         return jsonify({"error": "Fallo al actualizar el modo de control del chat."}), 500
 
-# Endpoint para obtener todos los pedidos
+# Endpoint para obtener los pedidos, paginados por cursor (?limit=&before=&status=&tenant_id=)
 @app.route("/api/orders", methods=["GET"])
 def get_all_orders():
     # En un entorno real, aquí se implementaría autenticación y autorización
-    orders = db_manager.get_orders()
-    return jsonify(orders), 200
+    try:
+        page = db_manager.get_orders(
+            status=request.args.get("status"),
+            limit=request.args.get("limit"),
+            before=request.args.get("before"),
+            tenant_id=parse_tenant_arg(request.args.get("tenant_id")),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return paged_response(page)
 
 # Endpoint para actualizar el estado de un pedido (ej. 'confirmed', 'shipped')
 @app.route("/api/orders/<int:order_id>/status", methods=["PUT"])
@@ -220,30 +260,336 @@ def update_order_status(order_id):
 
     if not new_status:
         return jsonify({"error": "Nuevo estado es requerido."}), 400
+    if new_status not in db_manager.ORDER_STATUS_TRANSITIONS:
+        return jsonify({"error": f"Estado de pedido desconocido: '{new_status}'."}), 400
+
+    try:
+        result = db_manager.update_order_status(order_id, new_status)
+    except ValueError as e:
+        # Transición no permitida desde el estado actual (p. ej. de 'delivered' a 'pending')
+        return jsonify({"error": str(e)}), 409
+    if result is None:
+        return jsonify({"error": "Error interno del servidor."}), 500
+    if not result:
+        return jsonify({"error": "Pedido no encontrado."}), 404
+    if data.get("notify_customer"):
+        order_notifications.queue_status_notifications([result], new_status, data.get("message"))
+    return jsonify({"status": "success", "message": f"Estado del pedido {order_id} actualizado a '{new_status}'."}), 200
+
+# Cambio de estado masivo en una transacción: {"status": "shipped", "order_ids": [...]} o
+# {"status": "shipped", "filter": {"status": "confirmed", "created_before": "<ISO 8601>", "tenant_id": opcional}}.
+# Con "notify_customers": true se avisa a cada cliente (texto opcional en "message").
+@app.route("/api/orders/status", methods=["POST"])
+def bulk_update_order_status():
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    data = request.get_json(silent=True) or {}
+    new_status = data.get("status")
+    order_ids = data.get("order_ids")
+    order_filter = data.get("filter") or {}
+
+    if not new_status:
+        return jsonify({"error": "Nuevo estado es requerido."}), 400
+    if order_ids is not None and not isinstance(order_ids, list):
+        return jsonify({"error": "order_ids debe ser una lista."}), 400
+    try:
+        created_before = order_filter.get("created_before")
+        if created_before is not None:
+            created_before = datetime.fromisoformat(created_before)
+        if data.get("notify_customers") and data.get("message"):
+            order_notifications.render_message(data["message"], 0, "")
+        results = db_manager.update_orders_status(
+            new_status, order_ids=order_ids, status=order_filter.get("status"), created_before=created_before,
+            tenant_id=parse_tenant_arg(order_filter.get("tenant_id")),
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    if results is None:
+        return jsonify({"error": "Error interno del servidor."}), 500
+
+    summary = {
+        outcome: 0 for outcome in (
+            db_manager.ORDER_UPDATED, db_manager.ORDER_UNCHANGED,
+            db_manager.ORDER_INVALID_TRANSITION, db_manager.ORDER_NOT_FOUND,
+        )
+    }
+    for result in results:
+        summary[result.result] += 1
+    queued = 0
+    if data.get("notify_customers"):
+        queued = order_notifications.queue_status_notifications(results, new_status, data.get("message"))
+    return jsonify({
+        "status": new_status,
+        "summary": summary,
+        "notifications_queued": queued,
+        "results": [
+            {"order_id": r.order_id, "result": r.result, "previous_status": r.previous_status} for r in results
+        ],
+    }), 200
+
+# Campañas de difusión: {"name": ..., "message": {"text": "Hola {name}..."} o
+# {"template": {"name", "language", "parameters"}}, "audience": {filtros}, "rate_per_second": opcional,
+# "tenant_id": número desde el que se envía (por defecto, el tenant por defecto),
+# "start": true para empezar a enviar}. Ver services/campaigns.py.
+@app.route("/api/campaigns", methods=["POST"])
+def create_campaign():
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    data = request.get_json(silent=True) or {}
+    try:
+        tenant_id = parse_tenant_arg(data.get("tenant_id")) or db_manager.DEFAULT_TENANT_ID
+        campaign_id = campaigns.create_campaign(
+            data.get("name"), data.get("message"), data.get("audience"), data.get("rate_per_second"), tenant_id
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if campaign_id is None:
+        return jsonify({"error": "Error interno del servidor."}), 500
+    if data.get("start"):
+        try:
+            campaigns.start_campaign(campaign_id, tenant_id)
+        except ValueError as e:
+            # La campaña queda creada en 'draft'; se puede iniciar después
+            return jsonify({"error": str(e), "campaign": campaigns.get_campaign(campaign_id)}), 503
+    return jsonify(campaigns.get_campaign(campaign_id)), 201
+
+# Estado y progreso de una campaña
+@app.route("/api/campaigns/<int:campaign_id>", methods=["GET"])
+def get_campaign(campaign_id):
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    campaign = campaigns.get_campaign(campaign_id)
+    if campaign is None:
+        return jsonify({"error": "Campaña no encontrada."}), 404
+    return jsonify(campaign), 200
+
+# Empezar o reanudar el envío de una campaña (desde su último punto de control)
+@app.route("/api/campaigns/<int:campaign_id>/start", methods=["POST"])
+def start_campaign(campaign_id):
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    campaign = campaigns.get_campaign(campaign_id)
+    if campaign is None:
+        return jsonify({"error": "Campaña no encontrada."}), 404
+    if campaign["status"] in ("completed", "cancelled"):
+        return jsonify({"error": f"La campaña ya terminó ({campaign['status']})."}), 409
+    if campaign["status"] == "running" and campaigns.is_sending(campaign_id):
+        return jsonify({"status": "already_running"}), 202
+    try:
+        started = campaigns.start_campaign(campaign_id, campaign["tenant_id"])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"status": "started" if started else "already_running"}), 202
+
+# Pausar o cancelar una campaña; el envío se detiene tras el lote en curso
+@app.route("/api/campaigns/<int:campaign_id>/<any(pause, cancel):action>", methods=["POST"])
+def stop_campaign(campaign_id, action):
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    result = campaigns.set_campaign_status(campaign_id, "paused" if action == "pause" else "cancelled")
+    if result is None:
+        return jsonify({"error": "Error interno del servidor."}), 500
+    if not result:
+        return jsonify({"error": "Campaña no encontrada o ya terminada."}), 409
+    return jsonify(campaigns.get_campaign(campaign_id)), 200
+
+def parse_export_request():
+    """Formato pedido (?format=csv|ndjson, por defecto csv). Lanza ValueError si no es válido."""
+    fmt = request.args.get("format", "csv").lower()
+    if fmt not in exports.FORMATS:
+        raise ValueError(f"Formato de exportación inválido: '{fmt}' (opciones: {', '.join(exports.FORMATS)})")
+    return fmt
+
+def parse_date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Fecha inválida en '{name}': {value!r} (se espera ISO 8601)")
+
+def export_response(fmt, columns, rows, filename):
+    """
+    Respuesta en streaming: las filas salen de un cursor del servidor y se envían por
+    fragmentos, así la memoria del worker no crece con el tamaño de la exportación.
+    """
+    content_type, extension = exports.FORMATS[fmt]
+    return Response(
+        stream_with_context(exports.iter_export(fmt, columns, rows)),
+        content_type=content_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{extension}"', "X-Accel-Buffering": "no"},
+    )
+
+# Exportación de pedidos (?format=csv|ndjson&status=&from=&to=&tenant_id=, fechas ISO 8601; `to` exclusivo)
+@app.route("/api/exports/orders", methods=["GET"])
+def export_orders():
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    try:
+        fmt = parse_export_request()
+        created_from = parse_date_arg("from")
+        created_to = parse_date_arg("to")
+        tenant_id = parse_tenant_arg(request.args.get("tenant_id"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    rows = db_manager.stream_orders(
+        status=request.args.get("status"), created_from=created_from, created_to=created_to, tenant_id=tenant_id
+    )
+    if rows is None:
+        return jsonify({"error": "Error de conexión a la base de datos."}), 500
+    return export_response(fmt, db_manager.ORDER_EXPORT_COLUMNS, rows, "pedidos")
 
-    conn = db_manager.get_db_connection()
-    if not conn:
+# Transcripción completa de un chat (?format=csv|ndjson)
+@app.route("/api/chats/<int:chat_id>/transcript", methods=["GET"])
+def export_chat_transcript(chat_id):
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    try:
+        fmt = parse_export_request()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    rows = db_manager.stream_chat_transcript(chat_id)
+    if rows is None:
         return jsonify({"error": "Error de conexión a la base de datos."}), 500
+    return export_response(fmt, db_manager.TRANSCRIPT_COLUMNS, rows, f"chat_{chat_id}")
+
+# Búsqueda de texto completo en mensajes y pedidos, por relevancia
+# (?q=&scope=messages,orders&chat_id=&sender_type=&from=&to=&tenant_id=&limit=&before=)
+@app.route("/api/search", methods=["GET"])
+def search():
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    scope = request.args.get("scope")
+    chat_id = request.args.get("chat_id")
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE orders SET status = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING id",
-                (new_status, order_id)
-            )
-            updated_id = cur.fetchone()
-            conn.commit()
-            if updated_id:
-                return jsonify({"status": "success", "message": f"Estado del pedido {order_id} actualizado a '{new_status}'."}), 200
-            else:
-                return jsonify({"error": "Pedido no encontrado."}), 404
-    except Exception as e:
-        logger.error(f"Error al actualizar el estado del pedido {order_id}: {e}")
-        conn.rollback()
+        page = db_manager.search(
+            request.args.get("q"),
+            scopes=[item.strip() for item in scope.split(",")] if scope else db_manager.SEARCH_SCOPES,
+            chat_id=int(chat_id) if chat_id else None,
+            sender_type=request.args.get("sender_type"),
+            created_from=parse_date_arg("from"),
+            created_to=parse_date_arg("to"),
+            limit=request.args.get("limit"),
+            before=request.args.get("before"),
+            tenant_id=parse_tenant_arg(request.args.get("tenant_id")),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return paged_response(page)
+
+# Números de WhatsApp (tenants) servidos por este despliegue. El token nunca se devuelve.
+@app.route("/api/tenants", methods=["GET"])
+def list_tenants():
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    return jsonify([tenant.to_dict() for tenant in tenants.list_tenants()]), 200
+
+# Registrar un número: {"name", "phone_number_id", "access_token": opcional (por defecto el del
+# entorno), "flow_file": opcional (relativo a flows/), "rate_per_second": opcional}
+@app.route("/api/tenants", methods=["POST"])
+def create_tenant():
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    data = request.get_json(silent=True) or {}
+    fields = {key: value for key, value in data.items() if key not in ("name", "phone_number_id")}
+    try:
+        tenant = tenants.create_tenant(data.get("name"), data.get("phone_number_id"), **fields)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if tenant is None:
         return jsonify({"error": "Error interno del servidor."}), 500
-    finally:
-        if conn:
-            conn.close()
+    return jsonify(tenant.to_dict()), 201
 
+# Cambiar la configuración de un número (mismos campos; "is_active": false deja de atenderlo)
+@app.route("/api/tenants/<int:tenant_id>", methods=["PATCH"])
+def update_tenant(tenant_id):
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    data = request.get_json(silent=True) or {}
+    try:
+        tenant = tenants.update_tenant(tenant_id, **data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if tenant is None:
+        return jsonify({"error": "Error interno del servidor."}), 500
+    if not tenant:
+        return jsonify({"error": "Tenant no encontrado."}), 404
+    return jsonify(tenant.to_dict()), 200
+
+# Stream de eventos en vivo para el panel (Server-Sent Events, ?chat_id= opcional).
+# Los agentes inactivos no consultan la base de datos: solo esperan eventos. Cada cliente
+# ocupa un hilo mientras está conectado: requiere workers gevent o gthread (ver events.stream).
+@app.route("/api/events", methods=["GET"])
+def stream_events():
+    # En un entorno real, aquí se implementaría autenticación y autorización
+    chat_id = request.args.get("chat_id", type=int)
+    subscription = events.get_broker().subscribe(chat_id)
+    if subscription is None:
+        # Límite EVENTS_MAX_SUBSCRIBERS del worker: el panel puede reintentar pasado Retry-After
+        return jsonify({"error": "Demasiados clientes conectados a los eventos."}), 503, {"Retry-After": "5"}
+    response = Response(
+        stream_with_context(events.stream(subscription)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Libera el cupo aunque el cliente se desconecte antes de que empiece el stream
+    response.call_on_close(subscription.close)
+    return response
+
+# Estado de todos los subsistemas del proceso en una sola respuesta, por subsistema (colas,
+# pool, cachés, contadores). Para monitorización continua, mejor /metrics.
+@app.route("/api/stats", methods=["GET"])
+def get_stats():
+    return jsonify({
+        "db_pool": db_manager.get_pool_stats(),
+        "chat_cache": db_manager.get_chat_cache_stats(),
+        "outbound": outbound.get_stats(),
+        "inbox": inbox.get_stats(),
+        "message_writer": db_manager.get_message_writer_stats(),
+        "events": events.get_broker().stats(),
+        "state": state_store.get_stats(),
+        "logging": logging_setup.get_stats(),
+        "webhook": {"payloads": triage.get_stats(), "delivery_statuses": delivery_status.get_stats()},
+        "inbound": inbound.get_stats(),
+        "db_schema": migrations.schema_status(),
+        "tenants": tenants.get_stats(),
+        "admission": admission.get_stats(),
+    }), 200
+
+@metrics.register_collector
+def _runtime_metrics():
+    # Valores que ya llevan los demás módulos (colas, pool, contadores), leídos al consultar /metrics
+    pool = db_manager.get_pool_stats()
+    inbound_stats = inbound.get_stats()
+    outbound_stats = outbound.get_stats()
+    statuses = delivery_status.get_stats()
+    log_stats = logging_setup.get_stats()
+    return [
+        ("db_pool_connections", "gauge", "Conexiones del pool por estado", [
+            ({"state": "in_use"}, pool.get("in_use", 0)),
+            ({"state": "idle"}, pool.get("idle", 0)),
+        ]),
+        ("db_pool_waiting", "gauge", "Hilos esperando una conexión libre", [({}, pool.get("waiting", 0))]),
+        ("inbound_queue_depth", "gauge", "Mensajes entrantes en cola en el motor por usuario", [
+            ({}, inbound_stats.get("queue", {}).get("queue_depth", 0)),
+        ]),
+        ("inbound_deferred_users", "gauge", "Conversaciones con mensajes aplazados pendientes del drenaje", [
+            ({}, inbound_stats.get("deferred_users", 0)),
+        ]),
+        ("inbound_in_flight", "gauge", "Mensajes entrantes en proceso (límite ADMISSION_MAX_IN_FLIGHT)", [
+            ({}, inbound_stats.get("in_flight", 0)),
+        ]),
+        ("admission_tracked_users", "gauge", "Usuarios con token bucket activo en el control de admisión", [
+            ({}, admission.get_stats().get("tracked_users", 0)),
+        ]),
+        ("outbound_queue_depth", "gauge", "Mensajes salientes pendientes de envío", [
+            ({}, outbound_stats["queue"].get("queue_depth", 0)),
+        ]),
+        ("webhook_payloads_total", "counter", "Payloads del webhook por clase", [
+            ({"kind": kind}, count) for kind, count in triage.get_stats().items()
+        ]),
+        ("delivery_statuses_pending", "gauge", "Estados de entrega en memoria pendientes de escribir", [
+            ({}, statuses.get("pending", 0)),
+        ]),
+        ("log_records_dropped_total", "counter", "Registros de log descartados por cola llena", [
+            ({}, log_stats.get("dropped", 0)),
+        ]),
+    ]
+
+# Métricas en formato de texto de Prometheus (tiempos por etapa, contadores y colas)
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
 
 
 if __name__ == "__main__":
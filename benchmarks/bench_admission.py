@@ -0,0 +1,119 @@
+# chatbot/benchmarks/bench_admission.py
+"""
+Mide la latencia de los usuarios normales mientras un número abusivo inunda el webhook,
+sin control de admisión (off) y con él (on, services.admission).
+
+En cada ronda el usuario abusivo envía --flood mensajes seguidos y después cada usuario
+normal envía uno. La latencia de un mensaje es el tiempo entre el POST al webhook y la
+llegada de su respuesta a la API de Graph falsa. Sin admisión, los mensajes del abusivo
+ocupan su worker (y los usuarios que comparten cola con él) y la DB; con ella se
+rechazan antes de registrarlos.
+
+La política por defecto del benchmark es 'drop': con 'defer' los mensajes rechazados
+quedan pendientes en el inbox y los procesa el barrido de recuperación más tarde.
+
+Requiere una base de datos local configurada con las variables DB_* habituales.
+
+Uso:
+    python -m benchmarks.bench_admission --users 50 --flood 100 --rounds 5
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OUTBOUND_RATE_PER_SECOND", "0") # Sin límite de envíos: se mide el procesamiento entrante
+
+from benchmarks.fake_graph_api import FakeGraphAPI  # noqa: E402
+from benchmarks.bench_db_round_trips import build_text_payload  # noqa: E402
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def wait_replies(fake, users, expected, timeout=120):
+    """Espera a que los usuarios normales reciban todas sus respuestas."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if sum(1 for _, payload, _ in fake.received() if payload.get("to") in users) >= expected:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def run(client, fake, mode, args, run_id):
+    from services import admission, inbound
+    if mode == "off":
+        admission._controller = admission.AdmissionController(user_rate=0, max_in_flight=0)
+    else:
+        admission._controller = admission.AdmissionController(policy=args.policy)
+    abuser = f"57{run_id % 10**6:06d}{mode == 'on':d}9999"
+    users = [f"57{run_id % 10**6:06d}{mode == 'on':d}{i:04d}" for i in range(args.users)]
+    sent_at = {user: [] for user in users}
+    started = time.perf_counter()
+    for round_ in range(args.rounds):
+        for n in range(args.flood):
+            client.post("/webhook", json=build_text_payload(abuser, "hola", f"wamid.adm-{run_id}-{mode}-x-{round_}-{n}"))
+        for i, user in enumerate(users):
+            sent_at[user].append(time.monotonic())
+            client.post("/webhook", json=build_text_payload(user, "hola", f"wamid.adm-{run_id}-{mode}-{i}-{round_}"))
+    complete = wait_replies(fake, set(users), args.users * args.rounds)
+    elapsed = time.perf_counter() - started
+    inbound.get_engine().wait_idle(timeout=300)
+
+    replies = {user: [] for user in users}
+    abuser_replies = 0
+    for _, payload, t in fake.received():
+        to = payload.get("to")
+        if to in replies:
+            replies[to].append(t)
+        elif to == abuser:
+            abuser_replies += 1
+    latencies = [reply - sent for user in users for sent, reply in zip(sent_at[user], replies[user])]
+    stats = admission.get_stats()
+    return {
+        "complete": complete,
+        "elapsed_s": round(elapsed, 3),
+        "healthy_latency_ms_p50": round(statistics.median(latencies) * 1000, 1),
+        "healthy_latency_ms_p99": round(percentile(latencies, 0.99) * 1000, 1),
+        "abuser_messages": args.flood * args.rounds,
+        "abuser_replies": abuser_replies,
+        "rejected": {"user_rate": stats["rejected_user_rate"], "overloaded": stats["rejected_overloaded"]},
+        "tracked_users": stats["tracked_users"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="Usuarios normales")
+    parser.add_argument("--flood", type=int, default=100, help="Mensajes del usuario abusivo por ronda")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Latencia de la API de Graph falsa")
+    parser.add_argument("--policy", default="drop", choices=("drop", "defer"))
+    args = parser.parse_args()
+
+    with FakeGraphAPI(latency_ms=args.latency_ms) as fake:
+        from services import whatsapp, outbound, logging_setup
+        whatsapp.WHATSAPP_API_BASE_URL = fake.base_url
+        whatsapp.WHATSAPP_TOKEN = whatsapp.WHATSAPP_TOKEN or "bench-token"
+        whatsapp.WHATSAPP_PHONE_NUMBER_ID = whatsapp.WHATSAPP_PHONE_NUMBER_ID or "bench-phone"
+
+        from app import app
+        logging_setup.configure_logging()
+        logging.getLogger().setLevel(logging.WARNING)
+        client = app.test_client()
+        run_id = int(time.time())
+
+        results = {mode: run(client, fake, mode, args, run_id) for mode in ("off", "on")}
+        outbound.get_dispatcher().shutdown()
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# chatbot/benchmarks/bench_campaigns.py
+"""
+Mide el envío de campañas (services/campaigns.py) contra la API de Graph falsa.
+
+Crea N chats de prueba, envía una campaña a todos e informa mensajes/s, destinatarios
+por estado y mensajes duplicados recibidos por la API. Con --crash-after el envío empieza en un proceso aparte
+(`python -m services.campaigns run`) que se mata con SIGKILL a los S segundos; después
+la campaña se reanuda aquí y se comprueba que ningún destinatario recibió el mensaje
+dos veces.
+
+Requiere una base de datos local configurada con las variables DB_* habituales; los
+chats y la campaña de prueba se borran al terminar.
+
+Uso:
+    python -m benchmarks.bench_campaigns --recipients 10000 --latency-ms 50 --tier 1000
+    python -m benchmarks.bench_campaigns --recipients 5000 --tier 80 --crash-after 5
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_graph_api import FakeGraphAPI  # noqa: E402
+
+BENCH_STATUS = "bench_campaign" # Estado de los chats de prueba (filtro de audiencia)
+BENCH_PREFIX = "bench-campaign-"
+
+
+def seed(db_manager, recipients):
+    conn = db_manager.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO chats (whatsapp_user_id, status) "
+                "SELECT %s || lpad(g::text, 7, '0'), %s FROM generate_series(1, %s) AS g",
+                (BENCH_PREFIX, BENCH_STATUS, recipients)
+            )
+        conn.commit()
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def cleanup(db_manager):
+    conn = db_manager.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM campaigns WHERE audience->>'status' = %s", (BENCH_STATUS,))
+            cur.execute("DELETE FROM messages WHERE chat_id IN (SELECT id FROM chats WHERE status = %s)", (BENCH_STATUS,))
+            cur.execute("DELETE FROM chats WHERE status = %s", (BENCH_STATUS,))
+        conn.commit()
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def crash_run(campaign_id, seconds, env):
+    """Empieza la campaña en otro proceso y lo mata sin darle tiempo a terminar nada."""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "services.campaigns", "run", str(campaign_id)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    time.sleep(seconds)
+    process.send_signal(signal.SIGKILL)
+    process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, default=10000)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--tier", type=float, default=1000, help="Nivel de throughput de la cuenta (mensajes/s)")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--crash-after", type=float, default=None, help="Matar el primer envío a los S segundos")
+    args = parser.parse_args()
+
+    with FakeGraphAPI(latency_ms=args.latency_ms, error_rate=args.error_rate) as fake:
+        env = dict(os.environ, WHATSAPP_API_BASE_URL=fake.base_url, WHATSAPP_THROUGHPUT_MPS=str(args.tier),
+                   WHATSAPP_ACCESS_TOKEN=os.getenv("WHATSAPP_ACCESS_TOKEN", "bench-token"),
+                   WHATSAPP_PHONE_NUMBER_ID=os.getenv("WHATSAPP_PHONE_NUMBER_ID", "bench-phone"),
+                   OUTBOUND_BACKOFF_BASE="0.01")
+        if args.workers:
+            env["CAMPAIGN_WORKERS"] = str(args.workers)
+        os.environ.update(env)
+        from services import db_manager, logging_setup, campaigns, migrations
+        logging_setup.configure_logging()
+        logging.getLogger().setLevel(logging.WARNING)
+        migrations.upgrade()
+
+        cleanup(db_manager)
+        seed(db_manager, args.recipients)
+        results = {"recipients": args.recipients, "tier_mps": args.tier, "campaign_rate_mps": campaigns.campaign_rate_limit()}
+        try:
+            campaign_id = campaigns.create_campaign(
+                "Lanzamiento Kit Óscar Camarra",
+                {"text": "¡Hola {name}! Ya está disponible el Kit Óscar Camarra. Responde KIT para pedirlo."},
+                {"status": BENCH_STATUS},
+            )
+            if args.crash_after:
+                crash_run(campaign_id, args.crash_after, env)
+                before_resume = campaigns.get_campaign(campaign_id)
+                results["after_crash"] = {
+                    "received_by_api": len(fake.received()),
+                    "recorded": before_resume["recipients"],
+                }
+            started = time.perf_counter()
+            results["final_status"] = campaigns.run_campaign(campaign_id)
+            elapsed = time.perf_counter() - started
+            campaign = campaigns.get_campaign(campaign_id)
+            received = collections.Counter(payload["to"] for _, payload, _ in fake.received())
+            results.update({
+                "elapsed_s": round(elapsed, 2),
+                "messages_per_second": round(campaign["sent_count"] / elapsed, 1) if not args.crash_after else None,
+                "recipients_by_status": campaign["recipients"],
+                "received_by_api": sum(received.values()),
+                "duplicates": sum(count - 1 for count in received.values() if count > 1),
+            })
+        finally:
+            cleanup(db_manager)
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# chatbot/benchmarks/bench_cold_start.py
+"""
+Mide el arranque en frío de los workers: cuánto tarda un proceso nuevo en importar la
+aplicación y quedar listo para servir, y cuántas conexiones y round trips hace a la DB.
+
+Modos (cada uno arranca --workers procesos a la vez, como gunicorn al desplegar):
+- legacy: lo que hacía cada worker antes de las migraciones: ejecutar todo el script
+  del esquema (0001_baseline) al importar app.py.
+- check:  la comprobación de versión actual (SCHEMA_CHECK_ON_STARTUP=warn).
+- off:    sin ningún acceso a la DB (solo el coste de importar).
+
+Las conexiones pasan por un proxy TCP que añade --latency-ms de ida y vuelta, para ver el
+efecto de una DB lenta o remota. Con --hold-lock S otra sesión mantiene abierta durante
+S segundos una transacción que lee `chats` (un informe o una exportación larga).
+
+Requiere una base de datos local ya migrada (`python -m services.migrations upgrade`)
+configurada con las variables DB_* habituales.
+
+Uso:
+    python -m benchmarks.bench_cold_start --workers 4 --latency-ms 20
+    python -m benchmarks.bench_cold_start --workers 4 --hold-lock 5
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Se ejecuta en cada proceso hijo; imprime una línea JSON al quedar listo.
+_WORKER_SCRIPT = r"""
+import json, os, sys, time
+started = time.perf_counter()
+from benchmarks import db_counters
+from services import db_manager
+db_manager.configure_pool(connection_factory=db_counters.CountingConnection)
+mode = os.environ["BENCH_MODE"]
+os.environ["SCHEMA_CHECK_ON_STARTUP"] = "off" if mode in ("off", "legacy") else "warn"
+import app
+if mode == "legacy":
+    from services import migrations
+    baseline = migrations.discover()[0]
+    conn = db_manager.get_db_connection()
+    with conn.cursor() as cur:
+        baseline.apply(cur)
+    conn.commit()
+    db_manager.release_db_connection(conn)
+ready = time.perf_counter() - started
+print(json.dumps({"ready_s": ready, "wall_s": time.time() - float(os.environ["BENCH_SPAWNED"]), **db_counters.snapshot()}))
+sys.stdout.flush()
+os._exit(0)
+"""
+
+
+class LatencyProxy:
+    """Proxy TCP hacia PostgreSQL que retrasa cada envío la mitad de --latency-ms en cada sentido."""
+
+    def __init__(self, target, latency_ms):
+        self.target = target # Ruta del socket unix o (host, puerto)
+        self.delay = latency_ms / 2000.0
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(128)
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _connect_target(self):
+        if isinstance(self.target, str):
+            upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        upstream.connect(self.target)
+        return upstream
+
+    def _accept(self):
+        while True:
+            client, _ = self.server.accept()
+            upstream = self._connect_target()
+            for source, sink in ((client, upstream), (upstream, client)):
+                pending = queue.Queue()
+                threading.Thread(target=self._read, args=(source, pending), daemon=True).start()
+                threading.Thread(target=self._write, args=(sink, pending), daemon=True).start()
+
+    def _read(self, source, pending):
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b""
+            pending.put((time.monotonic() + self.delay, data))
+            if not data:
+                return
+
+    @staticmethod
+    def _write(sink, pending):
+        while True:
+            due, data = pending.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if not data:
+                    sink.shutdown(socket.SHUT_WR)
+                    return
+                sink.sendall(data)
+            except OSError:
+                return
+
+
+def db_target():
+    host = os.getenv("DB_HOST", "localhost")
+    port = int(os.getenv("DB_PORT", "5432"))
+    if host.startswith("/"):
+        return os.path.join(host, f".s.PGSQL.{port}")
+    return (host, port)
+
+
+def hold_lock(seconds, ready):
+    """Transacción que lee `chats` y la deja abierta `seconds` segundos."""
+    from services import db_manager
+    conn = db_manager.open_dedicated_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM chats")
+            ready.set()
+            time.sleep(seconds)
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+def run_mode(mode, workers, env, hold_seconds):
+    holder = None
+    if hold_seconds:
+        ready = threading.Event()
+        holder = threading.Thread(target=hold_lock, args=(hold_seconds, ready))
+        holder.start()
+        ready.wait()
+    processes = []
+    for _ in range(workers):
+        spawned = time.time()
+        child_env = dict(env, BENCH_MODE=mode, BENCH_SPAWNED=repr(spawned))
+        processes.append(subprocess.Popen(
+            [sys.executable, "-c", _WORKER_SCRIPT], cwd=ROOT, env=child_env,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        ))
+    results = []
+    for process in processes:
+        out, _ = process.communicate()
+        lines = out.strip().splitlines()
+        results.append(json.loads(lines[-1]) if lines else None)
+    if holder is not None:
+        holder.join()
+    ok = [r for r in results if r]
+    if not ok:
+        return {"mode": mode, "failed": len(results)}
+    ready = sorted(r["ready_s"] for r in ok)
+    return {
+        "mode": mode,
+        "workers": len(ok),
+        "ready_ms_p50": round(statistics.median(ready) * 1000, 1),
+        "ready_ms_max": round(ready[-1] * 1000, 1),
+        "process_wall_ms_max": round(max(r["wall_s"] for r in ok) * 1000, 1),
+        "db_connections_per_worker": round(statistics.mean(r["connections"] for r in ok), 1),
+        "db_round_trips_per_worker": round(statistics.mean(r["round_trips"] for r in ok), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4, help="Procesos que arrancan a la vez por modo")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latencia de ida y vuelta añadida a la DB")
+    parser.add_argument("--hold-lock", type=float, default=0.0, help="Segundos con una transacción abierta sobre chats")
+    parser.add_argument("--modes", default="legacy,check,off")
+    args = parser.parse_args()
+
+    env = dict(os.environ, WHATSAPP_ACCESS_TOKEN="", PYTHONPATH=ROOT)
+    if args.latency_ms:
+        proxy = LatencyProxy(db_target(), args.latency_ms)
+        env.update(DB_HOST="127.0.0.1", DB_PORT=str(proxy.port))
+
+    results = {"latency_ms": args.latency_ms, "hold_lock_s": args.hold_lock, "modes": []}
+    for mode in args.modes.split(","):
+        results["modes"].append(run_mode(mode, args.workers, env, args.hold_lock))
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
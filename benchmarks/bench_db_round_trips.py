@@ -0,0 +1,95 @@
+# chatbot/benchmarks/bench_db_round_trips.py
+"""
+Mide los round trips a PostgreSQL por cada mensaje entrante al webhook.
+
+Requiere una base de datos local configurada con las variables DB_* habituales.
+Los envíos a WhatsApp se desactivan (sin token) para medir solo la base de datos.
+
+Uso:
+    python -m benchmarks.bench_db_round_trips --messages 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["WHATSAPP_ACCESS_TOKEN"] = ""
+
+from benchmarks import db_counters  # noqa: E402
+
+
+def build_text_payload(from_phone_number, text, message_id):
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{
+            "id": "bench",
+            "changes": [{
+                "field": "messages",
+                "value": {
+                    "messaging_product": "whatsapp",
+                    "metadata": {"phone_number_id": "bench"},
+                    "messages": [{
+                        "from": from_phone_number,
+                        "id": message_id,
+                        "timestamp": str(int(time.time())),
+                        "type": "text",
+                        "text": {"body": text},
+                    }],
+                },
+            }],
+        }],
+    }
+
+
+def wait_idle():
+    from services import inbound
+    engine = inbound.get_engine()
+    if engine is not None:
+        engine.wait_idle(timeout=60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200, help="Mensajes a enviar al webhook")
+    parser.add_argument("--users", type=int, default=20, help="Usuarios distintos que envían mensajes")
+    parser.add_argument("--text", default="hola", help="Texto del mensaje")
+    args = parser.parse_args()
+
+    from services import db_manager
+    db_manager.configure_pool(connection_factory=db_counters.CountingConnection)
+
+    from app import app
+    client = app.test_client()
+    run_id = f"{int(time.time() * 1000):x}" # wamids únicos por ejecución (el inbox descarta repetidos)
+
+    # Calentar: crear los chats y abrir las conexiones del pool antes de medir.
+    for user in range(args.users):
+        client.post("/webhook", json=build_text_payload(f"57300{user:07d}", args.text, f"wamid.warmup.{run_id}.{user}"))
+    wait_idle()
+
+    db_counters.reset()
+    started = time.perf_counter()
+    for i in range(args.messages):
+        user = f"57300{i % args.users:07d}"
+        client.post("/webhook", json=build_text_payload(user, args.text, f"wamid.bench.{run_id}.{i}"))
+    wait_idle() # Con INBOUND_ASYNC los mensajes terminan de procesarse en segundo plano
+    elapsed = time.perf_counter() - started
+
+    counters = db_counters.snapshot()
+    result = {
+        "messages": args.messages,
+        "elapsed_s": round(elapsed, 4),
+        "messages_per_s": round(args.messages / elapsed, 1) if elapsed else None,
+        "round_trips_per_message": round(counters["round_trips"] / args.messages, 2),
+        "statements_per_message": round(counters["statements"] / args.messages, 2),
+        "commits_per_message": round(counters["commits"] / args.messages, 2),
+        "connections_opened": counters["connections"],
+        "pool": db_manager.get_pool_stats(),
+    }
+    print(json.dumps(result, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# chatbot/benchmarks/bench_exports.py
+"""
+Compara la memoria de exportar todos los pedidos cargándolos de una vez
+(RealDictCursor.fetchall() + jsonify, como la API paginada sin límite) frente a la
+exportación en streaming de /api/exports/orders (cursor con nombre en el servidor y
+respuesta por fragmentos).
+
+Se mide el pico de memoria de Python (tracemalloc) mientras se consume la respuesta
+completa. Con el streaming el pico no depende del número de filas.
+
+Requiere una base de datos local configurada con las variables DB_* habituales; los
+pedidos de prueba se crean en un chat propio y se borran al terminar.
+
+Uso:
+    python -m benchmarks.bench_exports --orders 100000
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_USER = "bench-export"
+
+
+def seed(db_manager, orders):
+    conn = db_manager.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO chats (whatsapp_user_id) VALUES (%s) ON CONFLICT (whatsapp_user_id) DO UPDATE "
+                "SET updated_at = CURRENT_TIMESTAMP RETURNING id", (BENCH_USER,)
+            )
+            chat_id = cur.fetchone()[0]
+            cur.execute(
+                "INSERT INTO orders (chat_id, whatsapp_user_id, product_name, customer_name, delivery_address, payment_method, status) "
+                "SELECT %s, %s, 'Kit Oscar', 'Cliente ' || g, 'Calle ' || g || ' # 10-20, Bogotá', 'Contraentrega', 'bench_export' "
+                "FROM generate_series(1, %s) AS g", (chat_id, BENCH_USER, orders)
+            )
+        conn.commit()
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def cleanup(db_manager):
+    conn = db_manager.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM orders WHERE whatsapp_user_id = %s", (BENCH_USER,))
+            cur.execute("DELETE FROM chats WHERE whatsapp_user_id = %s", (BENCH_USER,))
+        conn.commit()
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def measure(fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = fn()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"elapsed_s": round(elapsed, 3), "peak_mb": round(peak / 2**20, 2), "bytes": size}
+
+
+def load_all(app, db_manager):
+    """Referencia: todas las filas en memoria y un único cuerpo JSON."""
+    from flask import jsonify
+    from psycopg2 import extras
+    conn = db_manager.get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+            cur.execute(
+                f"SELECT {', '.join(db_manager.ORDER_EXPORT_COLUMNS)} FROM orders WHERE status = %s "
+                "ORDER BY created_at, id", ("bench_export",)
+            )
+            rows = cur.fetchall()
+        conn.commit()
+    finally:
+        db_manager.release_db_connection(conn)
+    with app.app_context():
+        return len(jsonify(rows).get_data())
+
+
+def stream(client, fmt):
+    response = client.get(f"/api/exports/orders?format={fmt}&status=bench_export", buffered=False)
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    response.close()
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=100000)
+    args = parser.parse_args()
+
+    from services import db_manager, logging_setup
+    from app import app
+    logging_setup.configure_logging()
+    logging.getLogger().setLevel(logging.WARNING)
+    client = app.test_client()
+
+    cleanup(db_manager)
+    seed(db_manager, args.orders)
+    try:
+        results = {
+            "orders": args.orders,
+            "fetchall_json": measure(lambda: load_all(app, db_manager)),
+            "stream_ndjson": measure(lambda: stream(client, "ndjson")),
+            "stream_csv": measure(lambda: stream(client, "csv")),
+        }
+    finally:
+        cleanup(db_manager)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
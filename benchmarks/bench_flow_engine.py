@@ -0,0 +1,102 @@
+# chatbot/benchmarks/bench_flow_engine.py
+"""
+Compara el rendimiento del motor de flujos compilado (services/flow_engine.py) con la
+cadena if/elif anterior (legacy_bot_engine.py) sobre la misma mezcla de mensajes, y
+comprueba antes que ambos generan exactamente las mismas respuestas.
+
+No necesita base de datos: la mezcla no incluye los pasos que guardan pedidos o pasan
+el chat a un agente, y ambos guardan el estado conversacional en el mismo dict de
+cambios pendientes (como dentro del webhook).
+
+Cada motor se mide --repeat veces, alternando, y se toma la mejor ejecución: una sola
+ejecución varía más que la diferencia entre ambos.
+
+Uso:
+    python -m benchmarks.bench_flow_engine --iterations 20000 --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Una conversación típica: menú, opciones estáticas, texto no reconocido y los pasos
+# del pedido que solo dependen del estado.
+CONVERSATION = [
+    "hola",
+    "opt_kit_oscar",
+    "opt_catalogo",
+    "quiero una camiseta",
+    "Menú",
+    "pedir_kit_oscar_si",
+    "Ana Pérez",
+    "Calle 10 # 20-30, Bogotá",
+]
+
+
+def normalize(response):
+    return json.dumps(response, ensure_ascii=False, sort_keys=True)
+
+
+def run(respond, reset, iterations):
+    started = time.perf_counter()
+    for i in range(iterations):
+        user_id = f"user-{i % 100}"
+        for message in CONVERSATION:
+            respond(message, user_id)
+        reset(user_id)
+    return time.perf_counter() - started
+
+
+def summarize(elapsed, iterations):
+    calls = iterations * len(CONVERSATION)
+    return {"calls": calls, "elapsed_s": round(elapsed, 3), "calls_per_s": round(calls / elapsed, 1),
+            "us_per_call": round(elapsed / calls * 1e6, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5, help="Ejecuciones por motor (se toma la mejor)")
+    args = parser.parse_args()
+
+    os.environ["STATE_BACKEND"] = "memory"
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    from benchmarks import legacy_bot_engine
+    from services import db_manager
+    from services import flow_engine
+
+    engine = flow_engine.get_engine()
+    pending = {}
+
+    def respond_compiled(message, user_id):
+        return engine.respond(message, user_id, pending_states=pending)
+
+    def reset_compiled(user_id):
+        pending.pop((db_manager.DEFAULT_TENANT_ID, user_id), None)
+
+    def respond_legacy(message, user_id):
+        return legacy_bot_engine.get_bot_response_from_engine(message, user_id, pending_states=pending)
+
+    for message in CONVERSATION:
+        legacy, compiled = respond_legacy(message, "check-legacy"), respond_compiled(message, "check-compiled")
+        if normalize(legacy) != normalize(compiled):
+            raise SystemExit(f"Las respuestas difieren para {message!r}:\n{normalize(legacy)}\n{normalize(compiled)}")
+    pending.clear()
+
+    runners = {"legacy_if_chain": respond_legacy, "compiled_flow": respond_compiled}
+    best = {name: float("inf") for name in runners}
+    for _ in range(args.repeat):
+        for name, respond in runners.items():
+            best[name] = min(best[name], run(respond, reset_compiled, args.iterations))
+    results = {name: summarize(elapsed, args.iterations) for name, elapsed in best.items()}
+    results["speedup"] = round(best["legacy_if_chain"] / best["compiled_flow"], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# chatbot/benchmarks/bench_inbound.py
+"""
+Mide el procesamiento de mensajes entrantes dentro de la petición del webhook
+(INBOUND_ASYNC=false) frente al motor por usuario en segundo plano (inbound.InboundEngine).
+
+Cada usuario completa un pedido (menú, pedido, nombre, dirección, pago) con un POST por
+mensaje, intercalando usuarios. Al terminar se comprueba que cada usuario tiene
+exactamente un pedido con sus datos y que sus mensajes se guardaron en orden: el orden
+por usuario es lo que mantiene correcto el flujo de pedido.
+
+Requiere una base de datos local configurada con las variables DB_* habituales; los
+envíos a WhatsApp van a la API de Graph falsa.
+
+Uso:
+    python -m benchmarks.bench_inbound --users 100 --latency-ms 50
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OUTBOUND_RATE_PER_SECOND", "0") # Sin límite de envíos: se mide el procesamiento entrante
+
+from benchmarks.fake_graph_api import FakeGraphAPI  # noqa: E402
+from benchmarks.bench_db_round_trips import build_text_payload  # noqa: E402
+
+
+def conversation(user_index):
+    return ["hola", "pedir_kit_oscar_si", f"Cliente {user_index}", f"Calle {user_index} # 1-2", "payment_contraentrega"]
+
+
+def run(client, mode, users, run_id):
+    from services import inbound
+    inbound.INBOUND_ASYNC = mode == "engine"
+    user_ids = [f"57{run_id % 10**6:06d}{mode == 'engine':d}{i:04d}" for i in range(users)]
+    started = time.perf_counter()
+    webhook_time = 0.0
+    for step in range(len(conversation(0))):
+        for i, user_id in enumerate(user_ids):
+            payload = build_text_payload(user_id, conversation(i)[step], f"wamid.in-{run_id}-{mode}-{i}-{step}")
+            request_started = time.perf_counter()
+            client.post("/webhook", json=payload)
+            webhook_time += time.perf_counter() - request_started
+    engine = inbound.get_engine()
+    if engine is not None:
+        engine.wait_idle(timeout=120)
+    elapsed = time.perf_counter() - started
+    messages = users * len(conversation(0))
+    result = {
+        "messages": messages,
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_s": round(messages / elapsed, 1),
+        "webhook_ms_per_request": round(webhook_time / messages * 1000, 3),
+        "errors": check(user_ids),
+    }
+    if engine is not None:
+        stats = engine.stats()
+        result["queue_wait"] = stats["queue_wait"]
+        result["processing_time"] = stats["processing_time"]
+    return result
+
+
+def check(user_ids):
+    """Cuenta los usuarios cuyo pedido o cuyo orden de mensajes no es el esperado."""
+    from services import db_manager
+    conn = db_manager.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT whatsapp_user_id, customer_name, delivery_address, payment_method FROM orders "
+                "WHERE whatsapp_user_id = ANY(%s)", (user_ids,)
+            )
+            orders = {}
+            for user_id, *details in cur.fetchall():
+                orders.setdefault(user_id, []).append(tuple(details))
+            cur.execute(
+                "SELECT c.whatsapp_user_id, m.content FROM messages m JOIN chats c ON c.id = m.chat_id "
+                "WHERE c.whatsapp_user_id = ANY(%s) AND m.sender_type = 'user' ORDER BY m.id", (user_ids,)
+            )
+            received = {}
+            for user_id, content in cur.fetchall():
+                received.setdefault(user_id, []).append(content)
+        conn.commit()
+    finally:
+        db_manager.release_db_connection(conn)
+    errors = 0
+    for i, user_id in enumerate(user_ids):
+        expected = [(f"Cliente {i}", f"Calle {i} # 1-2", "Contraentrega")]
+        if orders.get(user_id) != expected or received.get(user_id) != conversation(i):
+            errors += 1
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Latencia de la API de Graph falsa")
+    args = parser.parse_args()
+
+    with FakeGraphAPI(latency_ms=args.latency_ms) as fake:
+        from services import whatsapp, outbound, logging_setup
+        whatsapp.WHATSAPP_API_BASE_URL = fake.base_url
+        whatsapp.WHATSAPP_TOKEN = whatsapp.WHATSAPP_TOKEN or "bench-token"
+        whatsapp.WHATSAPP_PHONE_NUMBER_ID = whatsapp.WHATSAPP_PHONE_NUMBER_ID or "bench-phone"
+
+        from app import app
+        logging_setup.configure_logging()
+        logging.getLogger().setLevel(logging.WARNING)
+        client = app.test_client()
+        run_id = int(time.time())
+
+        results = {mode: run(client, mode, args.users, run_id) for mode in ("in_request", "engine")}
+        results["speedup"] = round(results["in_request"]["elapsed_s"] / results["engine"]["elapsed_s"], 2)
+        outbound.get_dispatcher().shutdown() # Entregar las respuestas antes de cerrar la API falsa
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# chatbot/benchmarks/bench_logging.py
+"""
+Mide el CPU que el logging consume en el hilo de la petición del webhook.
+
+Envía la misma mezcla de mensajes al webhook (cliente de pruebas de Flask) con varias
+configuraciones de logging y mide el tiempo de CPU del hilo que atiende la petición
+(`time.thread_time`); el hilo de logging y los de envío no cuentan. El coste del logging
+es la diferencia con la ejecución con el logging desactivado.
+
+  - disabled:    logging.disable(), la referencia.
+  - sync_debug:  StreamHandler síncrono a nivel DEBUG (como el basicConfig anterior, que
+                 serializaba y escribía los payloads en el hilo de la petición).
+  - queue_info:  configuración por defecto (cola + hilo de logging, INFO, muestreo).
+  - queue_debug: la misma cola con DEBUG (payloads serializados en el hilo de logging).
+
+Requiere una base de datos local configurada con las variables DB_* habituales; los
+envíos a WhatsApp van a la API de Graph falsa. La salida de logs se descarta.
+
+Uso:
+    python -m benchmarks.bench_logging --messages 500
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_graph_api import FakeGraphAPI  # noqa: E402
+from benchmarks.bench_db_round_trips import build_text_payload  # noqa: E402
+
+MESSAGES = ["hola", "opt_catalogo", "quiero una camiseta", "menú"]
+MODES = ["disabled", "sync_debug", "queue_info", "queue_debug"]
+
+
+def set_mode(mode, queue_handler, devnull):
+    from services import logging_setup
+    root = logging.getLogger()
+    logging.disable(logging.NOTSET)
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    if mode == "disabled":
+        logging.disable(logging.CRITICAL)
+        root.addHandler(queue_handler)
+    elif mode == "sync_debug":
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(logging_setup.JsonFormatter())
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+    else:
+        root.addHandler(queue_handler)
+        root.setLevel(logging.INFO if mode == "queue_info" else logging.DEBUG)
+
+
+def run(client, mode, messages, users, run_id):
+    cpu = 0.0
+    started = time.perf_counter()
+    for i in range(messages):
+        payload = build_text_payload(
+            f"57310{i % users:07d}", MESSAGES[i % len(MESSAGES)], f"wamid.log-{run_id}-{mode}-{i}"
+        )
+        cpu_started = time.thread_time()
+        response = client.post("/webhook", json=payload)
+        cpu += time.thread_time() - cpu_started
+        if response.status_code != 200:
+            raise SystemExit(f"El webhook respondió {response.status_code}")
+    elapsed = time.perf_counter() - started
+    return {
+        "cpu_us_per_request": round(cpu / messages * 1e6, 1),
+        "wall_ms_per_request": round(elapsed / messages * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=500, help="Mensajes por configuración")
+    parser.add_argument("--users", type=int, default=20, help="Usuarios distintos que envían mensajes")
+    parser.add_argument("--rounds", type=int, default=3, help="Rondas por configuración (se toma la mejor)")
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    devnull = open(os.devnull, "w")
+    sys.stdout = devnull # El hilo de logging escribe en stdout: se descarta
+
+    with FakeGraphAPI(latency_ms=1.0) as fake:
+        from services import whatsapp, logging_setup
+        whatsapp.WHATSAPP_API_BASE_URL = fake.base_url
+        whatsapp.WHATSAPP_TOKEN = whatsapp.WHATSAPP_TOKEN or "bench-token"
+        whatsapp.WHATSAPP_PHONE_NUMBER_ID = whatsapp.WHATSAPP_PHONE_NUMBER_ID or "bench-phone"
+
+        from app import app
+        client = app.test_client()
+        queue_handler = logging_setup._handler
+        run_id = f"{int(time.time() * 1000):x}" # wamids únicos por ejecución (el inbox descarta repetidos)
+
+        # Calentar: chats creados, pool y caches llenos antes de medir.
+        set_mode("disabled", queue_handler, devnull)
+        run(client, "warmup", args.users * 2, args.users, run_id)
+
+        results = {}
+        for mode in MODES:
+            set_mode(mode, queue_handler, devnull)
+            rounds = [run(client, f"{mode}{r}", args.messages, args.users, run_id) for r in range(args.rounds)]
+            results[mode] = min(rounds, key=lambda result: result["cpu_us_per_request"])
+        set_mode("queue_info", queue_handler, devnull)
+
+        baseline = results["disabled"]["cpu_us_per_request"]
+        for mode in MODES[1:]:
+            results[mode]["logging_cpu_us_per_request"] = round(results[mode]["cpu_us_per_request"] - baseline, 1)
+        results["logging"] = logging_setup.get_stats()
+
+    sys.stdout = stdout
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# chatbot/benchmarks/bench_message_writer.py
+"""
+Compara la escritura de mensajes uno a uno (un INSERT y un COMMIT por mensaje) con el
+escritor por lotes de db_manager (INSERT multi-fila y un COMMIT por lote).
+
+Requiere una base de datos local configurada con las variables DB_*.
+
+Uso:
+    python -m benchmarks.bench_message_writer --messages 5000 --threads 16
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_threads(threads, messages, fn):
+    per_thread = messages // threads
+    workers = [threading.Thread(target=lambda: [fn(i) for i in range(per_thread)]) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    return {"messages": per_thread * threads, "elapsed_s": round(elapsed, 3), "messages_per_s": round(per_thread * threads / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    from services import db_manager, migrations
+    db_manager.DB_POOL_MAX = max(db_manager.DB_POOL_MAX, args.threads + 2)
+    migrations.upgrade()
+    chat = db_manager.resolve_chat("bench-writer")
+
+    def single(i):
+        db_manager.save_messages([(chat.chat_id, 'user', 'text', f"mensaje {i}")])
+
+    def batched(i):
+        db_manager.get_message_writer().submit([(chat.chat_id, 'user', 'text', f"mensaje {i}")], durable=True)
+
+    results = {
+        "single_commit": run_threads(args.threads, args.messages, single),
+        "group_commit_durable": run_threads(args.threads, args.messages, batched),
+        "writer": db_manager.get_message_writer_stats(),
+    }
+    db_manager.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# chatbot/benchmarks/bench_outbound.py
+"""
+Mide el despachador de salida (services/outbound.py) contra la API de Graph falsa.
+
+Envía N mensajes a varios destinatarios, espera a que se entreguen y comprueba que
+cada destinatario los recibió en orden. Informa mensajes/s, reintentos y fallos.
+
+Uso:
+    python -m benchmarks.bench_outbound --messages 2000 --recipients 50 --latency-ms 50 --error-rate 0.05
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_graph_api import FakeGraphAPI  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--recipients", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0, help="Límite de mensajes/s por phone_number_id (0 = sin límite)")
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with FakeGraphAPI(latency_ms=args.latency_ms, error_rate=args.error_rate) as fake:
+        os.environ["WHATSAPP_API_BASE_URL"] = fake.base_url
+        from services import whatsapp, outbound
+        whatsapp.WHATSAPP_API_BASE_URL = fake.base_url
+        whatsapp.WHATSAPP_TOKEN = whatsapp.WHATSAPP_TOKEN or "bench-token"
+        whatsapp.WHATSAPP_PHONE_NUMBER_ID = whatsapp.WHATSAPP_PHONE_NUMBER_ID or "bench-phone"
+
+        dispatcher = outbound.OutboundDispatcher(
+            num_workers=args.workers, rate_per_second=args.rate, backoff_base=0.01, backoff_max=0.1,
+        )
+        done = threading.Semaphore(0)
+        started = time.perf_counter()
+        for i in range(args.messages):
+            recipient = f"57300{i % args.recipients:07d}"
+            payload = whatsapp.build_text_payload(recipient, f"seq={i}")
+            dispatcher.enqueue(recipient, payload, on_result=lambda result: done.release())
+        enqueue_elapsed = time.perf_counter() - started
+        for _ in range(args.messages):
+            done.acquire()
+        elapsed = time.perf_counter() - started
+        dispatcher.shutdown()
+
+        # Verificar el orden por destinatario.
+        last_seq = {}
+        out_of_order = 0
+        for _, payload, _ in fake.received():
+            seq = int(payload["text"]["body"].split("=")[1])
+            if seq < last_seq.get(payload["to"], -1):
+                out_of_order += 1
+            last_seq[payload["to"]] = seq
+
+        print(json.dumps({
+            "messages": args.messages,
+            "enqueue_ms_per_message": round(enqueue_elapsed * 1000 / args.messages, 4),
+            "elapsed_s": round(elapsed, 3),
+            "messages_per_s": round(args.messages / elapsed, 1),
+            "http_connections_opened": fake.connections,
+            "out_of_order": out_of_order,
+            "dispatcher": dispatcher.stats(),
+        }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
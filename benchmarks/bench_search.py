@@ -0,0 +1,120 @@
+# chatbot/benchmarks/bench_search.py
+"""
+Latencia de /api/search sobre un volumen grande de mensajes.
+
+Crea N mensajes de prueba (repartidos en los últimos meses, con vocabulario de pedidos
+y un apellido distinto cada 1000 mensajes) y mide la primera página y la siguiente
+para búsquedas de selectividad creciente: una dirección (~10 coincidencias), un apellido
+(~1000) y una palabra presente en el 10 % de los mensajes. Los datos se borran al terminar.
+
+Requiere una base de datos local configurada con las variables DB_* habituales.
+
+Uso:
+    python -m benchmarks.bench_search --messages 1000000
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_USER = "bench-search"
+QUERIES = {
+    "direccion": "Quintero123 carrera 45",
+    "apellido": "Quintero123",
+    "frecuente": "pedido",
+}
+
+
+def seed(db_manager, messages):
+    conn = db_manager.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO chats (whatsapp_user_id) VALUES (%s) ON CONFLICT (whatsapp_user_id) DO UPDATE "
+                "SET updated_at = CURRENT_TIMESTAMP RETURNING id", (BENCH_USER,)
+            )
+            chat_id = cur.fetchone()[0]
+            cur.execute("SELECT date_trunc('month', CURRENT_TIMESTAMP)::date")
+            db_manager._ensure_message_partitions(cur, from_month=db_manager._add_months(cur.fetchone()[0], -3))
+            # Cada frase aparece en 1 de cada 10 mensajes; el apellido cambia cada 1000
+            cur.execute("""
+                INSERT INTO messages (chat_id, sender_type, message_type, content, timestamp)
+                SELECT %s, 'user', 'text',
+                       (ARRAY['hola buenas tardes', 'cuánto cuesta el kit', 'quisiera hacer un pedido',
+                              'hacen envío a Medellín', 'mi dirección es calle', 'gracias por la atención',
+                              'pago contraentrega', 'cuándo llega', 'me llamo', 'tienen garantía'])[1 + g %% 10]
+                       || ' ' || (ARRAY['Ana', 'Luis', 'Marta', 'Jorge', 'Sofía'])[1 + g %% 5]
+                       || ' Quintero' || (g / 1000) || ' carrera ' || (g %% 97) || ' # ' || (g %% 53) || '-' || (g %% 31),
+                       CURRENT_TIMESTAMP - (g %% 90) * INTERVAL '1 day'
+                FROM generate_series(1, %s) AS g
+            """, (chat_id, messages))
+            cur.execute("ANALYZE messages")
+        conn.commit()
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def cleanup(db_manager):
+    conn = db_manager.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM messages WHERE chat_id IN (SELECT id FROM chats WHERE whatsapp_user_id = %s)", (BENCH_USER,)
+            )
+            cur.execute("DELETE FROM chats WHERE whatsapp_user_id = %s", (BENCH_USER,))
+        conn.commit()
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def measure(client, text, repeat):
+    first, second = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get("/api/search", query_string={"q": text, "scope": "messages"})
+        first.append((time.perf_counter() - started) * 1000)
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor:
+            started = time.perf_counter()
+            client.get("/api/search", query_string={"q": text, "scope": "messages", "before": cursor})
+            second.append((time.perf_counter() - started) * 1000)
+    return {
+        "results_first_page": len(response.get_json()),
+        "first_page_ms_p50": round(statistics.median(first), 1),
+        "next_page_ms_p50": round(statistics.median(second), 1) if second else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--keep", action="store_true", help="No borrar los mensajes de prueba al terminar")
+    args = parser.parse_args()
+
+    from services import db_manager, logging_setup
+    from app import app
+    logging_setup.configure_logging()
+    logging.getLogger().setLevel(logging.WARNING)
+    client = app.test_client()
+
+    cleanup(db_manager)
+    started = time.perf_counter()
+    seed(db_manager, args.messages)
+    results = {"messages": args.messages, "seed_s": round(time.perf_counter() - started, 1)}
+    try:
+        for name, text in QUERIES.items():
+            results[name] = measure(client, text, args.repeat)
+    finally:
+        if not args.keep:
+            cleanup(db_manager)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
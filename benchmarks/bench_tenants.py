@@ -0,0 +1,151 @@
+# chatbot/benchmarks/bench_tenants.py
+"""
+Mide un solo proceso sirviendo varios números de WhatsApp (tenants) a la vez.
+
+Se crean --tenants tenants con su propio phone_number_id y token, y los mismos --users
+usuarios completan un pedido en cada uno (el mismo teléfono escribe a todas las marcas).
+Al terminar se comprueba el aislamiento:
+- cada (tenant, usuario) tiene su propio chat y exactamente un pedido con el tenant_id correcto;
+- cada número respondió exactamente a los mensajes que recibió.
+
+Informa el rendimiento, la memoria del proceso (RSS máximo) y las conexiones a la DB,
+que no crecen con el número de tenants.
+
+Requiere una base de datos local migrada (`python -m services.migrations upgrade`) con
+las variables DB_* habituales; los envíos a WhatsApp van a la API de Graph falsa.
+
+Uso:
+    python -m benchmarks.bench_tenants --tenants 30 --users 20
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OUTBOUND_RATE_PER_SECOND", "0") # Sin límite de envíos: se mide el procesamiento
+
+from benchmarks.fake_graph_api import FakeGraphAPI  # noqa: E402
+from benchmarks.bench_db_round_trips import build_text_payload  # noqa: E402
+from benchmarks.bench_inbound import conversation  # noqa: E402
+
+
+def create_tenants(count, run_id):
+    from services import tenants
+    created = []
+    for i in range(count):
+        tenant = tenants.create_tenant(f"Bench {run_id} #{i}", f"bench-{run_id}-{i}",
+                                       access_token=f"token-{run_id}-{i}")
+        if not tenant:
+            raise RuntimeError("No se pudo crear el tenant (¿está migrada la base de datos?)")
+        created.append(tenant)
+    return created
+
+
+def tenant_payload(tenant, user_id, text, wamid):
+    payload = build_text_payload(user_id, text, wamid)
+    payload["entry"][0]["changes"][0]["value"]["metadata"]["phone_number_id"] = tenant.phone_number_id
+    return payload
+
+
+def check(created, user_ids, received):
+    """Cuenta los (tenant, usuario) sin su pedido y las respuestas enviadas por otro número."""
+    from services import db_manager
+    tenant_ids = [tenant.id for tenant in created]
+    conn = db_manager.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT o.tenant_id, o.whatsapp_user_id, o.customer_name, c.tenant_id FROM orders o "
+                "JOIN chats c ON c.id = o.chat_id WHERE o.tenant_id = ANY(%s)", (tenant_ids,)
+            )
+            orders = {}
+            for tenant_id, user_id, name, chat_tenant_id in cur.fetchall():
+                orders.setdefault((tenant_id, user_id), []).append((name, chat_tenant_id))
+            cur.execute("SELECT count(*) FROM chats WHERE tenant_id = ANY(%s)", (tenant_ids,))
+            chats = cur.fetchone()[0]
+        conn.commit()
+    finally:
+        db_manager.release_db_connection(conn)
+    order_errors = 0
+    for tenant in created:
+        for i, user_id in enumerate(user_ids):
+            if orders.get((tenant.id, user_id)) != [(f"Cliente {i}", tenant.id)]:
+                order_errors += 1
+    # Cada mensaje tiene una respuesta, y debe salir por el número que lo recibió
+    per_number = {tenant.phone_number_id: 0 for tenant in created}
+    for pnid, payload, _ in received:
+        if pnid in per_number and payload.get("to") in user_ids:
+            per_number[pnid] += 1
+    expected = len(user_ids) * len(conversation(0))
+    return {
+        "chats": chats,
+        "expected_chats": len(created) * len(user_ids),
+        "order_errors": order_errors,
+        "replies": sum(per_number.values()),
+        "numbers_with_wrong_reply_count": sum(1 for count in per_number.values() if count != expected),
+    }
+
+
+def run(client, created, users, run_id):
+    from services import inbound, outbound
+    user_ids = [f"57{run_id % 10**6:06d}{i:04d}" for i in range(users)]
+    started = time.perf_counter()
+    for step in range(len(conversation(0))):
+        for t, tenant in enumerate(created):
+            for i, user_id in enumerate(user_ids):
+                payload = tenant_payload(tenant, user_id, conversation(i)[step], f"wamid.tn-{run_id}-{t}-{i}-{step}")
+                client.post("/webhook", json=payload)
+    engine = inbound.get_engine()
+    if engine is not None:
+        engine.wait_idle(timeout=300)
+    elapsed = time.perf_counter() - started
+    outbound.get_dispatcher().shutdown() # Entregar las respuestas antes de contarlas
+    messages = len(created) * users * len(conversation(0))
+    return user_ids, {
+        "messages": messages,
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_s": round(messages / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tenants", type=int, default=30)
+    parser.add_argument("--users", type=int, default=20, help="Usuarios por tenant (los mismos teléfonos en todos)")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Latencia de la API de Graph falsa")
+    args = parser.parse_args()
+
+    with FakeGraphAPI(latency_ms=args.latency_ms) as fake:
+        from services import whatsapp, db_manager, tenants, logging_setup
+        whatsapp.WHATSAPP_API_BASE_URL = fake.base_url
+        whatsapp.WHATSAPP_TOKEN = whatsapp.WHATSAPP_TOKEN or "bench-token"
+        whatsapp.WHATSAPP_PHONE_NUMBER_ID = whatsapp.WHATSAPP_PHONE_NUMBER_ID or "bench-phone"
+
+        from app import app
+        logging_setup.configure_logging()
+        logging.getLogger().setLevel(logging.WARNING)
+        client = app.test_client()
+        run_id = int(time.time())
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        created = create_tenants(args.tenants, run_id)
+        user_ids, result = run(client, created, args.users, run_id)
+        result["isolation"] = check(created, user_ids, fake.received())
+        pool = db_manager.get_pool_stats()
+        result["db_connections"] = pool["in_use"] + pool["idle"]
+        result["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        result["rss_growth_mb"] = round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024, 1)
+        result["tenant_registry"] = tenants.get_stats()
+
+        # Los tenants del benchmark quedan inactivos: no reciben mensajes en otras ejecuciones
+        for tenant in created:
+            tenants.update_tenant(tenant.id, is_active=False)
+        print(json.dumps({"tenants": args.tenants, "users_per_tenant": args.users, **result}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
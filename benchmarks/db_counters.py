@@ -0,0 +1,86 @@
+# chatbot/benchmarks/db_counters.py
+"""
+Conexión psycopg2 instrumentada para contar round trips a la base de datos.
+
+Se instala con `db_manager.configure_pool(connection_factory=CountingConnection)`.
+Cuenta como round trip cada sentencia ejecutada, el BEGIN implícito que psycopg2
+envía al abrir una transacción y cada COMMIT/ROLLBACK efectivo.
+"""
+import threading
+
+from psycopg2 import extensions
+
+_lock = threading.Lock()
+_counters = {"round_trips": 0, "statements": 0, "commits": 0, "rollbacks": 0, "connections": 0}
+_cursor_classes = {}
+
+
+def reset():
+    with _lock:
+        for key in _counters:
+            _counters[key] = 0
+
+
+def snapshot():
+    with _lock:
+        return dict(_counters)
+
+
+def _add(**increments):
+    with _lock:
+        for key, value in increments.items():
+            _counters[key] += value
+
+
+def _counting_cursor_class(base):
+    """Crea (una sola vez por clase base) una subclase del cursor que cuenta sus ejecuciones."""
+    cls = _cursor_classes.get(base)
+    if cls is not None:
+        return cls
+
+    def _count(cursor):
+        conn = cursor.connection
+        begin = 0
+        if not conn.autocommit and conn.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE:
+            begin = 1
+        _add(round_trips=1 + begin, statements=1)
+
+    def execute(self, query, vars=None):
+        _count(self)
+        return base.execute(self, query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        conn = self.connection
+        begin = 0
+        if not conn.autocommit and conn.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE:
+            begin = 1
+        _add(round_trips=len(vars_list) + begin, statements=len(vars_list))
+        return base.executemany(self, query, vars_list)
+
+    cls = type(f"Counting{base.__name__}", (base,), {"execute": execute, "executemany": executemany})
+    _cursor_classes[base] = cls
+    return cls
+
+
+class CountingConnection(extensions.connection):
+    """Conexión que envuelve todos sus cursores con contadores de round trips."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _add(connections=1)
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.pop("cursor_factory", None) or self.cursor_factory or extensions.cursor
+        kwargs["cursor_factory"] = _counting_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        if self.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            _add(round_trips=1, commits=1)
+        return super().commit()
+
+    def rollback(self):
+        if self.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            _add(round_trips=1, rollbacks=1)
+        return super().rollback()
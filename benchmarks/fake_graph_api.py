@@ -0,0 +1,128 @@
+# chatbot/benchmarks/fake_graph_api.py
+"""
+Servidor local que imita el endpoint de mensajes de la API de WhatsApp Cloud.
+
+Responde a POST /<version>/<phone_number_id>/messages con un wamid falso y guarda
+cada petición recibida para poder verificar orden y contenido. Puede simular
+latencia y respuestas 429/5xx.
+
+Uso como servidor independiente:
+    python -m benchmarks.fake_graph_api --port 8099 --latency-ms 80
+    WHATSAPP_API_BASE_URL=http://127.0.0.1:8099 python app.py
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGraphAPI:
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0.0, error_rate=0.0, error_status=429):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = []  # (phone_number_id, payload, instante)
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, como graph.facebook.com
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with fake._lock:
+                    fake.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body, headers=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length)
+                parts = self.path.strip("/").split("/")
+                if len(parts) != 3 or parts[2] != "messages":
+                    self._reply(404, {"error": {"message": "Unknown path"}})
+                    return
+                if fake.latency_ms:
+                    time.sleep(fake.latency_ms / 1000.0)
+                if fake.error_rate and random.random() < fake.error_rate:
+                    self._reply(fake.error_status, {"error": {"message": "Simulated error", "code": 130429}},
+                                headers={"Retry-After": "0"} if fake.error_status == 429 else None)
+                    return
+                payload = json.loads(raw or b"{}")
+                with fake._lock:
+                    fake.requests.append((parts[1], payload, time.monotonic()))
+                    wamid = f"wamid.FAKE{next(fake._ids):012d}"
+                to = payload.get("to")
+                self._reply(200, {
+                    "messaging_product": "whatsapp",
+                    "contacts": [{"input": to, "wa_id": to}],
+                    "messages": [{"id": wamid}],
+                })
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-graph-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def received(self):
+        with self._lock:
+            return list(self.requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de peticiones que fallan (0-1)")
+    parser.add_argument("--error-status", type=int, default=429)
+    args = parser.parse_args()
+    server = FakeGraphAPI(args.host, args.port, args.latency_ms, args.error_rate, args.error_status)
+    print(f"API de Graph falsa escuchando en {server.base_url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
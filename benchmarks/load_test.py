@@ -0,0 +1,285 @@
+# chatbot/benchmarks/load_test.py
+"""
+Prueba de carga de extremo a extremo del webhook con sustitutos locales.
+
+Genera payloads realistas (texto, botones, listas, pedidos completos y callbacks de
+estado, ver payloads.py) y los envía a la app de Flask a un ritmo fijo (bucle abierto:
+el envío no espera a las respuestas anteriores). Los mensajes de un mismo usuario los
+envía siempre el mismo cliente y en orden, como hace Meta. WhatsApp se sustituye por la
+API de Graph falsa y la base de datos es la PostgreSQL local (variables DB_*).
+
+Informa del caudal, las latencias p50/p95/p99 por etapa (webhook, cola y procesamiento
+entrante, envío saliente y de extremo a extremo hasta que la respuesta llega a la API),
+round trips y conexiones a la DB por mensaje y llamadas salientes por mensaje. Los
+resultados se guardan en JSON y se pueden comparar con una ejecución anterior.
+
+Uso:
+    python -m benchmarks.load_test --rate 100 --duration 30 --output resultados.json
+    python -m benchmarks.load_test --rate 100 --duration 30 --compare resultados.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OUTBOUND_RATE_PER_SECOND", "0") # El límite de Meta no es lo que se mide aquí
+
+from benchmarks import db_counters, payloads  # noqa: E402
+from benchmarks.fake_graph_api import FakeGraphAPI  # noqa: E402
+from services.workers import LatencyRecorder, ShardedExecutor  # noqa: E402
+
+# Métricas que se comparan entre ejecuciones: (ruta, mayor_es_mejor)
+COMPARED_METRICS = [
+    ("throughput.messages_per_s", True),
+    ("latency_ms.webhook.p50_ms", False),
+    ("latency_ms.webhook.p99_ms", False),
+    ("latency_ms.end_to_end.p50_ms", False),
+    ("latency_ms.end_to_end.p95_ms", False),
+    ("latency_ms.end_to_end.p99_ms", False),
+    ("latency_ms.inbound_processing.p95_ms", False),
+    ("latency_ms.outbound_delivery.p95_ms", False),
+    ("per_message.db_round_trips", False),
+    ("per_message.db_connections_opened", False),
+    ("per_message.outbound_calls", False),
+]
+
+
+class LoadDriver:
+    """Envía los payloads a su hora programada; un cliente por usuario (orden estricto)."""
+
+    def __init__(self, app, concurrency):
+        self.app = app
+        self._local = threading.local()
+        self._executor = ShardedExecutor(concurrency, queue_size=100000, name="load")
+        self.webhook = LatencyRecorder(window=None)
+        self.schedule_lag = LatencyRecorder(window=None)
+        self.errors = 0
+        self._sent_at = defaultdict(deque)  # usuario -> instantes de envío de los mensajes que esperan respuesta
+        self._lock = threading.Lock()
+
+    def _client(self):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client
+
+    def _post(self, user_id, payload, expects_reply, scheduled_at):
+        started = time.monotonic()
+        self.schedule_lag.record(max(0.0, started - scheduled_at))
+        if expects_reply:
+            with self._lock:
+                self._sent_at[user_id].append(started)
+        response = self._client().post("/webhook", json=payload)
+        self.webhook.record(time.monotonic() - started)
+        if response.status_code != 200:
+            with self._lock:
+                self.errors += 1
+
+    def run(self, items, rate):
+        """`items` son (clave, payload, espera_respuesta). Con `rate` 0 se envía sin pausa."""
+        started = time.monotonic()
+        for index, (user_id, payload, expects_reply) in enumerate(items):
+            scheduled_at = started + index / rate if rate > 0 else time.monotonic()
+            delay = scheduled_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._executor.submit(user_id, self._post, user_id, payload, expects_reply, scheduled_at)
+        self._executor.shutdown(drain=True)
+        return time.monotonic() - started
+
+    def end_to_end(self, received):
+        """Empareja cada mensaje con la respuesta que recibió la API falsa (k-ésimo con k-ésima por usuario)."""
+        recorder = LatencyRecorder(window=None)
+        by_user = defaultdict(list)
+        for _, payload, arrived_at in received:
+            by_user[payload.get("to")].append(arrived_at)
+        unmatched = 0
+        for user_id, sent in self._sent_at.items():
+            replies = by_user.get(user_id, [])
+            for sent_at, arrived_at in zip(sent, replies):
+                recorder.record(arrived_at - sent_at)
+            unmatched += max(0, len(sent) - len(replies))
+        return recorder, unmatched
+
+
+def build_items(workload, status_ratio, rng_seed=7):
+    """Intercala callbacks de estado (sent/delivered/read) de los wamids que asigna la API falsa."""
+    import random
+    rng = random.Random(rng_seed)
+    items = []
+    replies = 0
+    for user_id, payload, _ in workload:
+        items.append((user_id, payload, True))
+        replies += 1
+        credit = status_ratio
+        while credit > 0 and rng.random() < credit:
+            credit -= 1
+            wamid = f"wamid.FAKE{rng.randint(1, replies):012d}"
+            status = rng.choice(("sent", "delivered", "read"))
+            items.append((f"status-{wamid}", payloads.status_callback([(wamid, status, user_id)]), False))
+    return items
+
+
+def wait_until(predicate, timeout, interval=0.02):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return predicate()
+
+
+def get_path(data, path):
+    for key in path.split("."):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+def compare(current, baseline, threshold):
+    """Imprime las diferencias con una ejecución anterior; devuelve cuántas métricas empeoraron."""
+    regressions = 0
+    print(f"{'métrica':45} {'anterior':>12} {'actual':>12} {'cambio':>9}")
+    for path, higher_is_better in COMPARED_METRICS:
+        before, after = get_path(baseline, path), get_path(current, path)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        worse = change < -threshold if higher_is_better else change > threshold
+        regressions += worse
+        print(f"{path:45} {before:>12} {after:>12} {change:>8.1f}%{'  << peor' if worse else ''}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=100,
+                        help="Peticiones al webhook por segundo, mensajes y callbacks de estado (0 = lo más rápido posible)")
+    parser.add_argument("--duration", type=float, default=20, help="Segundos de carga a ese ritmo")
+    parser.add_argument("--messages", type=int, default=0, help="Número de mensajes (en lugar de --duration)")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--mix", default="", help="Pesos de las sesiones, p. ej. order=0.3,browse=0.5,chat=0.2")
+    parser.add_argument("--status-ratio", type=float, default=2.0, help="Callbacks de estado por mensaje")
+    parser.add_argument("--concurrency", type=int, default=16, help="Clientes simultáneos")
+    parser.add_argument("--latency-ms", type=float, default=80.0, help="Latencia de la API de Graph falsa")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de envíos que fallan con 429")
+    parser.add_argument("--drain-timeout", type=float, default=60.0)
+    parser.add_argument("--output", help="Archivo JSON donde guardar los resultados")
+    parser.add_argument("--compare", help="Resultados JSON de una ejecución anterior")
+    parser.add_argument("--threshold", type=float, default=10.0, help="% de empeoramiento que se marca como regresión")
+    args = parser.parse_args()
+
+    messages = args.messages or round(args.rate * args.duration / (1 + args.status_ratio)) or 1000
+    run_id = f"{int(time.time()) % 10**5:05d}"
+    workload = payloads.generate_workload(messages, args.users, payloads.parse_mix(args.mix), prefix=f"57{run_id}")
+    items = build_items(workload, args.status_ratio)
+
+    from services import db_manager
+    db_manager.configure_pool(connection_factory=db_counters.CountingConnection)
+
+    with FakeGraphAPI(latency_ms=args.latency_ms, error_rate=args.error_rate) as fake:
+        from services import whatsapp, outbound, inbound, delivery_status, logging_setup
+        whatsapp.WHATSAPP_API_BASE_URL = fake.base_url
+        whatsapp.WHATSAPP_TOKEN = whatsapp.WHATSAPP_TOKEN or "bench-token"
+        whatsapp.WHATSAPP_PHONE_NUMBER_ID = whatsapp.WHATSAPP_PHONE_NUMBER_ID or "bench-phone"
+
+        from app import app
+        logging_setup.configure_logging()
+        logging.getLogger().setLevel(logging.WARNING)
+
+        dispatcher = outbound.get_dispatcher()
+        engine = inbound.get_engine()
+        for recorder in (dispatcher.send_time, dispatcher.delivery_time):
+            recorder.reset()
+        if engine is not None:
+            engine.queue_wait, engine.processing_time = LatencyRecorder(window=None), LatencyRecorder(window=None)
+        db_counters.reset()
+        connections_before = fake.connections
+
+        driver = LoadDriver(app, args.concurrency)
+        started = time.monotonic()
+        send_elapsed = driver.run(items, args.rate)
+        if engine is not None:
+            engine.wait_idle(timeout=args.drain_timeout)
+        # Todas las respuestas entregadas (o fallidas) a la API falsa
+        expected = messages
+        wait_until(lambda: dispatcher.stats()["sent"] + dispatcher.stats()["failed"] >= expected, args.drain_timeout)
+        elapsed = time.monotonic() - started # Hasta la última respuesta enviada
+        end_to_end, unmatched = driver.end_to_end(fake.received())
+        wait_until(lambda: delivery_status.get_stats().get("pending", 0) == 0, args.drain_timeout)
+        counters = db_counters.snapshot()
+
+        inbound_stats = inbound.get_stats()
+        outbound_stats = dispatcher.stats()
+        results = {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "git_commit": git_commit(),
+                "python": platform.python_version(),
+                "cpu_count": os.cpu_count(),
+                "args": vars(args),
+            },
+            "throughput": {
+                "messages": messages,
+                "status_callbacks": len(items) - messages,
+                "send_elapsed_s": round(send_elapsed, 3),
+                "elapsed_s": round(elapsed, 3),
+                "messages_per_s": round(messages / elapsed, 1),
+                "requests_per_s": round(len(items) / elapsed, 1),
+                "webhook_errors": driver.errors,
+                "unanswered_messages": unmatched,
+            },
+            "latency_ms": {
+                "driver_schedule_lag": driver.schedule_lag.stats(),
+                "webhook": driver.webhook.stats(),
+                "inbound_queue_wait": inbound_stats.get("queue_wait"),
+                "inbound_processing": inbound_stats.get("processing_time"),
+                "outbound_delivery": outbound_stats["delivery_time"],
+                "outbound_send": outbound_stats["send_time"],
+                "end_to_end": end_to_end.stats(),
+            },
+            "per_message": {
+                "db_round_trips": round(counters["round_trips"] / messages, 3),
+                "db_statements": round(counters["statements"] / messages, 3),
+                "db_commits": round(counters["commits"] / messages, 3),
+                "db_connections_opened": round(counters["connections"] / messages, 4),
+                "outbound_calls": round(len(fake.received()) / messages, 3),
+                "outbound_connections_opened": round((fake.connections - connections_before) / messages, 4),
+            },
+            "outbound": {key: outbound_stats[key] for key in ("sent", "failed", "retries", "rejected")},
+            "delivery_statuses": delivery_status.get_stats(),
+            "db_pool": db_manager.get_pool_stats(),
+        }
+        dispatcher.shutdown()
+
+    print(json.dumps(results, indent=2, default=str))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, default=str)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
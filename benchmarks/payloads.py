@@ -0,0 +1,117 @@
+# chatbot/benchmarks/payloads.py
+"""
+Generadores de payloads del webhook de WhatsApp Cloud para benchmarks: mensajes de
+texto, respuestas de botón y de lista, callbacks de estado y conversaciones completas
+(p. ej. un pedido a través de `pedir_kit_oscar_si`).
+"""
+import random
+import time
+
+
+def envelope(value):
+    """Envuelve un `value` de cambio en el formato que envía Meta al webhook."""
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{
+            "id": "bench",
+            "changes": [{
+                "field": "messages",
+                "value": dict({"messaging_product": "whatsapp", "metadata": {"phone_number_id": "bench"}}, **value),
+            }],
+        }],
+    }
+
+
+def _message(from_phone_number, message_id, message_type, body):
+    return envelope({
+        "contacts": [{"profile": {"name": "Cliente bench"}, "wa_id": from_phone_number}],
+        "messages": [dict({
+            "from": from_phone_number,
+            "id": message_id,
+            "timestamp": str(int(time.time())),
+            "type": message_type,
+        }, **body)],
+    })
+
+
+def text_message(from_phone_number, text, message_id):
+    return _message(from_phone_number, message_id, "text", {"text": {"body": text}})
+
+
+def button_reply(from_phone_number, button_id, message_id, title=None):
+    return _message(from_phone_number, message_id, "interactive", {"interactive": {
+        "type": "button_reply", "button_reply": {"id": button_id, "title": title or button_id},
+    }})
+
+
+def list_reply(from_phone_number, row_id, message_id, title=None):
+    return _message(from_phone_number, message_id, "interactive", {"interactive": {
+        "type": "list_reply", "list_reply": {"id": row_id, "title": title or row_id},
+    }})
+
+
+def status_callback(statuses):
+    """`statuses` es una lista de (wamid, estado, destinatario)."""
+    now = str(int(time.time()))
+    return envelope({"statuses": [
+        {"id": wamid, "status": status, "timestamp": now, "recipient_id": recipient_id}
+        for wamid, status, recipient_id in statuses
+    ]})
+
+
+# Conversaciones: lista de (generador, argumento). Todas las entradas obtienen respuesta
+# del bot (ninguna pasa el chat a un agente), así cada mensaje se puede emparejar con
+# la respuesta que llega a la API de Graph.
+SESSIONS = {
+    "order": lambda n: [
+        (text_message, "hola"),
+        (list_reply, "opt_kit_oscar"),
+        (button_reply, "pedir_kit_oscar_si"),
+        (text_message, f"Cliente {n}"),
+        (text_message, f"Calle {n} # 10-20, Bogotá"),
+        (button_reply, "payment_contraentrega"),
+    ],
+    "browse": lambda n: [
+        (text_message, "hola"),
+        (list_reply, "opt_catalogo"),
+        (button_reply, "menu_principal"),
+    ],
+    "chat": lambda n: [
+        (text_message, "¿tienen envíos a Medellín?"),
+    ],
+}
+DEFAULT_MIX = {"order": 0.3, "browse": 0.5, "chat": 0.2}
+
+
+def parse_mix(text):
+    """'order=0.3,browse=0.5,chat=0.2' -> dict."""
+    mix = {}
+    for part in filter(None, (text or "").split(",")):
+        name, _, weight = part.partition("=")
+        if name not in SESSIONS:
+            raise ValueError(f"Sesión desconocida: {name!r} (opciones: {', '.join(SESSIONS)})")
+        mix[name] = float(weight or 1)
+    return mix or dict(DEFAULT_MIX)
+
+
+def generate_workload(messages, users, mix=None, prefix="57399", seed=1):
+    """
+    Devuelve unos `messages` mensajes como lista de (user_id, payload, sesión), con las
+    sesiones de cada usuario en orden y los usuarios intercalados al azar.
+    """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    names, weights = list(mix), list(mix.values())
+    user_ids = [f"{prefix}{i:07d}" for i in range(users)]
+    pending = {user_id: [] for user_id in user_ids}
+    sequence = 0
+    workload = []
+    while len(workload) < messages:
+        user_id = rng.choice(user_ids)
+        if not pending[user_id]:
+            session = rng.choices(names, weights)[0]
+            pending[user_id] = [(session, step) for step in SESSIONS[session](sequence)]
+        session, (generator, argument) = pending[user_id].pop(0)
+        sequence += 1
+        workload.append((user_id, generator(user_id, argument, f"wamid.load-{prefix}-{sequence}"), session))
+    return workload
@@ -0,0 +1,308 @@
+# chatbot/migrations/0001_baseline.py
+"""
+Esquema base: todo lo que creaba `db_manager.initialize_db()` antes de las migraciones
+versionadas. Cada sentencia es idempotente, así que en una base de datos existente solo
+completa lo que falte (incluida la conversión de `messages` a tabla particionada).
+
+No usa código de la aplicación: las constantes y el SQL son los de la versión 1, así el
+resultado en una base de datos nueva no cambia aunque cambie db_manager.
+"""
+import logging
+from datetime import date
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CONFIG = "chatbot_es"
+MESSAGE_PREVIEW_LENGTH = 200
+MESSAGES_PARTITIONS_AHEAD = 3
+
+
+def upgrade(cur):
+    legacy_messages = _rename_legacy_messages(cur)
+    _ensure_search_config(cur)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS chats (
+            id SERIAL PRIMARY KEY,
+            whatsapp_user_id VARCHAR(255) UNIQUE NOT NULL,
+            status VARCHAR(50) DEFAULT 'active', -- 'active', 'closed'
+            control_mode VARCHAR(50) DEFAULT 'bot', -- 'bot', 'agent'
+            assigned_agent_id INTEGER NULL, -- ID del agente asignado
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Particionada por mes: las escrituras y el historial reciente solo tocan las
+        -- particiones recientes y las antiguas se archivan enteras (ver message_archive.py).
+        -- La clave primaria incluye `timestamp` porque es la clave de partición.
+        CREATE SEQUENCE IF NOT EXISTS messages_id_seq AS INTEGER;
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+            chat_id INTEGER NOT NULL REFERENCES chats(id),
+            sender_type VARCHAR(10) NOT NULL, -- 'user', 'bot', 'agent'
+            message_type VARCHAR(50) NOT NULL, -- 'text', 'interactive_button', 'interactive_list', etc.
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            wamid VARCHAR(255),
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+        ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+        -- Red de seguridad si falta la partición de un mes; sus filas se mueven al crearla
+        CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+        CREATE TABLE IF NOT EXISTS orders (
+            id SERIAL PRIMARY KEY,
+            chat_id INTEGER NOT NULL REFERENCES chats(id),
+            whatsapp_user_id VARCHAR(255) NOT NULL,
+            product_name VARCHAR(255) NOT NULL,
+            customer_name VARCHAR(255),
+            delivery_address TEXT,
+            payment_method VARCHAR(100),
+            status VARCHAR(50) DEFAULT 'pending', -- 'pending', 'confirmed', 'shipped', 'delivered', 'cancelled'
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Inbox de mensajes entrantes: idempotencia por wamid y reanudación tras caídas
+        CREATE TABLE IF NOT EXISTS webhook_inbox (
+            id BIGSERIAL PRIMARY KEY,
+            wamid VARCHAR(255) UNIQUE NOT NULL, -- ID del mensaje de WhatsApp
+            whatsapp_user_id VARCHAR(255),
+            payload JSONB NOT NULL,
+            status VARCHAR(20) DEFAULT 'pending', -- 'pending', 'processing', 'done', 'failed'
+            attempts INTEGER DEFAULT 0,
+            last_error TEXT,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            claimed_at TIMESTAMP NULL,
+            processed_at TIMESTAMP NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_webhook_inbox_unfinished
+            ON webhook_inbox (id) WHERE status IN ('pending', 'processing');
+
+        -- Resumen del último mensaje por chat: la bandeja del panel sale de una sola consulta
+        ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_preview TEXT;
+        ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_sender_type VARCHAR(10);
+        ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP;
+        ALTER TABLE chats ADD COLUMN IF NOT EXISTS unread_count INTEGER NOT NULL DEFAULT 0; -- Mensajes del usuario desde la última lectura del agente
+        ALTER TABLE chats ADD COLUMN IF NOT EXISTS agent_last_read_at TIMESTAMP;
+
+        -- Índices para la paginación por cursor de la API de administración
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_timestamp ON messages (chat_id, timestamp, id);
+        CREATE INDEX IF NOT EXISTS idx_chats_updated_at ON chats (updated_at DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_orders_status_created_at ON orders (status, created_at DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_chats_status_updated_at ON chats (status, updated_at DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_chats_control_mode_updated_at ON chats (control_mode, updated_at DESC, id DESC);
+
+        -- Estado del flujo conversacional de cada usuario (compartido entre workers)
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            whatsapp_user_id VARCHAR(255) PRIMARY KEY,
+            state JSONB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL -- Los flujos abandonados se descartan al expirar
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversation_states_expires_at ON conversation_states (expires_at);
+
+        -- wamid de cada mensaje (entrante o enviado) para cruzarlo con los estados de entrega
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS wamid VARCHAR(255);
+        CREATE INDEX IF NOT EXISTS idx_messages_wamid ON messages (wamid) WHERE wamid IS NOT NULL;
+
+        -- Último estado de entrega de cada mensaje enviado (sent/delivered/read/failed)
+        CREATE TABLE IF NOT EXISTS message_statuses (
+            wamid VARCHAR(255) PRIMARY KEY,
+            recipient_id VARCHAR(255),
+            status VARCHAR(20) NOT NULL,
+            status_rank SMALLINT NOT NULL, -- Orden del estado: nunca se retrocede (read no vuelve a delivered)
+            status_timestamp TIMESTAMP,
+            error_code INTEGER,
+            error_title TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Tabla de agentes (para futura autenticación y asignación)
+        CREATE TABLE IF NOT EXISTS agents (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(100) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            full_name VARCHAR(255),
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Particiones de mensajes archivadas en disco (ver message_archive.py)
+        CREATE TABLE IF NOT EXISTS message_archives (
+            partition_name VARCHAR(63) PRIMARY KEY,
+            range_start TIMESTAMP NOT NULL,
+            range_end TIMESTAMP NOT NULL,
+            file_path TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            file_bytes BIGINT NOT NULL,
+            sha256 VARCHAR(64) NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        -- Qué chats tiene cada archivo: las consultas solo abren los archivos necesarios
+        CREATE TABLE IF NOT EXISTS message_archive_chats (
+            chat_id INTEGER NOT NULL,
+            partition_name VARCHAR(63) NOT NULL REFERENCES message_archives(partition_name) ON DELETE CASCADE,
+            message_count INTEGER NOT NULL,
+            first_message_at TIMESTAMP NOT NULL,
+            last_message_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (chat_id, partition_name)
+        );
+
+        -- Búsqueda de texto completo: columnas generadas (siempre sincronizadas con cada
+        -- INSERT/UPDATE) e índices GIN; en `messages` el índice se crea en cada partición.
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (to_tsvector('chatbot_es', content)) STORED;
+        CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector);
+        ALTER TABLE orders ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('chatbot_es', COALESCE(customer_name, '')), 'A') ||
+            setweight(to_tsvector('chatbot_es', COALESCE(delivery_address, '')), 'B')
+        ) STORED;
+        CREATE INDEX IF NOT EXISTS idx_orders_search ON orders USING GIN (search_vector);
+
+        -- Campañas de difusión (ver campaigns.py)
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            message JSONB NOT NULL, -- {"text": ...} o {"template": {"name", "language", "parameters"}}
+            audience JSONB NOT NULL DEFAULT '{}', -- Filtros sobre chats
+            status VARCHAR(20) NOT NULL DEFAULT 'draft', -- 'draft', 'running', 'paused', 'completed', 'cancelled'
+            rate_per_second REAL, -- NULL: el límite por defecto (CAMPAIGN_RATE_PER_SECOND)
+            audience_cursor INTEGER NOT NULL DEFAULT 0, -- Último chat_id cargado en campaign_recipients
+            audience_loaded BOOLEAN NOT NULL DEFAULT FALSE,
+            total_recipients INTEGER NOT NULL DEFAULT 0,
+            sent_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP NULL,
+            finished_at TIMESTAMP NULL
+        );
+        -- Un destinatario por chat y campaña: pending -> sending -> sent/failed
+        -- ('unknown' si el proceso cayó con el envío en curso; no se reenvía)
+        CREATE TABLE IF NOT EXISTS campaign_recipients (
+            campaign_id INTEGER NOT NULL REFERENCES campaigns(id) ON DELETE CASCADE,
+            chat_id INTEGER NOT NULL,
+            whatsapp_user_id VARCHAR(255) NOT NULL,
+            customer_name VARCHAR(255),
+            status VARCHAR(10) NOT NULL DEFAULT 'pending',
+            wamid VARCHAR(255),
+            sent_at TIMESTAMP NULL,
+            PRIMARY KEY (campaign_id, chat_id)
+        );
+        -- Pedidos de un chat (nombre del cliente y filtros de audiencia de las campañas)
+        CREATE INDEX IF NOT EXISTS idx_orders_chat_id ON orders (chat_id, created_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_campaign_recipients_unfinished
+            ON campaign_recipients (campaign_id, chat_id) WHERE status IN ('pending', 'sending');
+    """)
+    if legacy_messages:
+        _copy_legacy_messages(cur)
+    else:
+        _create_message_partitions(cur)
+    # Rellenar el resumen de los chats con mensajes anteriores a estas columnas
+    cur.execute("""
+        UPDATE chats c
+        SET last_message_preview = LEFT(m.content, %s),
+            last_sender_type = m.sender_type,
+            last_message_at = m.timestamp
+        FROM (
+            SELECT DISTINCT ON (chat_id) chat_id, sender_type, content, timestamp
+            FROM messages
+            ORDER BY chat_id, timestamp DESC, id DESC
+        ) m
+        WHERE c.id = m.chat_id AND c.last_message_at IS NULL
+    """, (MESSAGE_PREVIEW_LENGTH,))
+
+
+def _ensure_search_config(cur):
+    """
+    Crea la configuración de búsqueda `chatbot_es` (copia de 'spanish'). Si la extensión
+    unaccent está disponible se añade antes del stemmer y la búsqueda ignora todas las
+    tildes; sin ella el stemmer español ya las quita de casi todas las palabras.
+    """
+    config = SEARCH_CONFIG
+    cur.execute("SELECT 1 FROM pg_ts_config WHERE cfgname = %s", (config,))
+    if cur.fetchone():
+        return
+    cur.execute(f"CREATE TEXT SEARCH CONFIGURATION {config} (COPY = spanish)")
+    cur.execute("SAVEPOINT search_unaccent")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS unaccent")
+        cur.execute(
+            f"ALTER TEXT SEARCH CONFIGURATION {config} "
+            "ALTER MAPPING FOR hword, hword_part, word WITH unaccent, spanish_stem"
+        )
+        cur.execute("RELEASE SAVEPOINT search_unaccent")
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT search_unaccent")
+        logger.warning(f"Extensión unaccent no disponible; la búsqueda usará solo el stemmer español: {e}")
+
+
+def _rename_legacy_messages(cur):
+    """
+    Si `messages` es todavía una tabla sin particionar, la renombra (con su clave primaria e
+    índices) para crear la tabla particionada en su lugar. Devuelve True si hay que copiarla.
+    """
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('messages')")
+    row = cur.fetchone()
+    if row is None or row[0] == 'p':
+        return False
+    logger.warning("Convirtiendo la tabla messages en una tabla particionada por mes (se copian los mensajes existentes).")
+    cur.execute("""
+        ALTER TABLE messages RENAME TO messages_unpartitioned;
+        ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey;
+        ALTER TABLE messages_unpartitioned ADD COLUMN IF NOT EXISTS wamid VARCHAR(255);
+        ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+        DROP INDEX IF EXISTS idx_messages_chat_timestamp;
+        DROP INDEX IF EXISTS idx_messages_wamid;
+    """)
+    return True
+
+
+def _copy_legacy_messages(cur):
+    """Copia los mensajes de la tabla sin particionar (con sus ids) y la elimina."""
+    cur.execute("SELECT date_trunc('month', MIN(timestamp))::date FROM messages_unpartitioned")
+    _create_message_partitions(cur, from_month=cur.fetchone()[0])
+    cur.execute("""
+        INSERT INTO messages (id, chat_id, sender_type, message_type, content, timestamp, wamid)
+        SELECT id, chat_id, sender_type, message_type, content, COALESCE(timestamp, CURRENT_TIMESTAMP), wamid
+        FROM messages_unpartitioned
+    """)
+    logger.warning(f"{cur.rowcount} mensajes copiados a la tabla particionada.")
+    cur.execute("DROP TABLE messages_unpartitioned")
+
+
+def _add_months(month, months):
+    years, index = divmod(month.month - 1 + months, 12)
+    return date(month.year + years, index + 1, 1)
+
+
+def _create_message_partitions(cur, from_month=None):
+    """
+    Particiones mensuales `messages_pAAAA_MM` desde `from_month` (por defecto el mes en
+    curso) hasta MESSAGES_PARTITIONS_AHEAD meses después; las filas de esos meses que
+    estuvieran en la partición por defecto se mueven a la suya.
+    """
+    cur.execute("SELECT date_trunc('month', CURRENT_TIMESTAMP)::date")
+    current = cur.fetchone()[0]
+    month = from_month.replace(day=1) if from_month else current
+    last = _add_months(current, MESSAGES_PARTITIONS_AHEAD)
+    while month <= last:
+        name = f"messages_p{month:%Y_%m}"
+        cur.execute("SELECT to_regclass(%s)", (name,))
+        if cur.fetchone()[0] is None:
+            bounds = (month, _add_months(month, 1))
+            cur.execute("SELECT EXISTS (SELECT 1 FROM messages_default WHERE timestamp >= %s AND timestamp < %s)", bounds)
+            misplaced = cur.fetchone()[0]
+            if misplaced:
+                cur.execute("ALTER TABLE messages DETACH PARTITION messages_default")
+            cur.execute(f"CREATE TABLE {name} PARTITION OF messages FOR VALUES FROM (%s) TO (%s)", bounds)
+            if misplaced:
+                cur.execute(
+                    "WITH moved AS (DELETE FROM messages_default WHERE timestamp >= %s AND timestamp < %s RETURNING *) "
+                    "INSERT INTO messages (id, chat_id, sender_type, message_type, content, timestamp, wamid) "
+                    "SELECT id, chat_id, sender_type, message_type, content, timestamp, wamid FROM moved", bounds
+                )
+                cur.execute("ALTER TABLE messages ATTACH PARTITION messages_default DEFAULT")
+        month = _add_months(month, 1)
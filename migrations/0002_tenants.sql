@@ -0,0 +1,32 @@
+-- chatbot/migrations/0002_tenants.sql
+-- Varios números de WhatsApp (tenants) en un mismo despliegue. Todo lo existente queda en
+-- el tenant 1 ('default'), que usa WHATSAPP_PHONE_NUMBER_ID/WHATSAPP_ACCESS_TOKEN del entorno.
+
+CREATE TABLE IF NOT EXISTS tenants (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    phone_number_id VARCHAR(64) UNIQUE, -- NULL: el del entorno (solo el tenant por defecto)
+    access_token TEXT, -- NULL: WHATSAPP_ACCESS_TOKEN
+    flow_file VARCHAR(255), -- Relativo a flows/; NULL: BOT_FLOW_FILE
+    rate_per_second REAL, -- Mensajes/s del número; NULL: OUTBOUND_RATE_PER_SECOND
+    is_active BOOLEAN NOT NULL DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO tenants (id, name) VALUES (1, 'default') ON CONFLICT (id) DO NOTHING;
+SELECT setval(pg_get_serial_sequence('tenants', 'id'), GREATEST((SELECT MAX(id) FROM tenants), 1));
+
+-- Un chat por usuario y número: el mismo cliente puede escribir a dos marcas
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS tenant_id INTEGER NOT NULL DEFAULT 1 REFERENCES tenants(id);
+CREATE UNIQUE INDEX IF NOT EXISTS chats_tenant_user_key ON chats (tenant_id, whatsapp_user_id);
+ALTER TABLE chats DROP CONSTRAINT IF EXISTS chats_whatsapp_user_id_key;
+CREATE INDEX IF NOT EXISTS idx_chats_tenant_updated_at ON chats (tenant_id, updated_at DESC, id DESC);
+
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS tenant_id INTEGER NOT NULL DEFAULT 1 REFERENCES tenants(id);
+CREATE INDEX IF NOT EXISTS idx_orders_tenant_created_at ON orders (tenant_id, created_at DESC, id DESC);
+
+ALTER TABLE conversation_states ADD COLUMN IF NOT EXISTS tenant_id INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE conversation_states DROP CONSTRAINT IF EXISTS conversation_states_pkey;
+ALTER TABLE conversation_states ADD PRIMARY KEY (tenant_id, whatsapp_user_id);
+
+ALTER TABLE campaigns ADD COLUMN IF NOT EXISTS tenant_id INTEGER NOT NULL DEFAULT 1 REFERENCES tenants(id);
@@ -0,0 +1,7 @@
+-- chatbot/migrations/0003_order_source_wamid.sql
+-- wamid del mensaje entrante que cerró el pedido: si ese mensaje se vuelve a procesar
+-- (reenvío de Meta o reintento desde el inbox) el pedido no se duplica. NULL en los
+-- pedidos anteriores y en los que no vienen de un mensaje.
+
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS source_wamid VARCHAR(255);
+CREATE UNIQUE INDEX IF NOT EXISTS orders_source_wamid_key ON orders (source_wamid);
@@ -0,0 +1,136 @@
+# chatbot/services/admission.py
+"""
+Control de admisión de los mensajes entrantes, antes de cualquier trabajo en la DB.
+
+- Límite por conversación (número que recibe y `whatsapp_user_id`, la misma clave que
+  reparte los mensajes entre las colas del motor): token bucket de ADMISSION_USER_RATE
+  mensajes/s con ráfagas de hasta ADMISSION_USER_BURST. Un número que envía en bucle
+  no ocupa los workers ni la DB que necesitan los demás.
+- Límite global: como mucho ADMISSION_MAX_IN_FLIGHT mensajes en proceso (en cola o
+  ejecutándose) en el proceso, para que una avalancha no sature la DB.
+
+Los mensajes que superan un límite se confirman a Meta igualmente (200) y, según
+ADMISSION_POLICY, se aplazan ('defer': quedan pendientes en el inbox y el motor los
+reintenta, pasando otra vez por `check`, cada INBOUND_DRAIN_INTERVAL segundos) o se
+descartan ('drop': no llegan a registrarse).
+"""
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Configuración del control de admisión
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "1")) # Mensajes/s sostenidos por usuario; 0 = sin límite
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "20")) # Mensajes seguidos que se admiten a un usuario
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "1000")) # Mensajes en proceso por proceso; 0 = sin límite
+ADMISSION_POLICY = os.getenv("ADMISSION_POLICY", "defer").lower() # 'defer' o 'drop': qué hacer con lo que no se admite
+ADMISSION_PRUNE_INTERVAL = float(os.getenv("ADMISSION_PRUNE_INTERVAL", "60")) # Segundos entre limpiezas de los buckets
+
+# Motivos de rechazo (etiqueta `reason` de las métricas)
+USER_RATE = "user_rate"
+OVERLOADED = "overloaded"
+
+
+class AdmissionController:
+    """
+    Decide si se admite cada mensaje entrante. No bloquea ni consulta la DB.
+
+    Cada bucket se guarda como un solo float: el instante en que volverá a estar lleno
+    (equivalente a un token bucket: los tokens disponibles son burst - (lleno_en - ahora) * rate).
+    Un bucket lleno es igual que uno inexistente, así que la limpieza periódica quita los
+    que ya se rellenaron y la memoria solo crece con los usuarios activos.
+    """
+
+    def __init__(self, user_rate=ADMISSION_USER_RATE, user_burst=ADMISSION_USER_BURST,
+                 max_in_flight=ADMISSION_MAX_IN_FLIGHT, policy=ADMISSION_POLICY,
+                 prune_interval=ADMISSION_PRUNE_INTERVAL):
+        if policy not in ("defer", "drop"):
+            raise ValueError(f"ADMISSION_POLICY inválida: {policy!r} (usa 'defer' o 'drop')")
+        self.user_rate = user_rate
+        self.user_burst = max(1.0, user_burst)
+        self.max_in_flight = max_in_flight
+        self.policy = policy
+        self.prune_interval = prune_interval
+        self.pid = os.getpid()
+        self._buckets = {}  # (phone_number_id, whatsapp_user_id) -> instante (monotonic) en que el bucket vuelve a estar lleno
+        self._next_prune = time.monotonic() + prune_interval
+        self._lock = threading.Lock()
+        self._counters = {"admitted": 0, "rejected_" + USER_RATE: 0, "rejected_" + OVERLOADED: 0, "refunded": 0, "pruned": 0}
+
+    def check(self, key, in_flight=0):
+        """
+        Devuelve None si el mensaje se admite o el motivo del rechazo (USER_RATE u
+        OVERLOADED). `key` identifica la conversación (phone_number_id, usuario). Un mensaje
+        rechazado por sobrecarga no consume el bucket.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_prune:
+                self._prune(now)
+            if self.max_in_flight and in_flight >= self.max_in_flight:
+                self._counters["rejected_" + OVERLOADED] += 1
+                return OVERLOADED
+            if self.user_rate > 0 and key:
+                interval = 1.0 / self.user_rate
+                full_at = max(self._buckets.get(key, now), now) + interval
+                if full_at - now > self.user_burst * interval:
+                    self._counters["rejected_" + USER_RATE] += 1
+                    return USER_RATE
+                self._buckets[key] = full_at
+            self._counters["admitted"] += 1
+            return None
+
+    def refund(self, key):
+        """
+        Devuelve el token de un mensaje admitido que al final no se encoló (cola del
+        usuario llena): vuelve a pasar por `check` cuando el drenaje lo retome y no
+        debe pagar dos veces.
+        """
+        with self._lock:
+            self._counters["admitted"] -= 1
+            self._counters["refunded"] += 1
+            full_at = self._buckets.get(key)
+            if full_at is not None and self.user_rate > 0:
+                self._buckets[key] = full_at - 1.0 / self.user_rate
+
+    def _prune(self, now):
+        # Un dict nuevo en lugar de borrar claves: los dict de Python no devuelven memoria al encoger
+        before = len(self._buckets)
+        self._buckets = {key: full_at for key, full_at in self._buckets.items() if full_at > now}
+        self._counters["pruned"] += before - len(self._buckets)
+        self._next_prune = now + self.prune_interval
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["tracked_users"] = len(self._buckets)
+        stats["policy"] = self.policy
+        stats["user_rate"] = self.user_rate
+        stats["user_burst"] = self.user_burst
+        stats["max_in_flight"] = self.max_in_flight
+        return stats
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    """Devuelve el controlador de admisión del proceso, creándolo en el primer uso."""
+    global _controller
+    controller = _controller
+    if controller is not None and controller.pid == os.getpid():
+        return controller
+    with _controller_lock:
+        if _controller is None or _controller.pid != os.getpid():
+            _controller = AdmissionController()
+        return _controller
+
+
+def get_stats():
+    controller = _controller
+    if controller is None or controller.pid != os.getpid():
+        return {"policy": ADMISSION_POLICY, "admitted": 0}
+    return controller.stats()
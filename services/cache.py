@@ -0,0 +1,80 @@
+# chatbot/services/cache.py
+import time
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Caché LRU acotada con expiración por TTL, segura entre hilos.
+
+    `epoch` se incrementa con cada invalidación; `set(..., epoch=e)` descarta el valor
+    si hubo invalidaciones desde que se leyó `e`, evitando guardar datos obsoletos
+    leídos de la DB mientras llegaba una invalidación.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.epoch = 0
+        self._data = OrderedDict()  # key -> (valor, expira_en)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING or item[1] <= now:
+                if item is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, epoch=None, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if epoch is not None and epoch != self.epoch:
+                return False
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self.epoch += 1
+            self.invalidations += 1
+            return self._data.pop(key, _MISSING) is not _MISSING
+
+    def clear(self):
+        with self._lock:
+            self.epoch += 1
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl_s": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,604 @@
+# chatbot/services/campaigns.py
+"""
+Campañas de difusión: un mensaje (texto o plantilla aprobada) enviado a todos los chats
+que cumplen unos filtros de audiencia.
+
+- La audiencia se lee de `chats` por bloques (keyset por id) y se copia a
+  `campaign_recipients`; el último id cargado queda en la campaña como punto de control.
+- Los envíos salen por un despachador propio (pool de workers con token bucket, ver
+  outbound.py) limitado a una fracción del nivel de throughput de la cuenta, para dejar
+  margen a las conversaciones. Solo se reintentan los 429 y los errores al conectar; un
+  envío que falla con la petición ya enviada (timeout de lectura, 5xx) queda como
+  'unknown' y no se repite.
+- Antes de encolar un lote se marca 'sending' en un solo UPDATE y los resultados se
+  guardan por lotes. Si el proceso cae, al reanudar solo los destinatarios de lotes en
+  curso quedan como 'unknown' y no se reenvían: nadie recibe el mensaje dos veces.
+- Un advisory lock por campaña garantiza un único proceso enviándola.
+
+Desde la línea de comandos (recomendado para campañas grandes):
+    python -m services.campaigns run <campaign_id>
+    python -m services.campaigns resume    # Reanuda las campañas interrumpidas
+"""
+import os
+import atexit
+import logging
+import argparse
+import threading
+import contextvars
+from datetime import datetime
+
+from psycopg2 import extras
+
+from services import db_manager
+from services import logging_setup
+from services import metrics
+from services import outbound
+from services import tenants
+from services import whatsapp
+
+logger = logging.getLogger(__name__)
+
+# Configuración de las campañas
+CAMPAIGN_CHUNK_SIZE = int(os.getenv("CAMPAIGN_CHUNK_SIZE", "1000")) # Destinatarios cargados por lectura de la audiencia
+CAMPAIGN_SEND_BATCH = int(os.getenv("CAMPAIGN_SEND_BATCH", "200")) # Máximo de destinatarios marcados 'sending' por UPDATE
+CAMPAIGN_BATCH_SECONDS = float(os.getenv("CAMPAIGN_BATCH_SECONDS", "1")) # Cada lote cubre ~N segundos de envíos al ritmo de la campaña
+CAMPAIGN_WORKERS = int(os.getenv("CAMPAIGN_WORKERS", "32")) # Envíos simultáneos a la API
+WHATSAPP_THROUGHPUT_MPS = float(os.getenv("WHATSAPP_THROUGHPUT_MPS", "80")) # Nivel de la cuenta: 80 msg/s (1000 tras la mejora de Meta); tenants sin rate_per_second
+CAMPAIGN_RATE_SHARE = float(os.getenv("CAMPAIGN_RATE_SHARE", "0.75")) # Fracción para campañas; el resto, para conversaciones
+CAMPAIGN_SAVE_HISTORY = os.getenv("CAMPAIGN_SAVE_HISTORY", "true").lower() == "true" # Guardar el mensaje en el historial del chat
+CAMPAIGN_RETRY_STATUS_CODES = {429} # Un 5xx puede llegar con el mensaje ya aceptado: no se reintenta
+CAMPAIGN_LOCK_NAMESPACE = 7311 # Primera clave de pg_try_advisory_lock(namespace, campaign_id)
+
+CAMPAIGN_STATUSES = ("draft", "running", "paused", "completed", "cancelled")
+AUDIENCE_FILTERS = ("status", "control_mode", "active_since", "active_before", "has_orders", "order_status", "product")
+
+
+def campaign_rate_limit(tenant=None):
+    """Mensajes/s máximos de una campaña según el nivel de throughput del número (tenant)."""
+    throughput = tenant.rate_per_second if tenant is not None and tenant.rate_per_second else WHATSAPP_THROUGHPUT_MPS
+    return throughput * CAMPAIGN_RATE_SHARE
+
+
+# --- Mensaje y audiencia ---
+
+def _variables(customer_name, whatsapp_user_id):
+    # {name}: nombre del último pedido del chat (vacío si no tiene); {phone}: número del destinatario
+    return {"name": customer_name or "", "phone": whatsapp_user_id}
+
+
+def _format(text, variables):
+    try:
+        return text.format(**variables)
+    except (KeyError, IndexError, ValueError, AttributeError) as e:
+        raise ValueError(f"Variable inválida en el mensaje de la campaña: {e} (disponibles: name, phone)")
+
+
+def render_message(message, customer_name, whatsapp_user_id):
+    """
+    Payload de la API, texto para el historial y tipo de mensaje para un destinatario.
+    `message` es {"text": "..."} o {"template": {"name", "language", "parameters": [...]}};
+    el texto y los parámetros admiten {name} y {phone}. Lanza ValueError si no es válido.
+    """
+    variables = _variables(customer_name, whatsapp_user_id)
+    if isinstance(message.get("text"), str) and message["text"].strip():
+        text = _format(message["text"], variables)
+        return whatsapp.build_text_payload(whatsapp_user_id, text), text, "text"
+    template = message.get("template")
+    if isinstance(template, dict) and isinstance(template.get("name"), str) and template["name"]:
+        parameters = [_format(str(value), variables) for value in template.get("parameters") or ()]
+        payload = whatsapp.build_template_payload(
+            whatsapp_user_id, template["name"], template.get("language") or "es", parameters
+        )
+        content = f"[Plantilla {template['name']}] {' | '.join(parameters)}".strip()
+        return payload, content, "template"
+    raise ValueError('El mensaje de la campaña debe tener "text" o "template" con "name".')
+
+
+def _audience_conditions(audience):
+    """Condiciones SQL sobre `chats c` para los filtros de audiencia. Lanza ValueError."""
+    unknown = set(audience) - set(AUDIENCE_FILTERS)
+    if unknown:
+        raise ValueError(f"Filtros de audiencia desconocidos: {', '.join(sorted(unknown))} (opciones: {', '.join(AUDIENCE_FILTERS)})")
+    conditions, params = [], []
+    status = audience.get("status", "active") # Por defecto solo chats activos; None para todos
+    if status:
+        conditions.append("c.status = %s")
+        params.append(status)
+    if audience.get("control_mode"):
+        conditions.append("c.control_mode = %s")
+        params.append(audience["control_mode"])
+    for key, operator in (("active_since", ">="), ("active_before", "<")):
+        if audience.get(key):
+            try:
+                params.append(datetime.fromisoformat(audience[key]))
+            except (TypeError, ValueError):
+                raise ValueError(f"Fecha inválida en '{key}': {audience[key]!r} (se espera ISO 8601)")
+            conditions.append(f"c.last_message_at {operator} %s")
+    if audience.get("has_orders") is not None:
+        conditions.append(f"{'' if audience['has_orders'] else 'NOT '}EXISTS (SELECT 1 FROM orders o WHERE o.chat_id = c.id)")
+    if audience.get("order_status"):
+        statuses = audience["order_status"]
+        if isinstance(statuses, str):
+            statuses = [statuses]
+        conditions.append("EXISTS (SELECT 1 FROM orders o WHERE o.chat_id = c.id AND o.status = ANY(%s))")
+        params.append(list(statuses))
+    if audience.get("product"):
+        conditions.append("EXISTS (SELECT 1 FROM orders o WHERE o.chat_id = c.id AND o.product_name = %s)")
+        params.append(audience["product"])
+    return conditions, params
+
+
+# --- Campañas ---
+
+def create_campaign(name, message, audience=None, rate_per_second=None, tenant_id=db_manager.DEFAULT_TENANT_ID):
+    """
+    Crea una campaña en estado 'draft' para los chats de un número (tenant) y devuelve su
+    id (None si hubo un error de DB). Lanza ValueError si el mensaje, la audiencia, el
+    límite o el tenant no son válidos.
+    """
+    tenant = tenants.get_tenant(tenant_id)
+    if tenant is None:
+        raise ValueError(f"El tenant {tenant_id} no existe.")
+    audience = audience or {}
+    if not name:
+        raise ValueError("La campaña necesita un nombre.")
+    if not isinstance(message, dict) or not isinstance(audience, dict):
+        raise ValueError("'message' y 'audience' deben ser objetos JSON.")
+    render_message(message, "Cliente", "573000000000") # Validar antes de guardar
+    _audience_conditions(audience)
+    if rate_per_second is not None:
+        try:
+            rate_per_second = float(rate_per_second)
+        except (TypeError, ValueError):
+            raise ValueError(f"rate_per_second inválido: {rate_per_second!r}")
+        if not 0 < rate_per_second <= campaign_rate_limit(tenant):
+            raise ValueError(f"rate_per_second debe estar entre 0 y {campaign_rate_limit(tenant):g} mensajes/s.")
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO campaigns (tenant_id, name, message, audience, rate_per_second) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+                (tenant_id, name, extras.Json(message), extras.Json(audience), rate_per_second)
+            )
+            campaign_id = cur.fetchone()[0]
+        conn.commit()
+        logger.info(f"Campaña {campaign_id} creada: {name}")
+        return campaign_id
+    except Exception as e:
+        logger.error(f"Error al crear la campaña {name!r}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def get_campaign(campaign_id):
+    """La campaña con sus contadores y los destinatarios por estado (None si no existe o hay error)."""
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+            cur.execute("SELECT * FROM campaigns WHERE id = %s", (campaign_id,))
+            campaign = cur.fetchone()
+            if campaign is None:
+                return None
+            cur.execute(
+                "SELECT status, COUNT(*) AS count FROM campaign_recipients WHERE campaign_id = %s GROUP BY status",
+                (campaign_id,)
+            )
+            campaign["recipients"] = {row["status"]: row["count"] for row in cur.fetchall()}
+        conn.commit()
+        return campaign
+    except Exception as e:
+        logger.error(f"Error al obtener la campaña {campaign_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def set_campaign_status(campaign_id, status):
+    """
+    Pausa ('paused') o cancela ('cancelled') una campaña que no ha terminado; el proceso
+    que la envía se detiene tras el lote en curso. Devuelve True, False si no se pudo
+    cambiar (no existe o ya terminó) o None si hubo un error.
+    """
+    if status not in ("paused", "cancelled"):
+        raise ValueError(f"Estado de campaña inválido: '{status}' (opciones: paused, cancelled)")
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE campaigns SET status = %s, finished_at = CASE WHEN %s = 'cancelled' THEN CURRENT_TIMESTAMP END "
+                "WHERE id = %s AND status IN ('draft', 'running', 'paused')",
+                (status, status, campaign_id)
+            )
+            changed = cur.rowcount > 0
+        conn.commit()
+        return changed
+    except Exception as e:
+        logger.error(f"Error al cambiar el estado de la campaña {campaign_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+# --- Envío ---
+
+class CampaignRun:
+    """Envío de una campaña desde su último punto de control (ver run_campaign)."""
+
+    def __init__(self, campaign, dispatcher, batch_size=CAMPAIGN_SEND_BATCH, tenant=None):
+        self.campaign_id = campaign["id"]
+        self.tenant = tenant
+        self.message = campaign["message"]
+        self.audience_loaded = campaign["audience_loaded"]
+        self._conditions, self._params = _audience_conditions(campaign["audience"])
+        self._dispatcher = dispatcher
+        # Envíos encolados sin resultado: como mucho dos lotes, así los resultados se
+        # guardan con poco retraso y la cola del despachador nunca se llena. Si el proceso
+        # cae, solo estos y el lote reservado quedan como 'unknown'.
+        self.batch_size = batch_size
+        self._window_size = batch_size * 2
+        self._window = threading.BoundedSemaphore(self._window_size)
+        self._outcomes = [] # (chat_id, estado, wamid, contenido, tipo de mensaje)
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Envía hasta terminar, pausarse o cancelarse. Devuelve el estado final de la campaña."""
+        status = "running"
+        while status == "running":
+            self._flush()
+            claimed = self._claim_batch()
+            if claimed is None:
+                break # Error de DB: la campaña sigue 'running' y se reanuda después
+            status, batch = claimed
+            if status != "running":
+                break
+            if not batch:
+                if self.audience_loaded or not self._load_audience_chunk():
+                    break
+                continue
+            for chat_id, whatsapp_user_id, customer_name in batch:
+                self._window.acquire()
+                self._send(chat_id, whatsapp_user_id, customer_name)
+        # Esperar los envíos en curso y guardar sus resultados
+        for _ in range(self._window_size):
+            self._window.acquire()
+        while self._outcomes and self._flush():
+            pass
+        return self._finish() if status == "running" else status
+
+    def _load_audience_chunk(self):
+        """Copia el siguiente bloque de la audiencia a campaign_recipients y avanza el cursor (misma transacción)."""
+        conn = db_manager.get_db_connection()
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    WITH loaded AS (
+                        INSERT INTO campaign_recipients (campaign_id, chat_id, whatsapp_user_id, customer_name)
+                        SELECT camp.id, c.id, c.whatsapp_user_id,
+                               (SELECT o.customer_name FROM orders o
+                                WHERE o.chat_id = c.id AND o.customer_name IS NOT NULL
+                                ORDER BY o.created_at DESC LIMIT 1)
+                        FROM campaigns camp
+                        JOIN chats c ON c.id > camp.audience_cursor AND c.tenant_id = camp.tenant_id
+                        WHERE camp.id = %s {''.join(' AND ' + condition for condition in self._conditions)}
+                        ORDER BY c.id
+                        LIMIT %s
+                        RETURNING chat_id
+                    )
+                    UPDATE campaigns
+                    SET audience_cursor = COALESCE((SELECT MAX(chat_id) FROM loaded), audience_cursor),
+                        total_recipients = total_recipients + (SELECT COUNT(*) FROM loaded),
+                        audience_loaded = (SELECT COUNT(*) FROM loaded) < %s
+                    WHERE id = %s
+                    RETURNING audience_cursor, audience_loaded
+                """, (self.campaign_id, *self._params, CAMPAIGN_CHUNK_SIZE, CAMPAIGN_CHUNK_SIZE, self.campaign_id))
+                cursor, self.audience_loaded = cur.fetchone()
+            conn.commit()
+            logger.info(f"Campaña {self.campaign_id}: audiencia cargada hasta el chat {cursor}.")
+            return True
+        except Exception as e:
+            logger.error(f"Error al cargar la audiencia de la campaña {self.campaign_id}: {e}")
+            conn.rollback()
+            return False
+        finally:
+            db_manager.release_db_connection(conn)
+
+    def _claim_batch(self):
+        """(estado de la campaña, destinatarios marcados 'sending') o None si hubo un error."""
+        conn = db_manager.get_db_connection()
+        if not conn:
+            return None
+        try:
+            with conn.cursor() as cur:
+                # FOR UPDATE: una pausa o cancelación espera a que se confirme este lote
+                cur.execute("SELECT status FROM campaigns WHERE id = %s FOR UPDATE", (self.campaign_id,))
+                status = cur.fetchone()[0]
+                batch = []
+                if status == "running":
+                    cur.execute("""
+                        UPDATE campaign_recipients r SET status = 'sending'
+                        FROM (
+                            SELECT chat_id FROM campaign_recipients
+                            WHERE campaign_id = %s AND status = 'pending'
+                            ORDER BY chat_id LIMIT %s
+                        ) p
+                        WHERE r.campaign_id = %s AND r.chat_id = p.chat_id
+                        RETURNING r.chat_id, r.whatsapp_user_id, r.customer_name
+                    """, (self.campaign_id, self.batch_size, self.campaign_id))
+                    batch = sorted(cur.fetchall())
+            conn.commit()
+            return status, batch
+        except Exception as e:
+            logger.error(f"Error al reservar destinatarios de la campaña {self.campaign_id}: {e}")
+            conn.rollback()
+            return None
+        finally:
+            db_manager.release_db_connection(conn)
+
+    def _send(self, chat_id, whatsapp_user_id, customer_name):
+        try:
+            payload, content, message_type = render_message(self.message, customer_name, whatsapp_user_id)
+        except ValueError as e:
+            logger.error(f"Campaña {self.campaign_id}: no se pudo componer el mensaje para el chat {chat_id}: {e}")
+            self._record(chat_id, "failed", None, None, None)
+            return
+
+        def on_result(result):
+            # Aceptado aunque la respuesta no traiga wamid; 'unknown' si pudo llegar o no
+            status = "unknown" if result is outbound.UNKNOWN else "failed" if result is None else "sent"
+            self._record(chat_id, status, whatsapp.extract_wamid(result), content, message_type)
+
+        if not self._dispatcher.enqueue(whatsapp_user_id, payload, tenant=self.tenant, on_result=on_result):
+            self._record(chat_id, "failed", None, content, message_type)
+
+    def _record(self, chat_id, status, wamid, content, message_type):
+        metrics.CAMPAIGN_MESSAGES.inc(status)
+        with self._lock:
+            self._outcomes.append((chat_id, status, wamid, content, message_type))
+        self._window.release()
+
+    def _flush(self):
+        """Guarda en un solo UPDATE los resultados acumulados y suma los contadores de la campaña."""
+        with self._lock:
+            outcomes, self._outcomes = self._outcomes, []
+        if not outcomes:
+            return True
+        conn = db_manager.get_db_connection()
+        if not conn:
+            self._requeue(outcomes)
+            return False
+        try:
+            with conn.cursor() as cur:
+                extras.execute_values(cur, f"""
+                    WITH outcome (chat_id, status, wamid) AS (VALUES %s),
+                    updated AS (
+                        UPDATE campaign_recipients r
+                        SET status = o.status, wamid = o.wamid, sent_at = CURRENT_TIMESTAMP
+                        FROM outcome o
+                        WHERE r.campaign_id = {self.campaign_id:d} AND r.chat_id = o.chat_id AND r.status = 'sending'
+                        RETURNING r.status
+                    )
+                    UPDATE campaigns
+                    SET sent_count = sent_count + (SELECT COUNT(*) FROM updated WHERE status = 'sent'),
+                        failed_count = failed_count + (SELECT COUNT(*) FROM updated WHERE status = 'failed')
+                    WHERE id = {self.campaign_id:d}
+                """, [(chat_id, status, wamid) for chat_id, status, wamid, _, _ in outcomes],
+                    template="(%s::integer, %s::varchar, %s::varchar)", page_size=len(outcomes))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error al guardar {len(outcomes)} resultados de la campaña {self.campaign_id}: {e}")
+            conn.rollback()
+            self._requeue(outcomes)
+            return False
+        finally:
+            db_manager.release_db_connection(conn)
+        if CAMPAIGN_SAVE_HISTORY:
+            history = [
+                (chat_id, "bot", message_type, content, wamid)
+                for chat_id, status, wamid, content, message_type in outcomes if status == "sent"
+            ]
+            if history and not db_manager.save_messages(history):
+                logger.warning(f"Campaña {self.campaign_id}: {len(history)} mensajes enviados no se guardaron en el historial.")
+        return True
+
+    def _requeue(self, outcomes):
+        with self._lock:
+            self._outcomes[:0] = outcomes
+
+    def _finish(self):
+        """Marca la campaña como completada si ya no quedan destinatarios por enviar."""
+        if not self.audience_loaded or self._outcomes:
+            return "running"
+        conn = db_manager.get_db_connection()
+        if not conn:
+            return "running"
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE campaigns SET status = 'completed', finished_at = CURRENT_TIMESTAMP
+                    WHERE id = %s AND status = 'running' AND audience_loaded AND NOT EXISTS (
+                        SELECT 1 FROM campaign_recipients
+                        WHERE campaign_id = %s AND status IN ('pending', 'sending')
+                    )
+                    RETURNING sent_count, failed_count
+                """, (self.campaign_id, self.campaign_id))
+                row = cur.fetchone()
+            conn.commit()
+            if row is None:
+                return "running"
+            logger.info(f"Campaña {self.campaign_id} completada: {row[0]} enviados, {row[1]} fallidos.")
+            return "completed"
+        except Exception as e:
+            logger.error(f"Error al completar la campaña {self.campaign_id}: {e}")
+            conn.rollback()
+            return "running"
+        finally:
+            db_manager.release_db_connection(conn)
+
+
+def _begin(campaign_id):
+    """
+    Pone la campaña en 'running' y marca como 'unknown' los destinatarios que quedaron
+    'sending' en una ejecución anterior interrumpida. Devuelve la campaña (None si no se
+    puede enviar: no existe, ya terminó o hubo un error).
+    """
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+            cur.execute("""
+                UPDATE campaigns SET status = 'running', started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+                WHERE id = %s AND status IN ('draft', 'running', 'paused')
+                RETURNING *
+            """, (campaign_id,))
+            campaign = cur.fetchone()
+            if campaign is not None:
+                cur.execute(
+                    "UPDATE campaign_recipients SET status = 'unknown' WHERE campaign_id = %s AND status = 'sending'",
+                    (campaign_id,)
+                )
+                if cur.rowcount:
+                    logger.warning(
+                        f"Campaña {campaign_id}: {cur.rowcount} envíos interrumpidos quedan como 'unknown' (no se reenvían)."
+                    )
+        conn.commit()
+        return campaign
+    except Exception as e:
+        logger.error(f"Error al iniciar la campaña {campaign_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def run_campaign(campaign_id, dispatcher=None):
+    """
+    Envía (o reanuda) una campaña en el hilo actual. Devuelve el estado final, o None si
+    no se pudo iniciar (no existe, ya terminó o la está enviando otro proceso).
+    """
+    try:
+        lock_conn = db_manager.open_dedicated_connection()
+        lock_conn.autocommit = True
+    except Exception as e:
+        logger.error(f"No se pudo conectar a la DB para enviar la campaña {campaign_id}: {e}")
+        return None
+    own_dispatcher = dispatcher is None
+    try:
+        with lock_conn.cursor() as cur:
+            # El lock se libera solo si el proceso muere: otro puede reanudar la campaña
+            cur.execute("SELECT pg_try_advisory_lock(%s, %s)", (CAMPAIGN_LOCK_NAMESPACE, campaign_id))
+            if not cur.fetchone()[0]:
+                logger.warning(f"La campaña {campaign_id} ya se está enviando en otro proceso.")
+                return None
+        campaign = _begin(campaign_id)
+        if campaign is None:
+            return None
+        tenant = tenants.get_tenant(campaign["tenant_id"])
+        limit = campaign_rate_limit(tenant)
+        rate = min(campaign["rate_per_second"] or limit, limit)
+        if own_dispatcher:
+            dispatcher = outbound.OutboundDispatcher(num_workers=CAMPAIGN_WORKERS, rate_per_second=rate,
+                                                     retry_status_codes=CAMPAIGN_RETRY_STATUS_CODES)
+        batch_size = max(1, min(CAMPAIGN_SEND_BATCH, int(rate * CAMPAIGN_BATCH_SECONDS)))
+        logger.info(f"Enviando la campaña {campaign_id} ({campaign['name']}) desde el tenant {campaign['tenant_id']} a {rate:g} mensajes/s.")
+        return CampaignRun(campaign, dispatcher, batch_size, tenant).run()
+    finally:
+        if own_dispatcher and dispatcher is not None:
+            dispatcher.shutdown()
+        lock_conn.close() # Libera el advisory lock
+
+
+_runs = {} # campaign_id -> hilo que la envía en este proceso
+_waiting = set() # Campañas con un envío esperando a que termine el anterior
+_runs_lock = threading.Lock()
+
+
+def _run_after(previous, campaign_id):
+    if previous is not None:
+        previous.join() # El envío anterior termina su lote (p. ej. tras una pausa)
+    with _runs_lock:
+        _waiting.discard(campaign_id)
+    return run_campaign(campaign_id)
+
+
+def is_sending(campaign_id):
+    """True si este proceso tiene un hilo enviando (o a punto de enviar) la campaña."""
+    thread = _runs.get(campaign_id)
+    return thread is not None and thread.is_alive()
+
+
+def start_campaign(campaign_id, tenant_id=db_manager.DEFAULT_TENANT_ID):
+    """
+    Envía la campaña en un hilo en segundo plano de este proceso. Si el envío anterior
+    aún está terminando su lote (tras una pausa), el nuevo empieza cuando acabe.
+    Devuelve False si ya hay uno esperando. (Si la envía otro proceso, el advisory lock
+    lo impide.)
+    """
+    tenant = tenants.get_tenant(tenant_id)
+    if tenant is None or not tenant.is_configured:
+        raise ValueError(f"El tenant {tenant_id} no tiene phone_number_id o token configurados.")
+    with _runs_lock:
+        if campaign_id in _waiting:
+            return False
+        previous = _runs.get(campaign_id)
+        if previous is not None and previous.is_alive():
+            _waiting.add(campaign_id)
+        else:
+            previous = None
+        context = contextvars.copy_context() # Conservar el request_id en los logs del envío
+        thread = threading.Thread(
+            target=context.run, args=(_run_after, previous, campaign_id), name=f"campaign-{campaign_id}", daemon=True
+        )
+        _runs[campaign_id] = thread
+        thread.start()
+    return True
+
+
+def interrupted_campaigns():
+    """Ids de las campañas que quedaron en 'running' (el proceso que las enviaba terminó)."""
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM campaigns WHERE status = 'running' ORDER BY id")
+            campaign_ids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+        return campaign_ids
+    except Exception as e:
+        logger.error(f"Error al buscar campañas interrumpidas: {e}")
+        conn.rollback()
+        return []
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Envía o reanuda una campaña")
+    run_parser.add_argument("campaign_id", type=int)
+    subparsers.add_parser("resume", help="Reanuda las campañas interrumpidas")
+    args = parser.parse_args()
+    logging_setup.configure_logging()
+    atexit.register(db_manager.shutdown)
+    campaign_ids = [args.campaign_id] if args.command == "run" else interrupted_campaigns()
+    for campaign_id in campaign_ids:
+        print(f"Campaña {campaign_id}: {run_campaign(campaign_id) or 'no se pudo iniciar'}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
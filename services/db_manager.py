@@ -1,9 +1,20 @@
 # chatbot/services/db_manager.py
 import os
+import base64
 import psycopg2
 from psycopg2 import extras # Para usar RealDictCursor si lo deseas
 import logging
-from datetime import datetime
+import threading
+import time
+from collections import namedtuple
+from datetime import date, datetime
+
+from services import events
+from services import metrics
+from services import notifications
+from services.cache import TTLCache
+from services.db_pool import ConnectionPool
+from services.message_writer import MessageBatchWriter
 
 logger = logging.getLogger(__name__)
 
@@ -13,196 +24,874 @@ DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+
+# Configuración del pool de conexiones (compartido por todos los hilos del proceso)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5")) # Segundos de espera por una conexión libre
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30")) # Verificar conexiones inactivas más de N segundos
+DB_POOL_MAX_IDLE_TIME = float(os.getenv("DB_POOL_MAX_IDLE_TIME", "300"))
+
+# Caché en proceso de (tenant_id, whatsapp_user_id) -> ChatContext (invalidada entre workers con LISTEN/NOTIFY)
+CHAT_CACHE_ENABLED = os.getenv("CHAT_CACHE_ENABLED", "true").lower() == "true"
+CHAT_CACHE_MAX_SIZE = int(os.getenv("CHAT_CACHE_MAX_SIZE", "10000"))
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "300")) # Segundos
+CHAT_TOUCH_INTERVAL = float(os.getenv("CHAT_TOUCH_INTERVAL", "5")) # Segundos entre actualizaciones agrupadas de updated_at
+CHAT_CACHE_CHANNEL = "chat_cache_invalidate"
+CONVERSATION_STATE_CHANNEL = "conversation_state_invalidate" # Invalidación de la caché de estados conversacionales
+DEFAULT_TENANT_ID = 1 # Tenant de las instalaciones con un solo número (migración 0002)
+
+# Escritura agrupada de mensajes (group commit): un INSERT multi-fila y un COMMIT por lote
+MESSAGE_BATCH_ENABLED = os.getenv("MESSAGE_BATCH_ENABLED", "true").lower() == "true"
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "50")) # Filas por lote
+MESSAGE_BATCH_INTERVAL_MS = float(os.getenv("MESSAGE_BATCH_INTERVAL_MS", "20")) # Espera máxima antes de escribir
+MESSAGE_BATCH_MAX_PENDING = int(os.getenv("MESSAGE_BATCH_MAX_PENDING", "10000"))
+
+# Paginación de la API de administración
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "50"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "200"))
+MESSAGE_PREVIEW_LENGTH = 200 # Caracteres del último mensaje que se guardan en chats
+
+# Particiones mensuales de `messages` (por `timestamp`), creadas por adelantado
+MESSAGES_PARTITIONS_AHEAD = int(os.getenv("MESSAGES_PARTITIONS_AHEAD", "3")) # Meses futuros con partición ya creada
+
+# Exportaciones: cursores con nombre en el servidor, leídos de EXPORT_FETCH_SIZE en EXPORT_FETCH_SIZE filas
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "2000"))
+
+# Búsqueda de texto completo sobre mensajes y pedidos (configuración en español, creada por migrations/0001_baseline.py)
+SEARCH_CONFIG = "chatbot_es"
+SEARCH_SCOPES = ("messages", "orders")
+SEARCH_SNIPPET_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxWords=25, MinWords=10, MaxFragments=2, FragmentDelimiter=" … "'
+
+# Estados de pedido: transiciones permitidas (se validan en el servidor, dentro de la sentencia)
+ORDER_STATUS_TRANSITIONS = {
+    "pending": ("confirmed", "cancelled"),
+    "confirmed": ("shipped", "cancelled"),
+    "shipped": ("delivered",),
+    "delivered": (),
+    "cancelled": (),
+}
+ORDER_BULK_MAX = int(os.getenv("ORDER_BULK_MAX", "1000")) # Pedidos por cambio de estado masivo
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_overrides = {}
+
+def _timed(fn):
+    # Duración de cada función de acceso a datos en /metrics (chatbot_db_call_seconds{function=...})
+    return metrics.timed(metrics.DB_CALL_SECONDS, fn.__name__)(fn)
 
-def get_db_connection():
-    """Establece y devuelve una conexión a la base de datos."""
+def configure_pool(**connect_overrides):
+    """
+    Reconfigura el pool de conexiones (p. ej. `connection_factory` en benchmarks).
+    Cierra el pool actual; el siguiente uso crea uno nuevo con la configuración dada.
+    """
+    global _pool
+    with _pool_lock:
+        _pool_overrides.clear()
+        _pool_overrides.update(connect_overrides)
+        old_pool, _pool = _pool, None
+    if old_pool is not None:
+        old_pool.closeall()
+
+def connect_kwargs():
+    """Parámetros de conexión a la DB (variables DB_* y los de configure_pool)."""
+    kwargs = dict(
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT,
+        connect_timeout=DB_CONNECT_TIMEOUT,
+    )
+    kwargs.update(_pool_overrides)
+    return kwargs
+
+def open_dedicated_connection():
+    """Abre una conexión fuera del pool (para LISTEN u operaciones de larga duración)."""
+    return psycopg2.connect(**connect_kwargs())
+
+def _get_pool():
+    """Devuelve el pool del proceso, creándolo en el primer uso (y tras un fork)."""
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            # Tras un fork (gunicorn --preload) las conexiones del padre no se comparten.
+            _pool = ConnectionPool(
+                minconn=DB_POOL_MIN,
+                maxconn=DB_POOL_MAX,
+                timeout=DB_POOL_TIMEOUT,
+                ping_after=DB_POOL_PING_AFTER,
+                max_idle_time=DB_POOL_MAX_IDLE_TIME,
+                **connect_kwargs()
+            )
+            logger.info(f"Pool de conexiones creado (min={DB_POOL_MIN}, max={DB_POOL_MAX}, pid={_pool.pid})")
+        return _pool
+
+def get_db_connection(timeout=None):
+    """Obtiene una conexión del pool de la base de datos. Debe devolverse con release_db_connection()."""
     try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        return conn
+        return _get_pool().getconn(timeout)
     except Exception as e:
         logger.error(f"Error al conectar a la base de datos: {e}")
         return None
 
-def initialize_db():
-    """Crea las tablas necesarias si no existen."""
+def release_db_connection(conn, discard=False):
+    """Devuelve una conexión al pool. Si la transacción quedó abierta se revierte."""
+    if conn is None:
+        return
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        conn.close()
+        return
+    pool.putconn(conn, discard=discard)
+
+def get_pool_stats():
+    """Devuelve las estadísticas del pool (en uso, inactivas, tiempos de espera)."""
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        return {"min": DB_POOL_MIN, "max": DB_POOL_MAX, "in_use": 0, "idle": 0, "initialized": False}
+    stats = pool.stats()
+    stats["initialized"] = True
+    return stats
+
+def close_pool():
+    """Cierra el pool del proceso (al apagar la aplicación)."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None and pool.pid == os.getpid():
+        pool.closeall()
+
+def _add_months(month, months):
+    years, index = divmod(month.month - 1 + months, 12)
+    return date(month.year + years, index + 1, 1)
+
+def message_partition_name(month):
+    return f"messages_p{month:%Y_%m}"
+
+def message_partition_range(name):
+    """(inicio, fin) del mes de una partición `messages_pAAAA_MM`, o None si no sigue ese formato."""
+    try:
+        month = datetime.strptime(name, "messages_p%Y_%m").date()
+    except ValueError:
+        return None
+    return month, _add_months(month, 1)
+
+def _ensure_message_partitions(cur, from_month=None, months_ahead=MESSAGES_PARTITIONS_AHEAD):
+    """
+    Crea las particiones mensuales de `messages` desde `from_month` (por defecto el mes en
+    curso de la base de datos) hasta `months_ahead` meses después. Si la partición por
+    defecto tiene filas de un mes que se crea, se mueven a la partición nueva.
+    Devuelve los nombres de las particiones creadas.
+    """
+    cur.execute("SELECT date_trunc('month', CURRENT_TIMESTAMP)::date")
+    current = cur.fetchone()[0]
+    month = from_month.replace(day=1) if from_month else current
+    last = _add_months(current, months_ahead)
+    created = []
+    while month <= last:
+        name = message_partition_name(month)
+        cur.execute("SELECT to_regclass(%s)", (name,))
+        if cur.fetchone()[0] is None:
+            bounds = (month, _add_months(month, 1))
+            cur.execute("SELECT EXISTS (SELECT 1 FROM messages_default WHERE timestamp >= %s AND timestamp < %s)", bounds)
+            misplaced = cur.fetchone()[0]
+            if misplaced:
+                cur.execute("ALTER TABLE messages DETACH PARTITION messages_default")
+            cur.execute(f"CREATE TABLE {name} PARTITION OF messages FOR VALUES FROM (%s) TO (%s)", bounds)
+            if misplaced:
+                cur.execute(
+                    "WITH moved AS (DELETE FROM messages_default WHERE timestamp >= %s AND timestamp < %s RETURNING *) "
+                    "INSERT INTO messages (id, chat_id, sender_type, message_type, content, timestamp, wamid) "
+                    "SELECT id, chat_id, sender_type, message_type, content, timestamp, wamid FROM moved", bounds
+                )
+                cur.execute("ALTER TABLE messages ATTACH PARTITION messages_default DEFAULT")
+                logger.warning(f"Mensajes de la partición por defecto movidos a {name}.")
+            created.append(name)
+        month = _add_months(month, 1)
+    if created:
+        logger.info(f"Particiones de mensajes creadas: {', '.join(created)}")
+    return created
+
+def ensure_message_partitions(months_ahead=MESSAGES_PARTITIONS_AHEAD, from_month=None):
+    """Crea por adelantado las particiones de los próximos meses (lo llaman el job de retención y `migrations upgrade`)."""
     conn = get_db_connection()
     if not conn:
-        logger.error("No se pudo conectar a la DB para inicializarla.")
-        return
+        return None
+    try:
+        with conn.cursor() as cur:
+            created = _ensure_message_partitions(cur, from_month, months_ahead)
+        conn.commit()
+        return created
+    except Exception as e:
+        logger.error(f"Error al crear las particiones de mensajes: {e}")
+        conn.rollback()
+        return None
+    finally:
+        release_db_connection(conn)
+
+# Contexto del chat resuelto una sola vez por mensaje entrante y reutilizado en todo el pipeline
+ChatContext = namedtuple("ChatContext", ["chat_id", "whatsapp_user_id", "control_mode", "assigned_agent_id", "tenant_id"])
+
+_chat_cache = TTLCache(maxsize=CHAT_CACHE_MAX_SIZE, ttl=CHAT_CACHE_TTL)
+_pending_touches = set()
+_touch_lock = threading.Lock()
+_last_touch_flush = time.monotonic()
+_chat_cache_listener = None
+
+def _chat_cache_key(tenant_id, whatsapp_user_id):
+    return (tenant_id, whatsapp_user_id)
 
+def _on_chat_invalidation(payload):
+    # "tenant_id usuario"; sin tenant (workers anteriores a la migración 0002) es el por defecto
+    tenant_id, _, whatsapp_user_id = payload.rpartition(" ")
+    _chat_cache.invalidate(_chat_cache_key(int(tenant_id or DEFAULT_TENANT_ID), whatsapp_user_id))
+
+def _chat_cache_active():
+    """
+    La caché solo se usa mientras el listener de invalidaciones está conectado; si no,
+    un cambio de control hecho en otro worker no llegaría a tiempo.
+    """
+    global _chat_cache_listener
+    if not CHAT_CACHE_ENABLED:
+        return False
+    listener = notifications.get_listener(open_dedicated_connection)
+    if listener is not _chat_cache_listener:
+        with _touch_lock:
+            if listener is not _chat_cache_listener:
+                _chat_cache.clear()
+                listener.subscribe(CHAT_CACHE_CHANNEL, _on_chat_invalidation, on_reconnect=_chat_cache.clear)
+                _chat_cache_listener = listener
+    return listener.is_listening()
+
+def _touch_chat(chat_id):
+    """
+    Registra la actividad del chat sin consultar la DB en cada mensaje: los `updated_at`
+    pendientes se escriben juntos, como mucho cada CHAT_TOUCH_INTERVAL segundos.
+    """
+    global _last_touch_flush
+    with _touch_lock:
+        _pending_touches.add(chat_id)
+        if time.monotonic() - _last_touch_flush < CHAT_TOUCH_INTERVAL:
+            return
+        chat_ids = list(_pending_touches)
+        _pending_touches.clear()
+        _last_touch_flush = time.monotonic()
+    flush_chat_touches(chat_ids)
+
+@_timed
+def flush_chat_touches(chat_ids=None):
+    """Actualiza `updated_at` de varios chats en una sola sentencia."""
+    if chat_ids is None:
+        with _touch_lock:
+            chat_ids = list(_pending_touches)
+            _pending_touches.clear()
+    if not chat_ids:
+        return True
+    conn = get_db_connection()
+    if not conn:
+        return False
     try:
         with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS chats (
-                    id SERIAL PRIMARY KEY,
-                    whatsapp_user_id VARCHAR(255) UNIQUE NOT NULL,
-                    status VARCHAR(50) DEFAULT 'active', -- 'active', 'closed'
-                    control_mode VARCHAR(50) DEFAULT 'bot', -- 'bot', 'agent'
-                    assigned_agent_id INTEGER NULL, -- ID del agente asignado
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-
-                CREATE TABLE IF NOT EXISTS messages (
-                    id SERIAL PRIMARY KEY,
-                    chat_id INTEGER NOT NULL REFERENCES chats(id),
-                    sender_type VARCHAR(10) NOT NULL, -- 'user', 'bot', 'agent'
-                    message_type VARCHAR(50) NOT NULL, -- 'text', 'interactive_button', 'interactive_list', etc.
-                    content TEXT NOT NULL,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-
-                CREATE TABLE IF NOT EXISTS orders (
-                    id SERIAL PRIMARY KEY,
-                    chat_id INTEGER NOT NULL REFERENCES chats(id),
-                    whatsapp_user_id VARCHAR(255) NOT NULL,
-                    product_name VARCHAR(255) NOT NULL,
-                    customer_name VARCHAR(255),
-                    delivery_address TEXT,
-                    payment_method VARCHAR(100),
-                    status VARCHAR(50) DEFAULT 'pending', -- 'pending', 'confirmed', 'shipped', 'delivered', 'cancelled'
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-
-                -- Tabla de agentes (para futura autenticación y asignación)
-                CREATE TABLE IF NOT EXISTS agents (
-                    id SERIAL PRIMARY KEY,
-                    username VARCHAR(100) UNIQUE NOT NULL,
-                    password_hash VARCHAR(255) NOT NULL,
-                    full_name VARCHAR(255),
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
+            cur.execute("UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = ANY(%s)", (chat_ids,))
             conn.commit()
-            logger.info("Tablas de la base de datos verificadas/creadas exitosamente.")
+            return True
     except Exception as e:
-        logger.error(f"Error al inicializar la base de datos: {e}")
+        logger.error(f"Error al actualizar la actividad de {len(chat_ids)} chats: {e}")
         conn.rollback()
+        return False
     finally:
-        if conn:
-            conn.close()
+        release_db_connection(conn)
+
+def get_chat_cache_stats():
+    """Devuelve aciertos/fallos de la caché de chats y el estado del listener."""
+    stats = _chat_cache.stats()
+    stats["enabled"] = CHAT_CACHE_ENABLED
+    stats["listening"] = CHAT_CACHE_ENABLED and notifications.get_listener(open_dedicated_connection).is_listening()
+    return stats
+
+@_timed
+def resolve_chat(whatsapp_user_id, tenant_id=DEFAULT_TENANT_ID):
+    """
+    Obtiene o crea el chat de un usuario con un número (tenant) y actualiza su `updated_at`
+    en un solo round trip. Devuelve un ChatContext (id, modo de control, agente asignado y
+    tenant) o None si hay error. Los chats conocidos se sirven desde la caché en proceso
+    sin consultar la DB.
+    """
+    cache_key = _chat_cache_key(tenant_id, whatsapp_user_id)
+    use_cache = _chat_cache_active()
+    if use_cache:
+        chat = _chat_cache.get(cache_key)
+        if chat is not None:
+            _touch_chat(chat.chat_id)
+            return chat
+        epoch = _chat_cache.epoch
 
-def get_or_create_chat(whatsapp_user_id):
-    """Obtiene un chat existente o crea uno nuevo para un usuario de WhatsApp."""
     conn = get_db_connection()
     if not conn:
         return None
     try:
+        # Autocommit: una única sentencia, sin BEGIN/COMMIT adicionales.
+        conn.autocommit = True
         with conn.cursor() as cur:
-            cur.execute("SELECT id, control_mode FROM chats WHERE whatsapp_user_id = %s", (whatsapp_user_id,))
-            chat = cur.fetchone()
-            if chat:
-                # Actualizar el timestamp si el chat ya existe
-                cur.execute("UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = %s", (chat[0],))
-                conn.commit()
-                return chat[0]
-            else:
-                cur.execute(
-                    "INSERT INTO chats (whatsapp_user_id) VALUES (%s) RETURNING id",
-                    (whatsapp_user_id,)
-                )
-                new_chat_id = cur.fetchone()[0]
-                conn.commit()
-                logger.info(f"Nuevo chat creado para usuario {whatsapp_user_id} con ID {new_chat_id}")
-                return new_chat_id
+            cur.execute(
+                """
+                INSERT INTO chats (tenant_id, whatsapp_user_id) VALUES (%s, %s)
+                ON CONFLICT (tenant_id, whatsapp_user_id) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+                RETURNING id, control_mode, assigned_agent_id, (xmax = 0) AS created
+                """,
+                (tenant_id, whatsapp_user_id)
+            )
+            chat_id, control_mode, assigned_agent_id, created = cur.fetchone()
+            if created:
+                logger.info(f"Nuevo chat creado para usuario {whatsapp_user_id} (tenant {tenant_id}) con ID {chat_id}")
+            chat = ChatContext(chat_id, whatsapp_user_id, control_mode or 'bot', assigned_agent_id, tenant_id)
+            if use_cache:
+                _chat_cache.set(cache_key, chat, epoch=epoch)
+            return chat
     except Exception as e:
         logger.error(f"Error al obtener o crear chat para {whatsapp_user_id}: {e}")
-        conn.rollback()
         return None
     finally:
-        if conn:
-            conn.close()
+        release_db_connection(conn)
+
+def get_or_create_chat(whatsapp_user_id, tenant_id=DEFAULT_TENANT_ID):
+    """Obtiene un chat existente o crea uno nuevo para un usuario de WhatsApp. Devuelve solo el ID."""
+    chat = resolve_chat(whatsapp_user_id, tenant_id)
+    return chat.chat_id if chat else None
 
-def save_message(chat_id, sender_type, message_type, content):
-    """Guarda un mensaje en la base de datos."""
+@_timed
+def get_chat(chat_id):
+    """Devuelve el ChatContext de un chat por su ID (para el panel), o None si no existe o hay error."""
     conn = get_db_connection()
     if not conn:
-        return False
+        return None
     try:
         with conn.cursor() as cur:
             cur.execute(
-                "INSERT INTO messages (chat_id, sender_type, message_type, content) VALUES (%s, %s, %s, %s)",
-                (chat_id, sender_type, message_type, content)
+                "SELECT id, whatsapp_user_id, control_mode, assigned_agent_id, tenant_id FROM chats WHERE id = %s",
+                (chat_id,)
             )
+            row = cur.fetchone()
             conn.commit()
-            logger.info(f"Mensaje guardado (Chat ID: {chat_id}, Tipo: {sender_type})")
-            return True
+            if not row:
+                return None
+            return ChatContext(row[0], row[1], row[2] or 'bot', row[3], row[4])
     except Exception as e:
-        logger.error(f"Error al guardar mensaje: {e}")
+        logger.error(f"Error al obtener el chat {chat_id}: {e}")
         conn.rollback()
-        return False
+        return None
     finally:
-        if conn:
-            conn.close()
+        release_db_connection(conn)
+
+_message_writer = None
+_message_writer_lock = threading.Lock()
+
+def get_message_writer():
+    """Devuelve el escritor por lotes de mensajes del proceso (None si está desactivado)."""
+    global _message_writer
+    if not MESSAGE_BATCH_ENABLED:
+        return None
+    writer = _message_writer
+    if writer is not None and writer.pid == os.getpid():
+        return writer
+    with _message_writer_lock:
+        if _message_writer is None or _message_writer.pid != os.getpid():
+            _message_writer = MessageBatchWriter(
+                save_messages,
+                max_batch=MESSAGE_BATCH_SIZE,
+                max_delay=MESSAGE_BATCH_INTERVAL_MS / 1000.0,
+                max_pending=MESSAGE_BATCH_MAX_PENDING,
+            )
+        return _message_writer
+
+# Inserta los mensajes y actualiza en la misma sentencia el resumen de cada chat afectado
+# (último mensaje, remitente, fecha y mensajes del usuario sin leer por el agente).
+# Una respuesta del agente cuenta como lectura: solo suman los mensajes posteriores a ella.
+_INSERT_MESSAGES_SQL = "INSERT INTO messages (chat_id, sender_type, message_type, content, wamid) VALUES "
+_MESSAGES_SUMMARY_SQL = f"""
+        RETURNING id, chat_id, sender_type, message_type, content, timestamp
+    ), last_agent AS (
+        SELECT chat_id, MAX(id) FILTER (WHERE sender_type = 'agent') AS agent_id
+        FROM inserted GROUP BY chat_id
+    ), per_chat AS (
+        SELECT DISTINCT ON (i.chat_id)
+            i.chat_id, i.sender_type, i.content, i.timestamp, a.agent_id,
+            COUNT(*) FILTER (WHERE i.sender_type = 'user' AND i.id > COALESCE(a.agent_id, 0))
+                OVER (PARTITION BY i.chat_id) AS unread
+        FROM inserted i JOIN last_agent a USING (chat_id)
+        ORDER BY i.chat_id, i.id DESC
+    ), summary AS (
+        UPDATE chats c
+        SET last_message_preview = LEFT(p.content, {MESSAGE_PREVIEW_LENGTH:d}),
+            last_sender_type = p.sender_type,
+            last_message_at = p.timestamp,
+            updated_at = p.timestamp,
+            unread_count = CASE WHEN p.agent_id IS NULL THEN c.unread_count + p.unread ELSE p.unread END,
+            agent_last_read_at = CASE WHEN p.agent_id IS NULL THEN c.agent_last_read_at ELSE p.timestamp END
+        FROM per_chat p
+        WHERE c.id = p.chat_id
+        RETURNING c.id, c.unread_count
+    )
+"""
+# Un evento por mensaje para el panel; NOTIFY se entrega al confirmar la sentencia.
+_MESSAGE_EVENTS_SQL = f"""
+    SELECT COUNT(*) FROM (
+        SELECT pg_notify('{events.EVENTS_CHANNEL}', json_build_object(
+            'type', '{events.MESSAGE_CREATED}',
+            'data', json_build_object(
+                'chat_id', i.chat_id, 'message_id', i.id, 'sender_type', i.sender_type,
+                'message_type', i.message_type, 'content', LEFT(i.content, {events.EVENTS_CONTENT_LENGTH:d}),
+                'truncated', LENGTH(i.content) > {events.EVENTS_CONTENT_LENGTH:d},
+                'timestamp', i.timestamp, 'unread_count', s.unread_count
+            )
+        )::text)
+        FROM inserted i JOIN summary s ON s.id = i.chat_id
+        ORDER BY i.id
+    ) n
+""" if events.EVENTS_ENABLED else "SELECT COUNT(*) FROM summary"
+# Filas de otras tablas que se confirman junto con los mensajes de un payload (ver
+# save_messages), como pares (tipo, fila): así un mensaje y todo lo que produjo se
+# guardan o se descartan juntos, y un reintento desde el inbox no aplica nada dos veces.
+STATE_ROW = "state" # (tenant_id, whatsapp_user_id, estado JSON o None para borrarlo, TTL en segundos)
+ORDER_ROW = "order" # (chat_id, whatsapp_user_id, producto, nombre, dirección, método de pago, source_wamid)
+CONTROL_ROW = "control" # (tenant_id, whatsapp_user_id, control_mode)
+INBOX_DONE_ROW = "inbox_done" # (inbox_id, claimed_at): el mensaje del inbox queda procesado
+
+def order_row(chat_id, whatsapp_user_id, order_details, source_wamid=None):
+    """Fila de un pedido para save_messages. `source_wamid` es el mensaje que lo cerró (ver migración 0003)."""
+    return (ORDER_ROW, (
+        chat_id, whatsapp_user_id, order_details.get("product"), order_details.get("name"),
+        order_details.get("address"), order_details.get("payment_method"), source_wamid,
+    ))
+
+def with_source_wamid(extra_row, source_wamid):
+    """Asigna a una fila de pedido el wamid del mensaje entrante que la produjo (las demás no cambian)."""
+    kind, row = extra_row
+    return (kind, row[:-1] + (source_wamid,)) if kind == ORDER_ROW else extra_row
 
-def save_order(chat_id, whatsapp_user_id, order_details):
-    """Guarda los detalles de un pedido en la base de datos."""
+def control_row(tenant_id, whatsapp_user_id, control_mode):
+    """Cambio del modo de control (bot/agente) del chat de un usuario, para save_messages."""
+    return (CONTROL_ROW, (tenant_id, whatsapp_user_id, control_mode))
+
+# Estado conversacional: los demás workers invalidan su caché con NOTIFY.
+_STATE_ROWS_TEMPLATE = "(%s::integer, %s, %s::jsonb, %s::integer)"
+_SAVE_STATES_SQL = """
+    ), saved_states AS (
+        INSERT INTO conversation_states (tenant_id, whatsapp_user_id, state, updated_at, expires_at)
+        SELECT tenant_id, whatsapp_user_id, state, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + make_interval(secs => ttl)
+        FROM state_rows WHERE state IS NOT NULL
+        ON CONFLICT (tenant_id, whatsapp_user_id) DO UPDATE
+        SET state = EXCLUDED.state, updated_at = EXCLUDED.updated_at, expires_at = EXCLUDED.expires_at
+        RETURNING whatsapp_user_id
+    ), deleted_states AS (
+        DELETE FROM conversation_states
+        WHERE (tenant_id, whatsapp_user_id) IN (SELECT tenant_id, whatsapp_user_id FROM state_rows WHERE state IS NULL)
+        RETURNING whatsapp_user_id
+    )
+"""
+_STATE_NOTIFY_SQL = f"""
+    SELECT COUNT(*) FROM (
+        SELECT pg_notify('{CONVERSATION_STATE_CHANNEL}', %s || ' ' || tenant_id || ' ' || whatsapp_user_id) FROM state_rows
+    ) n
+"""
+# Pedidos: un mensaje que se reprocesa no duplica el suyo (índice único sobre source_wamid).
+_ORDER_ROWS_TEMPLATE = "(%s::integer, %s, %s, %s, %s, %s, %s::varchar)"
+_SAVE_ORDERS_SQL = """
+    ), new_orders AS (
+        INSERT INTO orders (chat_id, tenant_id, whatsapp_user_id, product_name, customer_name, delivery_address, payment_method, source_wamid)
+        SELECT r.chat_id, c.tenant_id, r.whatsapp_user_id, r.product_name, r.customer_name, r.delivery_address, r.payment_method, r.source_wamid
+        FROM order_rows r JOIN chats c ON c.id = r.chat_id
+        ON CONFLICT (source_wamid) DO NOTHING
+        RETURNING id, chat_id, product_name, status, created_at
+    )
+"""
+_ORDER_EVENTS_SQL = f"""
+    SELECT COUNT(*) FROM (
+        SELECT pg_notify('{events.EVENTS_CHANNEL}', json_build_object(
+            'type', '{events.ORDER_CREATED}',
+            'data', json_build_object(
+                'order_id', id, 'chat_id', chat_id, 'product_name', product_name,
+                'status', status, 'created_at', created_at
+            )
+        )::text)
+        FROM new_orders ORDER BY id
+    ) n
+""" if events.EVENTS_ENABLED else "SELECT COUNT(*) FROM new_orders"
+# Mensajes del inbox procesados: solo si siguen reclamados por quien los procesó.
+_INBOX_DONE_TEMPLATE = "(%s::bigint, %s::timestamp)"
+_INBOX_DONE_SQL = """
+    ), inbox_done_rows AS (
+        UPDATE webhook_inbox w SET status = 'done', processed_at = CURRENT_TIMESTAMP
+        FROM inbox_done d
+        WHERE w.id = d.id AND w.claimed_at = d.claimed_at AND w.status = 'processing'
+        RETURNING w.id
+    )
+"""
+# Cambios de control: sentencia aparte en la misma transacción, porque el resumen de los
+# mensajes actualiza las mismas filas de chats (una sentencia no puede tocar dos veces una fila).
+_CONTROL_ROWS_TEMPLATE = "(%s::integer, %s, %s)"
+_SAVE_CONTROLS_SQL = f"""
+    WITH control_rows (tenant_id, whatsapp_user_id, control_mode) AS (VALUES {{values}}),
+    controlled AS (
+        UPDATE chats c SET control_mode = r.control_mode, assigned_agent_id = NULL, updated_at = CURRENT_TIMESTAMP
+        FROM control_rows r
+        WHERE c.tenant_id = r.tenant_id AND c.whatsapp_user_id = r.whatsapp_user_id
+        RETURNING c.id, c.tenant_id, c.whatsapp_user_id, c.control_mode
+    )
+    SELECT COUNT(*) FROM (
+        SELECT pg_notify('{CHAT_CACHE_CHANNEL}', tenant_id || ' ' || whatsapp_user_id){{event}} FROM controlled
+    ) n
+"""
+_CONTROL_EVENT_SQL = f""", pg_notify('{events.EVENTS_CHANNEL}', json_build_object(
+            'type', '{events.CHAT_CONTROL_CHANGED}',
+            'data', json_build_object(
+                'chat_id', id, 'whatsapp_user_id', whatsapp_user_id, 'tenant_id', tenant_id,
+                'control_mode', control_mode, 'assigned_agent_id', NULL
+            )
+        )::text)""" if events.EVENTS_ENABLED else ""
+
+def _values(cur, template, rows):
+    return b",".join(cur.mogrify(template, row) for row in rows)
+
+def _save_messages_query(cur, rows, extra):
+    """
+    Compone una única sentencia con los mensajes, el estado conversacional, los pedidos y
+    los mensajes del inbox procesados. Se construye a mano (como `execute_values`) porque
+    lleva varias listas de VALUES. Devuelve la sentencia y el nombre de cada columna del
+    resultado (filas afectadas por tipo).
+    """
+    ctes, selects = [], []
+    if rows:
+        values = b",".join(
+            cur.mogrify("(%s, %s, %s, %s, %s)", row if len(row) == 5 else (*row, None)) for row in rows
+        )
+        ctes.append(b"inserted AS (" + _INSERT_MESSAGES_SQL.encode() + values + _MESSAGES_SUMMARY_SQL.encode())
+        selects.append(("messages", _MESSAGE_EVENTS_SQL.encode()))
+    if extra.get(STATE_ROW):
+        values = _values(cur, _STATE_ROWS_TEMPLATE, extra[STATE_ROW])
+        ctes.append(b"state_rows (tenant_id, whatsapp_user_id, state, ttl) AS (VALUES " + values + _SAVE_STATES_SQL.encode())
+        selects.append(("states", cur.mogrify(_STATE_NOTIFY_SQL, (notifications.origin(),))))
+    if extra.get(ORDER_ROW):
+        values = _values(cur, _ORDER_ROWS_TEMPLATE, extra[ORDER_ROW])
+        ctes.append(
+            b"order_rows (chat_id, whatsapp_user_id, product_name, customer_name, delivery_address, payment_method, source_wamid)"
+            b" AS (VALUES " + values + _SAVE_ORDERS_SQL.encode()
+        )
+        selects.append(("orders", _ORDER_EVENTS_SQL.encode()))
+    if extra.get(INBOX_DONE_ROW):
+        values = _values(cur, _INBOX_DONE_TEMPLATE, extra[INBOX_DONE_ROW])
+        ctes.append(b"inbox_done (id, claimed_at) AS (VALUES " + values + _INBOX_DONE_SQL.encode())
+        selects.append(("inbox_done", b"SELECT COUNT(*) FROM inbox_done_rows"))
+    query = b"WITH " + b", ".join(ctes) + b" SELECT " + b", ".join(b"(" + select + b")" for _, select in selects)
+    return query, [name for name, _ in selects]
+
+def _group_extra(extra_rows):
+    grouped = {}
+    for kind, row in extra_rows or ():
+        grouped.setdefault(kind, []).append(row)
+    # Un mismo usuario puede cambiar de estado (o de modo de control) varias veces en un lote: vale el último.
+    for kind in (STATE_ROW, CONTROL_ROW):
+        if kind in grouped:
+            grouped[kind] = list({row[:2]: row for row in grouped[kind]}.values())
+    return grouped
+
+@_timed
+def save_messages(rows, extra=None):
+    """
+    Guarda varios mensajes en una sola sentencia con un INSERT multi-fila y actualiza el
+    resumen de sus chats. `rows` es una lista de tuplas (chat_id, sender_type, message_type, content)
+    con el wamid de WhatsApp como quinto elemento opcional.
+    `extra` son pares (tipo, fila) de otras tablas que se confirman en la misma
+    transacción que los mensajes: estados conversacionales (STATE_ROW, ver state_store),
+    pedidos (ORDER_ROW), cambios de control (CONTROL_ROW) y mensajes del inbox procesados
+    (INBOX_DONE_ROW).
+    """
+    rows = list(rows)
+    extra = _group_extra(extra)
+    if not rows and not extra:
+        return True
+    controls = extra.pop(CONTROL_ROW, None)
     conn = get_db_connection()
     if not conn:
         return False
     try:
+        # Una sola sentencia (INSERT multi-fila + resumen de cada chat + estados + pedidos +
+        # inbox): en autocommit es atómica y evita el BEGIN/COMMIT. Solo los cambios de
+        # control necesitan una transacción con una sentencia más.
+        conn.autocommit = not controls
+        counts = {}
         with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO orders (chat_id, whatsapp_user_id, product_name, customer_name, delivery_address, payment_method) VALUES (%s, %s, %s, %s, %s, %s)",
-                (
-                    chat_id,
-                    whatsapp_user_id,
-                    order_details.get("product"),
-                    order_details.get("name"),
-                    order_details.get("address"),
-                    order_details.get("payment_method"),
-                )
-            )
+            if controls:
+                cur.execute(_SAVE_CONTROLS_SQL.format(
+                    values=_values(cur, _CONTROL_ROWS_TEMPLATE, controls).decode(), event=_CONTROL_EVENT_SQL
+                ))
+            if rows or extra:
+                query, names = _save_messages_query(cur, rows, extra)
+                cur.execute(query)
+                counts = dict(zip(names, cur.fetchone()))
+        if controls:
             conn.commit()
-            logger.info(f"Pedido guardado para el chat ID: {chat_id}")
+            for tenant_id, whatsapp_user_id, control_mode in controls:
+                _chat_cache.invalidate(_chat_cache_key(tenant_id, whatsapp_user_id))
+                logger.info(f"Modo de control de chat para {whatsapp_user_id} cambiado a '{control_mode}' por el flujo del bot")
+        if extra.get(ORDER_ROW):
+            saved = counts["orders"]
+            metrics.ORDERS_CREATED.inc(amount=saved)
+            # Los que faltan ya estaban guardados: su mensaje se procesó otra vez
+            logger.info(f"{saved} pedidos guardados ({len(extra[ORDER_ROW]) - saved} repetidos descartados)")
+        logger.debug(f"{len(rows)} mensajes y {len(extra.get(STATE_ROW, ()))} estados guardados en un lote")
+        return True
+    except Exception as e:
+        logger.error(f"Error al guardar un lote de {len(rows)} mensajes: {e}")
+        if controls:
+            conn.rollback()
+        return False
+    finally:
+        release_db_connection(conn)
+
+@_timed
+def save_message(chat_id, sender_type, message_type, content, durable=False, wamid=None):
+    """
+    Guarda un mensaje en la base de datos. Con el escritor por lotes activo, el mensaje se
+    agrupa con otros en el mismo COMMIT; `durable=True` espera a que se haya confirmado.
+    `wamid` es el ID del mensaje en WhatsApp (el devuelto por la API al enviarlo).
+    """
+    row = (chat_id, sender_type, message_type, content, wamid)
+    writer = get_message_writer()
+    if writer is not None:
+        if not writer.submit([row], durable=durable):
+            return False
+        logger.info(f"Mensaje guardado (Chat ID: {chat_id}, Tipo: {sender_type})")
+        return True
+    if save_messages([row]):
+        logger.info(f"Mensaje guardado (Chat ID: {chat_id}, Tipo: {sender_type})")
+        return True
+    return False
+
+@_timed
+def persist_messages(rows, durable=True, extra=None):
+    """
+    Guarda juntos (misma transacción) todos los mensajes de un payload del webhook y lo que
+    produjeron: estados conversacionales, pedidos, cambios de control y el inbox (ver save_messages).
+    Pasa por el escritor por lotes si está activo, así se combina con otras peticiones.
+    """
+    writer = get_message_writer()
+    if writer is not None:
+        return writer.submit(rows, durable=durable, extra=extra)
+    return save_messages(rows, extra)
+
+def get_message_writer_stats():
+    writer = _message_writer
+    if writer is None or writer.pid != os.getpid():
+        return {"enabled": MESSAGE_BATCH_ENABLED, "rows": 0, "batches": 0, "pending_rows": 0}
+    stats = writer.stats()
+    stats["enabled"] = True
+    return stats
+
+def shutdown():
+    """Escribe los mensajes pendientes y cierra el pool (al terminar el proceso)."""
+    writer = _message_writer
+    if writer is not None and writer.pid == os.getpid():
+        writer.close()
+    close_pool()
+
+# Un estado por wamid (ya agrupados en memoria); solo se sobrescribe con uno igual o posterior
+_SAVE_STATUSES_SQL = """
+    INSERT INTO message_statuses
+        (wamid, recipient_id, status, status_rank, status_timestamp, error_code, error_title, updated_at)
+    VALUES %s
+    ON CONFLICT (wamid) DO UPDATE
+    SET status = EXCLUDED.status, status_rank = EXCLUDED.status_rank,
+        status_timestamp = EXCLUDED.status_timestamp, recipient_id = EXCLUDED.recipient_id,
+        error_code = EXCLUDED.error_code, error_title = EXCLUDED.error_title, updated_at = EXCLUDED.updated_at
+    WHERE message_statuses.status_rank <= EXCLUDED.status_rank
+"""
+_STATUS_ROWS_TEMPLATE = "(%s, %s, %s, %s, to_timestamp(%s)::timestamp, %s, %s, CURRENT_TIMESTAMP)"
+
+@_timed
+def save_message_statuses(rows):
+    """
+    Guarda en una sola sentencia los estados de entrega de mensajes enviados. `rows` son
+    tuplas (wamid, recipient_id, status, status_rank, epoch, error_code, error_title) con
+    un solo estado por wamid.
+    """
+    rows = list(rows)
+    if not rows:
+        return True
+    conn = get_db_connection()
+    if not conn:
+        return False
+    try:
+        conn.autocommit = True # Una sola sentencia: sin BEGIN/COMMIT adicionales
+        with conn.cursor() as cur:
+            extras.execute_values(cur, _SAVE_STATUSES_SQL, rows, template=_STATUS_ROWS_TEMPLATE, page_size=len(rows))
+            logger.debug(f"{len(rows)} estados de entrega guardados en un lote")
             return True
     except Exception as e:
-        logger.error(f"Error al guardar pedido: {e}")
-        conn.rollback()
+        logger.error(f"Error al guardar un lote de {len(rows)} estados de entrega: {e}")
         return False
     finally:
-        if conn:
-            conn.close()
+        release_db_connection(conn)
+
+def save_order(chat_id, whatsapp_user_id, order_details, source_wamid=None):
+    """Guarda un pedido fuera del pipeline de mensajes (misma sentencia que save_messages)."""
+    return save_messages([], [order_row(chat_id, whatsapp_user_id, order_details, source_wamid)])
+
+# Resultado por pedido de un cambio de estado: 'updated', 'unchanged' (ya tenía ese estado),
+# 'invalid_transition' o 'not_found'. Los datos del pedido permiten notificar al cliente.
+OrderStatusResult = namedtuple(
+    "OrderStatusResult", ["order_id", "result", "previous_status", "chat_id", "whatsapp_user_id", "product_name", "tenant_id"]
+)
+ORDER_UPDATED = "updated"
+ORDER_UNCHANGED = "unchanged"
+ORDER_INVALID_TRANSITION = "invalid_transition"
+ORDER_NOT_FOUND = "not_found"
+
+_UPDATE_ORDERS_STATUS_SQL = """
+    WITH requested AS ({requested}),
+    locked AS (
+        SELECT o.id, o.status, o.chat_id, o.whatsapp_user_id, o.product_name, o.tenant_id
+        FROM orders o JOIN requested r ON r.id = o.id
+        ORDER BY o.id
+        FOR UPDATE OF o
+    ),
+    updated AS (
+        UPDATE orders o SET status = %(status)s, updated_at = CURRENT_TIMESTAMP
+        FROM locked l
+        WHERE o.id = l.id AND l.status = ANY(%(allowed_from)s)
+        RETURNING o.id, o.updated_at
+    )
+    SELECT r.id, l.status, u.id IS NOT NULL, l.chat_id, l.whatsapp_user_id, l.product_name, l.tenant_id, u.updated_at
+    FROM requested r
+    LEFT JOIN locked l ON l.id = r.id
+    LEFT JOIN updated u ON u.id = r.id
+    ORDER BY r.id
+"""
+_REQUESTED_BY_IDS = "SELECT DISTINCT unnest(%(order_ids)s::int[]) AS id"
+
+@_timed
+def update_orders_status(new_status, order_ids=None, status=None, created_before=None, tenant_id=None):
+    """
+    Cambia el estado de muchos pedidos en una sola sentencia y transacción: los indicados
+    en `order_ids` o los que cumplan el filtro (`status` actual y/o `created_before`, de un
+    `tenant_id` si se indica, hasta
+    ORDER_BULK_MAX por llamada, los más antiguos primero; se vuelve a llamar para el resto).
+    Solo se aplican las transiciones de ORDER_STATUS_TRANSITIONS; con un filtro solo se
+    toman los pedidos que pueden pasar a `new_status`, así cada llamada avanza. Devuelve
+    una lista de OrderStatusResult (una por pedido) o None si hubo un error. Lanza
+    ValueError si la petición no es válida.
+    """
+    if new_status not in ORDER_STATUS_TRANSITIONS:
+        raise ValueError(f"Estado de pedido desconocido: {new_status!r}")
+    params = {
+        "status": new_status,
+        "allowed_from": [current for current, targets in ORDER_STATUS_TRANSITIONS.items() if new_status in targets],
+    }
+    if order_ids is not None:
+        try:
+            params["order_ids"] = sorted({int(order_id) for order_id in order_ids})
+        except (TypeError, ValueError):
+            raise ValueError("Los ids de pedido deben ser números enteros.")
+        if not params["order_ids"]:
+            return []
+        if len(params["order_ids"]) > ORDER_BULK_MAX:
+            raise ValueError(f"Como máximo {ORDER_BULK_MAX} pedidos por petición.")
+        requested = _REQUESTED_BY_IDS
+    else:
+        if status is None and created_before is None:
+            raise ValueError("Se requieren ids de pedido o un filtro (status, created_before).")
+        if status is not None and status not in params["allowed_from"]:
+            raise ValueError(f"Un pedido en estado {status!r} no puede pasar a {new_status!r}.")
+        requested = "SELECT id FROM orders WHERE status = ANY(%(allowed_from)s)"
+        if status is not None:
+            requested += " AND status = %(filter_status)s"
+            params["filter_status"] = status
+        if created_before is not None:
+            requested += " AND created_at < %(created_before)s"
+            params["created_before"] = created_before
+        if tenant_id is not None:
+            requested += " AND tenant_id = %(tenant_id)s"
+            params["tenant_id"] = tenant_id
+        requested += " ORDER BY created_at, id LIMIT %(limit)s"
+        params["limit"] = ORDER_BULK_MAX
 
-def get_chat_control_mode(chat_id):
-    """Obtiene el modo de control actual (bot/agente) para un chat."""
     conn = get_db_connection()
     if not conn:
-        return 'bot' # Default a bot si hay error de DB
+        return None
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT control_mode FROM chats WHERE id = %s", (chat_id,))
-            result = cur.fetchone()
-            if result:
-                return result[0]
-            return 'bot' # Default a bot si no se encuentra
+            cur.execute(_UPDATE_ORDERS_STATUS_SQL.format(requested=requested), params)
+            results = []
+            changed = []
+            for order_id, previous, updated, chat_id, whatsapp_user_id, product_name, order_tenant_id, updated_at in cur.fetchall():
+                if previous is None:
+                    result = ORDER_NOT_FOUND
+                elif updated:
+                    result = ORDER_UPDATED
+                    changed.append({"order_id": order_id, "chat_id": chat_id, "status": new_status, "updated_at": updated_at})
+                elif previous == new_status:
+                    result = ORDER_UNCHANGED
+                else:
+                    result = ORDER_INVALID_TRANSITION
+                results.append(OrderStatusResult(order_id, result, previous, chat_id, whatsapp_user_id, product_name, order_tenant_id))
+            events.publish_many(cur, events.ORDER_STATUS_CHANGED, changed)
+            conn.commit()
+            logger.info(f"Cambio de estado a '{new_status}': {len(changed)} de {len(results)} pedidos actualizados")
+            return results
     except Exception as e:
-        logger.error(f"Error al obtener el modo de control para el chat {chat_id}: {e}")
-        return 'bot'
+        logger.error(f"Error al cambiar el estado de los pedidos a '{new_status}': {e}")
+        conn.rollback()
+        return None
     finally:
-        if conn:
-            conn.close()
+        release_db_connection(conn)
 
-def set_chat_control(whatsapp_user_id, control_mode, agent_id=None):
-    """Establece el modo de control (bot/agente) para un chat."""
+def update_order_status(order_id, new_status):
+    """
+    Cambia el estado de un pedido. Devuelve el OrderStatusResult, False si no existe y None
+    si hubo un error. Lanza ValueError si el estado o la transición no son válidos.
+    """
+    results = update_orders_status(new_status, order_ids=[order_id])
+    if results is None:
+        return None
+    result = results[0]
+    if result.result == ORDER_NOT_FOUND:
+        return False
+    if result.result == ORDER_INVALID_TRANSITION:
+        raise ValueError(f"No se puede pasar el pedido {order_id} de '{result.previous_status}' a '{new_status}'.")
+    return result
+
+@_timed
+def set_chat_control(whatsapp_user_id, control_mode, agent_id=None, tenant_id=DEFAULT_TENANT_ID):
+    """Establece el modo de control (bot/agente) para el chat de un usuario con un número (tenant)."""
     conn = get_db_connection()
     if not conn:
         return False
     try:
         with conn.cursor() as cur:
             cur.execute(
-                "UPDATE chats SET control_mode = %s, assigned_agent_id = %s, updated_at = CURRENT_TIMESTAMP WHERE whatsapp_user_id = %s",
-                (control_mode, agent_id, whatsapp_user_id)
+                "UPDATE chats SET control_mode = %s, assigned_agent_id = %s, updated_at = CURRENT_TIMESTAMP "
+                "WHERE tenant_id = %s AND whatsapp_user_id = %s RETURNING id",
+                (control_mode, agent_id, tenant_id, whatsapp_user_id)
             )
+            updated = cur.fetchone()
+            # Invalida la caché de chats en todos los workers al confirmar la transacción.
+            notifications.notify(cur, CHAT_CACHE_CHANNEL, f"{tenant_id} {whatsapp_user_id}")
+            if updated:
+                events.publish(cur, events.CHAT_CONTROL_CHANGED, {
+                    "chat_id": updated[0],
+                    "whatsapp_user_id": whatsapp_user_id,
+                    "tenant_id": tenant_id,
+                    "control_mode": control_mode,
+                    "assigned_agent_id": agent_id,
+                })
             conn.commit()
+            _chat_cache.invalidate(_chat_cache_key(tenant_id, whatsapp_user_id))
             logger.info(f"Modo de control de chat para {whatsapp_user_id} cambiado a '{control_mode}' por agente {agent_id if agent_id else 'N/A'}")
             return True
     except Exception as e:
@@ -210,76 +899,427 @@ def set_chat_control(whatsapp_user_id, control_mode, agent_id=None):
         conn.rollback()
         return False
     finally:
-        if conn:
-            conn.close()
+        release_db_connection(conn)
+
+# Paginación por cursor (keyset): el cursor codifica (timestamp, id) de la última fila vista
+Page = namedtuple("Page", ["items", "next_cursor", "prev_cursor"])
+
+def clamp_page_size(limit):
+    """Normaliza el tamaño de página pedido por el cliente."""
+    if limit is None:
+        return PAGE_SIZE_DEFAULT
+    try:
+        return max(1, min(int(limit), PAGE_SIZE_MAX))
+    except (TypeError, ValueError):
+        raise ValueError(f"Tamaño de página inválido: {limit!r}")
+
+def encode_cursor(timestamp, row_id):
+    raw = f"{timestamp.isoformat()}|{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
 
-def get_chats(status=None, control_mode=None):
-    """Obtiene una lista de chats con filtros opcionales."""
+def decode_cursor(cursor):
+    """Decodifica un cursor de paginación. Lanza ValueError si no es válido."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, row_id = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise ValueError(f"Cursor de paginación inválido: {cursor!r}")
+
+@_timed
+def get_chats(status=None, control_mode=None, limit=None, before=None, tenant_id=None):
+    """
+    Obtiene una página de chats (más recientes primero) con filtros opcionales (`tenant_id`
+    limita la página a los chats de un número). Cada chat
+    incluye el resumen de su último mensaje y los no leídos, sin consultar `messages`.
+    `before` es el `next_cursor` de la página anterior.
+    """
+    limit = clamp_page_size(limit)
     conn = get_db_connection()
     if not conn:
-        return []
+        return Page([], None, None)
     try:
         with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
-            query = "SELECT id, whatsapp_user_id, status, control_mode, assigned_agent_id, created_at, updated_at FROM chats WHERE 1=1"
+            query = (
+                "SELECT id, tenant_id, whatsapp_user_id, status, control_mode, assigned_agent_id, created_at, updated_at, "
+                "last_message_preview, last_sender_type, last_message_at, unread_count, agent_last_read_at "
+                "FROM chats WHERE 1=1"
+            )
             params = []
+            if tenant_id is not None:
+                query += " AND tenant_id = %s"
+                params.append(tenant_id)
             if status:
                 query += " AND status = %s"
                 params.append(status)
             if control_mode:
                 query += " AND control_mode = %s"
                 params.append(control_mode)
-            query += " ORDER BY updated_at DESC"
+            if before:
+                query += " AND (updated_at, id) < (%s, %s)"
+                params.extend(decode_cursor(before))
+            query += " ORDER BY updated_at DESC, id DESC LIMIT %s"
+            params.append(limit + 1)
             
             cur.execute(query, tuple(params))
             chats = cur.fetchall()
-            return chats
+            next_cursor = None
+            if len(chats) > limit:
+                chats = chats[:limit]
+                next_cursor = encode_cursor(chats[-1]["updated_at"], chats[-1]["id"])
+            return Page(chats, next_cursor, None)
+    except ValueError:
+        raise
     except Exception as e:
         logger.error(f"Error al obtener chats: {e}")
-        return []
+        return Page([], None, None)
     finally:
-        if conn:
-            conn.close()
+        release_db_connection(conn)
 
-def get_messages_for_chat(chat_id):
-    """Obtiene todos los mensajes para un chat específico."""
+@_timed
+def mark_chat_read(chat_id):
+    """Marca como leídos por el agente los mensajes de un chat. Devuelve False si no existe."""
     conn = get_db_connection()
     if not conn:
-        return []
+        return None
     try:
-        with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+        conn.autocommit = True # Una sola sentencia: sin BEGIN/COMMIT adicionales
+        with conn.cursor() as cur:
             cur.execute(
-                "SELECT id, chat_id, sender_type, message_type, content, timestamp FROM messages WHERE chat_id = %s ORDER BY timestamp ASC",
+                "UPDATE chats SET unread_count = 0, agent_last_read_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING id",
                 (chat_id,)
             )
+            return cur.fetchone() is not None
+    except Exception as e:
+        logger.error(f"Error al marcar como leído el chat {chat_id}: {e}")
+        return None
+    finally:
+        release_db_connection(conn)
+
+@_timed
+def get_messages_for_chat(chat_id, limit=None, before=None, after=None, since_id=None):
+    """
+    Obtiene una página de mensajes de un chat, siempre en orden cronológico.
+
+    - Sin cursores: los `limit` mensajes más recientes.
+    - `before`: mensajes anteriores al cursor (historial hacia atrás).
+    - `after`: mensajes posteriores al cursor.
+    - `since_id`: mensajes con id mayor (consulta incremental del panel).
+
+    `next_cursor` apunta a mensajes más antiguos y `prev_cursor` a más recientes.
+    """
+    limit = clamp_page_size(limit)
+    if since_id is not None:
+        try:
+            since_id = int(since_id)
+        except (TypeError, ValueError):
+            raise ValueError(f"since_id inválido: {since_id!r}")
+    conn = get_db_connection()
+    if not conn:
+        return Page([], None, None)
+    # El estado de entrega (solo mensajes enviados) se une por wamid
+    columns = (
+        "id, chat_id, sender_type, message_type, content, timestamp, wamid, "
+        "(SELECT s.status FROM message_statuses s WHERE s.wamid = messages.wamid) AS delivery_status"
+    )
+    try:
+        with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+            if since_id is not None:
+                cur.execute(
+                    f"SELECT {columns} FROM messages WHERE chat_id = %s AND id > %s ORDER BY id ASC LIMIT %s",
+                    (chat_id, since_id, limit + 1)
+                )
+                newer_first = False
+            elif after:
+                # `timestamp >= ...` repite el cursor para que se descarten las particiones anteriores
+                after_ts, after_id = decode_cursor(after)
+                cur.execute(
+                    f"SELECT {columns} FROM messages WHERE chat_id = %s AND timestamp >= %s AND (timestamp, id) > (%s, %s) "
+                    "ORDER BY timestamp ASC, id ASC LIMIT %s",
+                    (chat_id, after_ts, after_ts, after_id, limit + 1)
+                )
+                newer_first = False
+            else:
+                # Con el índice (chat_id, timestamp, id) de cada partición el LIMIT se resuelve con un
+                # Merge Append que lee solo las primeras filas de cada una; `before` descarta las posteriores.
+                query = f"SELECT {columns} FROM messages WHERE chat_id = %s"
+                params = [chat_id]
+                if before:
+                    before_ts, before_id = decode_cursor(before)
+                    query += " AND timestamp <= %s AND (timestamp, id) < (%s, %s)"
+                    params.extend((before_ts, before_ts, before_id))
+                query += " ORDER BY timestamp DESC, id DESC LIMIT %s"
+                params.append(limit + 1)
+                cur.execute(query, tuple(params))
+                newer_first = True
+
             messages = cur.fetchall()
-            return messages
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+            if newer_first:
+                messages.reverse()
+            if not messages:
+                return Page([], None, None)
+            oldest, newest = messages[0], messages[-1]
+            older_cursor = encode_cursor(oldest["timestamp"], oldest["id"])
+            newer_cursor = encode_cursor(newest["timestamp"], newest["id"])
+            if newer_first:
+                # Hacia atrás solo hay más si la consulta lo indicó; hacia delante siempre puede haber nuevos.
+                return Page(messages, older_cursor if has_more else None, newer_cursor)
+            return Page(messages, older_cursor, newer_cursor)
+    except ValueError:
+        raise
     except Exception as e:
         logger.error(f"Error al obtener mensajes para el chat {chat_id}: {e}")
-        return []
+        return Page([], None, None)
     finally:
-        if conn:
-            conn.close()
+        release_db_connection(conn)
 
-def get_orders(status=None):
-    """Obtiene una lista de pedidos con filtros opcionales."""
+@_timed
+def get_orders(status=None, limit=None, before=None, tenant_id=None):
+    """
+    Obtiene una página de pedidos (más recientes primero) con filtros opcionales.
+    `before` es el `next_cursor` de la página anterior.
+    """
+    limit = clamp_page_size(limit)
     conn = get_db_connection()
     if not conn:
-        return []
+        return Page([], None, None)
     try:
         with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
-            query = "SELECT id, chat_id, whatsapp_user_id, product_name, customer_name, delivery_address, payment_method, status, created_at, updated_at FROM orders WHERE 1=1"
+            query = "SELECT id, tenant_id, chat_id, whatsapp_user_id, product_name, customer_name, delivery_address, payment_method, status, created_at, updated_at FROM orders WHERE 1=1"
             params = []
+            if tenant_id is not None:
+                query += " AND tenant_id = %s"
+                params.append(tenant_id)
             if status:
                 query += " AND status = %s"
                 params.append(status)
-            query += " ORDER BY created_at DESC"
+            if before:
+                query += " AND (created_at, id) < (%s, %s)"
+                params.extend(decode_cursor(before))
+            query += " ORDER BY created_at DESC, id DESC LIMIT %s"
+            params.append(limit + 1)
             
             cur.execute(query, tuple(params))
             orders = cur.fetchall()
-            return orders
+            next_cursor = None
+            if len(orders) > limit:
+                orders = orders[:limit]
+                next_cursor = encode_cursor(orders[-1]["created_at"], orders[-1]["id"])
+            return Page(orders, next_cursor, None)
+    except ValueError:
+        raise
     except Exception as e:
         logger.error(f"Error al obtener pedidos: {e}")
-        return []
+        return Page([], None, None)
+    finally:
+        release_db_connection(conn)
+
+# --- Búsqueda de texto completo ---
+
+# Cada ámbito: tipo de resultado, tabla, columna de fecha, texto del fragmento y detalles propios
+_SEARCH_SOURCES = {
+    "messages": (
+        "message", "messages", "timestamp", "content",
+        "jsonb_build_object('sender_type', sender_type, 'message_type', message_type)",
+    ),
+    "orders": (
+        "order", "orders", "created_at", "concat_ws(' · ', customer_name, delivery_address)",
+        "jsonb_build_object('customer_name', customer_name, 'delivery_address', delivery_address, "
+        "'product_name', product_name, 'status', status)",
+    ),
+}
+
+def _encode_search_cursor(rank, kind, row_id):
+    raw = f"{rank!r}|{kind}|{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_search_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        rank, kind, row_id = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8").split("|")
+        return float(rank), kind, int(row_id)
+    except Exception:
+        raise ValueError(f"Cursor de búsqueda inválido: {cursor!r}")
+
+def _search_branch(scope, cursor, chat_id, sender_type, created_from, created_to, limit, tenant_id=None):
+    """Consulta de un ámbito: coincidencias del índice GIN ordenadas por relevancia tras el cursor."""
+    kind, table, date_column, body, details = _SEARCH_SOURCES[scope]
+    conditions = ["search_vector @@ q.query"]
+    params = []
+    if chat_id is not None:
+        conditions.append("chat_id = %s")
+        params.append(chat_id)
+    if tenant_id is not None:
+        # `messages` no guarda el tenant: se filtra por los chats del número
+        conditions.append("tenant_id = %s" if scope == "orders" else "chat_id IN (SELECT id FROM chats WHERE tenant_id = %s)")
+        params.append(tenant_id)
+    if sender_type and scope == "messages":
+        conditions.append("sender_type = %s")
+        params.append(sender_type)
+    # Las fechas descartan particiones de `messages` fuera del rango
+    if created_from:
+        conditions.append(f"{date_column} >= %s")
+        params.append(created_from)
+    if created_to:
+        conditions.append(f"{date_column} < %s")
+        params.append(created_to)
+    keyset = ""
+    if cursor:
+        # Orden global: rank DESC, tipo ASC, id DESC
+        rank, cursor_kind, row_id = cursor
+        if kind == cursor_kind:
+            keyset = "WHERE rank < %s OR (rank = %s AND id < %s)"
+            params.extend((rank, rank, row_id))
+        else:
+            keyset = f"WHERE rank {'<=' if kind > cursor_kind else '<'} %s"
+            params.append(rank)
+    query = f"""
+        (SELECT * FROM (
+            SELECT '{kind}' AS kind, id, chat_id, {date_column} AS created_at,
+                   ts_rank(search_vector, q.query)::float8 AS rank, {body} AS body, {details} AS details
+            FROM {table}, q WHERE {' AND '.join(conditions)}
+        ) hits {keyset}
+        ORDER BY rank DESC, id DESC LIMIT %s)
+    """
+    params.append(limit)
+    return query, params
+
+@_timed
+def search(text, scopes=SEARCH_SCOPES, chat_id=None, sender_type=None, created_from=None, created_to=None,
+           limit=None, before=None, tenant_id=None):
+    """
+    Búsqueda de texto completo en el contenido de los mensajes y en el nombre y la dirección
+    de los pedidos (sintaxis de buscador: "frase exacta", OR, -excluir). Resultados por
+    relevancia con `snippet` resaltado (<mark>, el resto del texto escapado para HTML).
+    `before` es el `next_cursor` de la página anterior. Lanza ValueError si los filtros no
+    son válidos.
+    """
+    limit = clamp_page_size(limit)
+    if not text or not text.strip():
+        raise ValueError("La búsqueda no puede estar vacía.")
+    unknown = set(scopes) - set(SEARCH_SCOPES)
+    if unknown or not scopes:
+        raise ValueError(f"Ámbito de búsqueda inválido: {', '.join(sorted(unknown)) or '(vacío)'} (opciones: {', '.join(SEARCH_SCOPES)})")
+    cursor = _decode_search_cursor(before) if before else None
+    conn = get_db_connection()
+    if not conn:
+        return Page([], None, None)
+    branches, params = [], [text, SEARCH_SNIPPET_OPTIONS]
+    for scope in SEARCH_SCOPES:
+        if scope in scopes:
+            branch, branch_params = _search_branch(scope, cursor, chat_id, sender_type, created_from, created_to, limit + 1, tenant_id)
+            branches.append(branch)
+            params.extend(branch_params)
+    params.append(limit + 1)
+    # Los fragmentos (ts_headline, costoso) solo se calculan para las filas de la página
+    query = f"""
+        WITH q AS (SELECT websearch_to_tsquery('{SEARCH_CONFIG}', %s) AS query)
+        SELECT h.kind AS type, h.id, h.chat_id, c.whatsapp_user_id, h.created_at, h.rank,
+               ts_headline('{SEARCH_CONFIG}',
+                           replace(replace(replace(h.body, '&', '&amp;'), '<', '&lt;'), '>', '&gt;'),
+                           q.query, %s) AS snippet,
+               h.details
+        FROM ({' UNION ALL '.join(branches)}) h
+        CROSS JOIN q
+        JOIN chats c ON c.id = h.chat_id
+        ORDER BY h.rank DESC, h.kind, h.id DESC
+        LIMIT %s
+    """
+    try:
+        with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+            cur.execute(query, tuple(params))
+            results = cur.fetchall()
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Error en la búsqueda de texto completo: {e}")
+        conn.rollback()
+        return Page([], None, None)
     finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        release_db_connection(conn)
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        last = results[-1]
+        next_cursor = _encode_search_cursor(last["rank"], last["type"], last["id"])
+    return Page(results, next_cursor, None)
+
+# --- Exportaciones en streaming ---
+
+ORDER_EXPORT_COLUMNS = (
+    "id", "chat_id", "whatsapp_user_id", "product_name", "customer_name", "delivery_address",
+    "payment_method", "status", "created_at", "updated_at",
+)
+TRANSCRIPT_COLUMNS = ("id", "timestamp", "sender_type", "message_type", "content", "wamid", "delivery_status")
+
+def _stream_rows(conn, cursor_name, query, params, fetch_size):
+    """
+    Generador de filas leídas con un cursor con nombre (del lado del servidor): en memoria
+    solo hay `fetch_size` filas a la vez, sea cual sea el tamaño del resultado. Cierra la
+    conexión al terminar o si el cliente corta la descarga.
+    """
+    try:
+        with conn.cursor(name=cursor_name) as cur:
+            cur.itersize = fetch_size
+            cur.execute(query, params)
+            for row in cur:
+                yield row
+        conn.commit()
+    except GeneratorExit:
+        raise
+    except Exception as e:
+        logger.error(f"Error durante la exportación '{cursor_name}': {e}")
+        raise
+    finally:
+        conn.close()
+
+def _open_export_connection():
+    # Conexión fuera del pool: una descarga larga no debe ocupar una conexión de las peticiones.
+    try:
+        conn = open_dedicated_connection()
+        conn.set_session(readonly=True)
+        return conn
+    except Exception as e:
+        logger.error(f"No se pudo abrir una conexión para exportar: {e}")
+        return None
+
+def stream_orders(status=None, created_from=None, created_to=None, fetch_size=EXPORT_FETCH_SIZE, tenant_id=None):
+    """
+    Devuelve un generador con todos los pedidos que cumplen los filtros (tuplas en el orden
+    de ORDER_EXPORT_COLUMNS, los más antiguos primero), o None si no hay conexión.
+    """
+    query = f"SELECT {', '.join(ORDER_EXPORT_COLUMNS)} FROM orders WHERE TRUE"
+    params = []
+    if tenant_id is not None:
+        query += " AND tenant_id = %s"
+        params.append(tenant_id)
+    if status:
+        query += " AND status = %s"
+        params.append(status)
+    if created_from is not None:
+        query += " AND created_at >= %s"
+        params.append(created_from)
+    if created_to is not None:
+        query += " AND created_at < %s"
+        params.append(created_to)
+    query += " ORDER BY created_at, id"
+    conn = _open_export_connection()
+    if conn is None:
+        return None
+    return _stream_rows(conn, "export_orders", query, tuple(params), fetch_size)
+
+def stream_chat_transcript(chat_id, fetch_size=EXPORT_FETCH_SIZE):
+    """
+    Devuelve un generador con todos los mensajes de un chat en orden (tuplas en el orden de
+    TRANSCRIPT_COLUMNS), o None si no hay conexión.
+    """
+    query = (
+        "SELECT m.id, m.timestamp, m.sender_type, m.message_type, m.content, m.wamid, s.status "
+        "FROM messages m LEFT JOIN message_statuses s ON s.wamid = m.wamid "
+        "WHERE m.chat_id = %s ORDER BY m.timestamp, m.id"
+    )
+    conn = _open_export_connection()
+    if conn is None:
+        return None
+    return _stream_rows(conn, "export_transcript", query, (chat_id,), fetch_size)
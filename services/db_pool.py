@@ -0,0 +1,223 @@
+# chatbot/services/db_pool.py
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(Exception):
+    """Se lanza cuando no hay conexiones libres dentro del tiempo de espera."""
+
+
+class ConnectionPool:
+    """
+    Pool de conexiones de PostgreSQL seguro entre hilos.
+
+    - Mantiene entre `minconn` y `maxconn` conexiones abiertas.
+    - `getconn` espera hasta `timeout` segundos si el pool está agotado.
+    - Las conexiones que llevan más de `ping_after` segundos sin usarse se
+      verifican con un `SELECT 1` antes de entregarse.
+    - Las conexiones inactivas por encima de `minconn` se cierran tras
+      `max_idle_time` segundos.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, timeout=5.0, ping_after=30.0, max_idle_time=300.0, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Tamaños de pool inválidos: se requiere 0 <= minconn <= maxconn y maxconn >= 1.")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.max_idle_time = max_idle_time
+        self.pid = os.getpid()
+        self._connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, instante en que se devolvió)
+        self._in_use = {}     # id(conn) -> conn
+        self._opening = 0     # conexiones que se están abriendo fuera del lock
+        self._waiting = 0
+        self._closed = False
+        self._counters = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "opened": 0,
+            "discarded": 0,
+            "ping_failures": 0,
+        }
+        for _ in range(minconn):
+            try:
+                self._idle.append((self._connect(), time.monotonic()))
+            except Exception as e:
+                logger.error(f"No se pudo abrir la conexión inicial del pool: {e}")
+                break
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._connect_kwargs)
+        with self._cond:
+            self._counters["opened"] += 1
+        return conn
+
+    def _total(self):
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def getconn(self, timeout=None):
+        """Obtiene una conexión viva del pool, esperando si es necesario."""
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited = False
+
+        while True:
+            conn = None
+            idle_since = None
+            with self._cond:
+                if self._closed:
+                    raise psycopg2.InterfaceError("El pool de conexiones está cerrado.")
+                while not self._idle and self._total() >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeoutError(
+                            f"No hay conexiones disponibles tras {timeout:.2f}s (máximo {self.maxconn})."
+                        )
+                    waited = True
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                    if self._closed:
+                        raise psycopg2.InterfaceError("El pool de conexiones está cerrado.")
+
+                if self._idle:
+                    # LIFO: reutilizamos la conexión más reciente para que las demás
+                    # puedan envejecer y cerrarse si sobran.
+                    conn, idle_since = self._idle.pop()
+                    self._in_use[id(conn)] = conn
+                else:
+                    self._opening += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._opening -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._opening -= 1
+                    self._in_use[id(conn)] = conn
+            elif not self._is_alive(conn, idle_since):
+                self.putconn(conn, discard=True)
+                continue
+
+            wait_time = time.monotonic() - started
+            with self._cond:
+                self._counters["checkouts"] += 1
+                if waited:
+                    self._counters["waits"] += 1
+                    self._counters["wait_time_total"] += wait_time
+                    if wait_time > self._counters["wait_time_max"]:
+                        self._counters["wait_time_max"] = wait_time
+            return conn
+
+    def _is_alive(self, conn, idle_since):
+        """Verifica la conexión; solo hace un round trip si estuvo inactiva mucho tiempo."""
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - idle_since < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"Conexión del pool descartada por fallo de verificación: {e}")
+            with self._cond:
+                self._counters["ping_failures"] += 1
+            return False
+
+    def putconn(self, conn, discard=False):
+        """Devuelve una conexión al pool (o la cierra si está rota o sobra)."""
+        if conn is None:
+            return
+        if not discard and not conn.closed:
+            try:
+                status = conn.get_transaction_status()
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    # Nunca devolvemos al pool una transacción abierta.
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except Exception:
+                discard = True
+        if conn.closed:
+            discard = True
+
+        now = time.monotonic()
+        to_close = []
+        with self._cond:
+            self._in_use.pop(id(conn), None)
+            if discard or self._closed:
+                to_close.append(conn)
+                self._counters["discarded"] += 1
+            else:
+                self._idle.append((conn, now))
+            # Cerrar conexiones inactivas que sobran por encima de minconn.
+            while len(self._idle) > self.minconn and now - self._idle[0][1] > self.max_idle_time:
+                to_close.append(self._idle.popleft()[0])
+            self._cond.notify()
+
+        for stale in to_close:
+            try:
+                stale.close()
+            except Exception:
+                pass
+
+    def closeall(self):
+        """Cierra todas las conexiones inactivas y marca el pool como cerrado."""
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        """Devuelve estadísticas del pool: conexiones en uso, inactivas y tiempos de espera."""
+        with self._cond:
+            counters = dict(self._counters)
+            stats = {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "opening": self._opening,
+                "waiting": self._waiting,
+            }
+        stats.update(counters)
+        stats["wait_time_total_ms"] = round(stats.pop("wait_time_total") * 1000, 3)
+        stats["wait_time_max_ms"] = round(stats.pop("wait_time_max") * 1000, 3)
+        stats["wait_time_avg_ms"] = (
+            round(stats["wait_time_total_ms"] / stats["waits"], 3) if stats["waits"] else 0.0
+        )
+        return stats
@@ -0,0 +1,188 @@
+# chatbot/services/delivery_status.py
+import os
+import time
+import atexit
+import logging
+import threading
+
+from services import db_manager
+
+logger = logging.getLogger(__name__)
+
+# Configuración de la ingesta de estados de entrega (callbacks `statuses` de Meta)
+STATUS_FLUSH_INTERVAL_MS = float(os.getenv("STATUS_FLUSH_INTERVAL_MS", "500")) # Espera máxima antes de escribir
+STATUS_BATCH_SIZE = int(os.getenv("STATUS_BATCH_SIZE", "500")) # wamids distintos por sentencia
+STATUS_MAX_PENDING = int(os.getenv("STATUS_MAX_PENDING", "50000")) # wamids en memoria antes de descartar
+
+# Orden de los estados: uno posterior reemplaza a uno anterior, nunca al revés
+# (Meta no garantiza el orden de entrega de los callbacks).
+STATUS_RANKS = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+
+
+def parse_status(status):
+    """
+    Convierte un elemento de `statuses` del webhook en una fila de `message_statuses`
+    (ver db_manager.save_message_statuses). Devuelve None si no es válido.
+    """
+    wamid = status.get("id")
+    rank = STATUS_RANKS.get(status.get("status"))
+    if not wamid or rank is None:
+        return None
+    try:
+        timestamp = int(status.get("timestamp"))
+    except (TypeError, ValueError):
+        timestamp = int(time.time())
+    error_code = error_title = None
+    errors = status.get("errors")
+    if errors:
+        error_code = errors[0].get("code")
+        error_title = errors[0].get("title")
+    return (wamid, status.get("recipient_id"), status["status"], rank, timestamp, error_code, error_title)
+
+
+def _newer(row, current):
+    # (rango, timestamp): read gana a delivered aunque llegue antes
+    return current is None or (row[3], row[4]) >= (current[3], current[4])
+
+
+class StatusBuffer:
+    """
+    Agrupa los estados de entrega en memoria y los escribe en lote desde un hilo aparte.
+
+    Varios callbacks del mismo mensaje (sent, delivered, read) se combinan en el buffer y
+    solo se escribe el último, así una ráfaga de estados se convierte en una sentencia por
+    intervalo. Si la escritura falla los estados vuelven al buffer para el siguiente intento.
+    """
+
+    def __init__(self, flush_fn=db_manager.save_message_statuses, max_batch=STATUS_BATCH_SIZE,
+                 max_delay=STATUS_FLUSH_INTERVAL_MS / 1000.0, max_pending=STATUS_MAX_PENDING):
+        self._flush_fn = flush_fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._pending = {}  # wamid -> fila
+        self._oldest = None
+        self._closed = False
+        self.pid = os.getpid()
+        self._counters = {"received": 0, "coalesced": 0, "written": 0, "batches": 0, "invalid": 0, "dropped": 0}
+        self._thread = threading.Thread(target=self._run, name="status-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, statuses):
+        """Encola los estados de un payload del webhook; no hace I/O."""
+        rows = []
+        invalid = 0
+        for status in statuses:
+            row = parse_status(status)
+            if row is None:
+                invalid += 1
+            else:
+                rows.append(row)
+        with self._cond:
+            self._counters["received"] += len(rows)
+            self._counters["invalid"] += invalid
+            self._merge(rows)
+            if self._pending and self._oldest is None:
+                # Primer estado del lote: el hilo empieza a contar el intervalo
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            elif len(self._pending) >= self.max_batch:
+                self._cond.notify()
+        return len(rows)
+
+    def _merge(self, rows):
+        # Llamar con el lock tomado
+        for row in rows:
+            current = self._pending.get(row[0])
+            if current is not None:
+                self._counters["coalesced"] += 1
+            elif len(self._pending) >= self.max_pending:
+                self._counters["dropped"] += 1
+                continue
+            if _newer(row, current):
+                self._pending[row[0]] = row
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                if self._pending:
+                    age = time.monotonic() - self._oldest
+                    if len(self._pending) >= self.max_batch or age >= self.max_delay or self._closed:
+                        break
+                    self._cond.wait(self.max_delay - age)
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+            batch = []
+            for wamid in list(self._pending)[:self.max_batch]:
+                batch.append(self._pending.pop(wamid))
+            self._oldest = time.monotonic() if self._pending else None
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            try:
+                ok = bool(self._flush_fn(batch))
+            except Exception as e:
+                logger.error(f"Error al escribir un lote de {len(batch)} estados de entrega: {e}", exc_info=True)
+                ok = False
+            with self._cond:
+                if ok:
+                    self._counters["batches"] += 1
+                    self._counters["written"] += len(batch)
+                    continue
+                if self._closed:
+                    self._counters["dropped"] += len(batch)
+                    return
+                # Reintentar en el siguiente intervalo sin pisar estados más nuevos llegados mientras tanto
+                self._merge(batch)
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+                self._cond.wait(self.max_delay)
+
+    def close(self, timeout=5.0):
+        """Escribe los estados pendientes antes de detener el hilo."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats["pending"] = len(self._pending)
+        return stats
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """Devuelve el buffer de estados del proceso (uno por worker), creándolo en el primer uso."""
+    global _buffer
+    buffer = _buffer
+    if buffer is not None and buffer.pid == os.getpid():
+        return buffer
+    with _buffer_lock:
+        if _buffer is None or _buffer.pid != os.getpid():
+            _buffer = StatusBuffer()
+            atexit.register(_buffer.close)
+        return _buffer
+
+
+def ingest(statuses):
+    """Registra los estados de entrega de un payload del webhook (se escriben en segundo plano)."""
+    return get_buffer().add(statuses)
+
+
+def get_stats():
+    buffer = _buffer
+    if buffer is None or buffer.pid != os.getpid():
+        return {"received": 0, "pending": 0}
+    return buffer.stats()
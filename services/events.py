@@ -0,0 +1,195 @@
+# chatbot/services/events.py
+import os
+import json
+import queue
+import logging
+import itertools
+import threading
+
+from services import notifications
+
+logger = logging.getLogger(__name__)
+
+# Configuración de los eventos en vivo para el panel de administración
+EVENTS_ENABLED = os.getenv("EVENTS_ENABLED", "true").lower() == "true"
+EVENTS_CHANNEL = "chatbot_events" # Canal de NOTIFY compartido por todos los workers
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "500")) # Eventos pendientes por cliente conectado
+EVENTS_HEARTBEAT_INTERVAL = float(os.getenv("EVENTS_HEARTBEAT_INTERVAL", "15")) # Segundos entre keep-alives del stream
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "100")) # Clientes conectados por worker; 0 = sin límite
+EVENTS_CONTENT_LENGTH = 1000 # Caracteres del mensaje incluidos en el evento (el payload de NOTIFY es limitado)
+
+# Eventos que se publican desde las rutas de escritura de db_manager
+MESSAGE_CREATED = "message_created"
+CHAT_CONTROL_CHANGED = "chat_control_changed"
+ORDER_CREATED = "order_created"
+ORDER_STATUS_CHANGED = "order_status_changed"
+RESYNC = "resync" # Se pudieron perder eventos: el cliente debe volver a consultar la API
+
+
+class Subscription:
+    """Cola de eventos de un cliente conectado, opcionalmente filtrada por chat."""
+
+    def __init__(self, broker, chat_id=None, maxsize=EVENTS_QUEUE_SIZE):
+        self._broker = broker
+        self.chat_id = chat_id
+        self._queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def wants(self, event):
+        return self.chat_id is None or event.get("data", {}).get("chat_id") == self.chat_id
+
+    def offer(self, event):
+        if self.overflowed:
+            return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # Cliente lento: en lugar de bloquear el listener, se le pide que resincronice.
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Devuelve el siguiente evento, o None si no llegó ninguno en `timeout` segundos."""
+        if self.overflowed:
+            self.overflowed = False
+            with self._queue.mutex:
+                self._queue.queue.clear()
+            return {"type": RESYNC, "data": {"reason": "overflow"}}
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._broker.unsubscribe(self)
+
+
+class EventBroker:
+    """
+    Pub/sub en proceso alimentado por el listener de PostgreSQL.
+
+    Los eventos se emiten con NOTIFY dentro de la transacción que hace el cambio, así
+    llegan a todos los workers (incluido el que escribe) solo si se confirmó. Cada
+    worker reparte lo recibido entre las colas de sus clientes conectados; un cliente
+    inactivo no genera consultas.
+    """
+
+    def __init__(self, listener, max_subscribers=EVENTS_MAX_SUBSCRIBERS):
+        self._listener = listener
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._counters = {"received": 0, "delivered": 0, "invalid": 0, "rejected": 0}
+        listener.subscribe(EVENTS_CHANNEL, self._on_notify, on_reconnect=self._on_reconnect)
+
+    def subscribe(self, chat_id=None):
+        """Registra un cliente; devuelve None si el worker ya tiene max_subscribers conectados."""
+        subscription = Subscription(self, chat_id)
+        with self._lock:
+            if self.max_subscribers and len(self._subscribers) >= self.max_subscribers:
+                self._counters["rejected"] += 1
+                return None
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def is_listening(self):
+        return self._listener.is_listening()
+
+    def _on_notify(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            with self._lock:
+                self._counters["invalid"] += 1
+            logger.warning(f"Evento con payload inválido descartado: {payload[:200]}")
+            return
+        self.publish_local(event)
+
+    def _on_reconnect(self):
+        self.publish_local({"type": RESYNC, "data": {"reason": "reconnect"}})
+
+    def publish_local(self, event):
+        """Entrega un evento a los clientes de este worker."""
+        event["id"] = next(self._ids)
+        with self._lock:
+            subscribers = [s for s in self._subscribers if s.wants(event)]
+            self._counters["received"] += 1
+            self._counters["delivered"] += len(subscribers)
+        for subscription in subscribers:
+            subscription.offer(event)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["subscribers"] = len(self._subscribers)
+        stats["max_subscribers"] = self.max_subscribers
+        stats["listening"] = self.is_listening()
+        return stats
+
+
+_broker = None
+_broker_pid = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """Devuelve el broker de eventos del proceso (uno por worker), creándolo en el primer uso."""
+    global _broker, _broker_pid
+    if _broker is None or _broker_pid != os.getpid():
+        with _broker_lock:
+            if _broker is None or _broker_pid != os.getpid():
+                from services import db_manager # Import diferido: db_manager publica eventos
+                _broker = EventBroker(notifications.get_listener(db_manager.open_dedicated_connection))
+                _broker_pid = os.getpid()
+    return _broker
+
+
+def publish(cur, event_type, data):
+    """
+    Publica un evento dentro de la transacción del cursor; se entrega al hacer commit.
+    `data` debe ser pequeño (NOTIFY admite hasta 8000 bytes por payload).
+    """
+    if not EVENTS_ENABLED:
+        return
+    notifications.notify(cur, EVENTS_CHANNEL, json.dumps({"type": event_type, "data": data}, default=str))
+
+
+def publish_many(cur, event_type, items):
+    """Publica un evento por elemento de `items` con una sola sentencia (p. ej. cambios masivos)."""
+    if not EVENTS_ENABLED or not items:
+        return
+    notifications.notify_many(cur, EVENTS_CHANNEL, [
+        json.dumps({"type": event_type, "data": data}, default=str) for data in items
+    ])
+
+
+def format_sse(event):
+    """Serializa un evento en el formato de Server-Sent Events."""
+    return f"id: {event.get('id', '')}\nevent: {event['type']}\ndata: {json.dumps(event.get('data', {}), default=str)}\n\n"
+
+
+def stream(subscription, heartbeat=EVENTS_HEARTBEAT_INTERVAL):
+    """
+    Generador de Server-Sent Events para la suscripción de un cliente (ver
+    EventBroker.subscribe); la cierra al terminar. Envía un comentario cada `heartbeat`
+    segundos para mantener viva la conexión a través de proxies.
+
+    Cada cliente ocupa un hilo del servidor mientras está conectado: con workers 'sync'
+    de gunicorn un solo panel abierto bloquea el worker entero. Hay que servir la app
+    con workers gevent (`-k gevent`) o gthread (`-k gthread --threads N`, con N mayor
+    que EVENTS_MAX_SUBSCRIBERS para que queden hilos para el resto de peticiones).
+    """
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            event = subscription.get(heartbeat)
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield format_sse(event)
+    finally:
+        subscription.close()
@@ -0,0 +1,57 @@
+# chatbot/services/exports.py
+import io
+import os
+import csv
+import json
+
+# Filas acumuladas por fragmento de la respuesta (menos escrituras pequeñas al socket)
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "500"))
+
+# Formatos de exportación: Content-Type y extensión del archivo descargado
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson; charset=utf-8", "ndjson"),
+}
+
+
+def _value(value):
+    # Fechas en ISO 8601, igual en CSV y en NDJSON
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+def iter_csv(columns, rows, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Genera el CSV (con cabecera) en fragmentos de `chunk_rows` filas."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow([_value(value) for value in row])
+        count += 1
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_ndjson(columns, rows, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Genera un objeto JSON por línea, en fragmentos de `chunk_rows` filas."""
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(
+            {column: _value(value) for column, value in zip(columns, row)}, ensure_ascii=False, default=str
+        ))
+        if len(chunk) >= chunk_rows:
+            yield "\n".join(chunk) + "\n"
+            chunk = []
+    if chunk:
+        yield "\n".join(chunk) + "\n"
+
+
+def iter_export(fmt, columns, rows):
+    """Fragmentos de texto de la exportación en el formato pedido ('csv' o 'ndjson')."""
+    if fmt == "csv":
+        return iter_csv(columns, rows)
+    return iter_ndjson(columns, rows)
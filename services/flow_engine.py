@@ -0,0 +1,341 @@
+# chatbot/services/flow_engine.py
+import os
+import json
+import time
+import string
+import logging
+import threading
+
+from services import db_manager
+from services import state_store
+from services.logging_setup import LazyJson
+
+logger = logging.getLogger(__name__)
+
+# Configuración del motor de flujos conversacionales
+FLOWS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flows")
+BOT_FLOW_FILE = os.getenv("BOT_FLOW_FILE", os.path.join(FLOWS_DIR, "bot_flow.json")) # Flujo por defecto (tenants sin flow_file)
+BOT_FLOW_RELOAD_INTERVAL = float(os.getenv("BOT_FLOW_RELOAD_INTERVAL", "2")) # Segundos entre comprobaciones del archivo (0 = sin recarga)
+
+
+class FrozenDict(dict):
+    """
+    Dict inmutable. Hereda de dict para que `json.dumps` lo serialice sin conversiones
+    al construir el payload de WhatsApp.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Las respuestas compiladas del flujo son inmutables.")
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    update = pop = popitem = clear = setdefault = _immutable
+
+    def __hash__(self):
+        return id(self)
+
+
+def freeze(value):
+    """Convierte recursivamente dicts y listas en FrozenDict y tuplas."""
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class Template:
+    """Plantilla precompilada: trozos literales y campos ya separados, sin parsear en cada uso."""
+
+    __slots__ = ("parts",)
+
+    def __init__(self, text):
+        self.parts = tuple(
+            (literal, field) for literal, field, _, _ in string.Formatter().parse(text)
+        )
+
+    @property
+    def is_static(self):
+        return all(field is None for _, field in self.parts)
+
+    def render(self, values, user_input):
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field == "input":
+                out.append(user_input)
+            elif field is not None:
+                value = values.get(field)
+                out.append("" if value is None else str(value))
+        return "".join(out)
+
+
+class CompiledResponse:
+    """Respuesta del bot: si no tiene campos dinámicos se construye una sola vez."""
+
+    __slots__ = ("static", "text", "message_type", "buttons", "list_options")
+
+    def __init__(self, name, definition):
+        if "text" not in definition:
+            raise ValueError(f"La respuesta '{name}' no tiene 'text'.")
+        self.message_type = definition.get("message_type", "text")
+        self.buttons = freeze(definition.get("buttons"))
+        self.list_options = freeze(definition.get("list_options"))
+        self.text = Template(definition["text"])
+        self.static = self._build(definition["text"]) if self.text.is_static else None
+
+    def _build(self, text):
+        # Un literal es más rápido que los argumentos con nombre (se construye en cada respuesta dinámica)
+        return FrozenDict({
+            "message_type": self.message_type, "text": text,
+            "buttons": self.buttons, "list_options": self.list_options,
+        })
+
+    def render(self, values=None, user_input=""):
+        if self.static is not None:
+            return self.static
+        return self._build(self.text.render(values or {}, user_input))
+
+
+class Setter:
+    """Asigna un campo de los datos del flujo a partir del mensaje del usuario."""
+
+    __slots__ = ("choices", "default")
+
+    def __init__(self, definition):
+        if isinstance(definition, dict):
+            self.choices = FrozenDict(definition.get("choices", {}))
+            self.default = Template(definition.get("default", "{input}"))
+        else:
+            self.choices = FrozenDict()
+            self.default = Template(definition)
+
+    def value(self, processed_message, user_message, values):
+        choice = self.choices.get(processed_message)
+        return choice if choice is not None else self.default.render(values, user_message)
+
+
+class Step:
+    __slots__ = ("setters", "action", "response", "next")
+
+    def __init__(self, setters, action, response, next_step):
+        self.setters = setters
+        self.action = action
+        self.response = response
+        self.next = next_step
+
+
+class Intent:
+    __slots__ = ("response", "action", "start")
+
+    def __init__(self, response, action, start):
+        self.response = response
+        self.action = action
+        self.start = start
+
+
+class CompiledFlow:
+    """Tablas de despacho O(1): disparador -> intención y (flujo, paso) -> paso."""
+
+    def __init__(self, intents, steps, fallback, version):
+        self.intents = intents
+        self.flows = frozenset(flow for flow, _ in steps)
+        self.steps = steps
+        self.fallback = fallback
+        self.version = version
+
+
+def _tenant_id(chat):
+    return chat.tenant_id if chat else db_manager.DEFAULT_TENANT_ID
+
+
+def _save_order(user_id, chat, order_details):
+    # El pedido se guarda con el chat ya resuelto, en la misma transacción que el mensaje que lo cierra
+    chat_id = chat.chat_id if chat else db_manager.get_or_create_chat(user_id)
+    if not chat_id:
+        logger.error(f"No se pudo obtener/crear chat_id para {user_id} al guardar el pedido.")
+        return None
+    # Un solo registro; nombre, dirección y teléfono se redactan al escribirlo
+    logger.info("Nuevo pedido (usuario %s): %s", user_id, LazyJson(order_details))
+    return db_manager.order_row(chat_id, user_id, order_details)
+
+
+def _handoff_to_agent(user_id, chat, order_details):
+    return db_manager.control_row(_tenant_id(chat), user_id, 'agent') # Cambia el control a agente
+
+
+# Acciones que un flujo puede ejecutar (por nombre en el archivo de flujo). Cada una
+# devuelve la fila que escribe (ver db_manager.save_messages) en lugar de escribirla.
+ACTIONS = {
+    "save_order": _save_order,
+    "handoff_to_agent": _handoff_to_agent,
+}
+
+
+def _run_action(action, user_id, chat, values, pending_actions):
+    row = action(user_id, chat, values)
+    if row is None:
+        return
+    if pending_actions is not None:
+        pending_actions.append(row)
+    else:
+        db_manager.save_messages([], [row])
+
+
+def compile_flow(definition):
+    """Valida y compila la definición de un flujo. Lanza ValueError si es inválida."""
+    responses = {
+        name: CompiledResponse(name, response) for name, response in definition.get("responses", {}).items()
+    }
+
+    def response(name, where):
+        if name not in responses:
+            raise ValueError(f"{where}: la respuesta '{name}' no existe.")
+        return responses[name]
+
+    def action(name, where):
+        if name is not None and name not in ACTIONS:
+            raise ValueError(f"{where}: la acción '{name}' no existe.")
+        return ACTIONS.get(name)
+
+    steps = {}
+    for flow_name, flow_steps in definition.get("flows", {}).items():
+        for step_name, step in flow_steps.items():
+            where = f"Paso '{flow_name}.{step_name}'"
+            next_step = step.get("next")
+            if next_step is not None and next_step not in flow_steps:
+                raise ValueError(f"{where}: el paso siguiente '{next_step}' no existe.")
+            steps[(flow_name, step_name)] = Step(
+                tuple((field, Setter(setter)) for field, setter in step.get("set", {}).items()),
+                action(step.get("action"), where),
+                response(step["response"], where),
+                next_step,
+            )
+
+    intents = {}
+    for index, intent in enumerate(definition.get("intents", [])):
+        where = f"Intención {index}"
+        start = intent.get("start")
+        if start is not None:
+            start = (start["flow"], start["step"])
+            if start not in steps:
+                raise ValueError(f"{where}: el paso inicial '{start[0]}.{start[1]}' no existe.")
+        compiled = Intent(response(intent["response"], where), action(intent.get("action"), where), start)
+        for trigger in intent["triggers"]:
+            intents[trigger.lower().strip()] = compiled
+
+    return CompiledFlow(intents, steps, response(definition["fallback"], "fallback"), definition.get("version"))
+
+
+class FlowEngine:
+    """
+    Motor de respuestas del bot a partir de un archivo de flujo (JSON). El archivo se
+    compila al cargarse y se vuelve a compilar si cambia (como mucho una comprobación
+    cada `reload_interval` segundos); si la nueva versión es inválida se mantiene la anterior.
+    """
+
+    def __init__(self, path=BOT_FLOW_FILE, reload_interval=BOT_FLOW_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._next_check = 0.0
+        self.reloads = 0
+        self._flow = self._load()
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, encoding="utf-8") as f:
+            flow = compile_flow(json.load(f))
+        self._mtime = mtime
+        logger.info(f"Flujo del bot cargado desde {self.path} (versión {flow.version}).")
+        return flow
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if self.reload_interval <= 0 or now < self._next_check:
+            return
+        if not self._lock.acquire(blocking=False):
+            return # Otro hilo ya lo está comprobando
+        try:
+            self._next_check = now + self.reload_interval
+            try:
+                mtime = os.stat(self.path).st_mtime
+                if mtime == self._mtime:
+                    return
+                self._mtime = mtime # Una versión inválida se reporta una sola vez
+                self._flow = self._load()
+                self.reloads += 1
+            except Exception as e:
+                logger.error(f"No se pudo recargar el flujo del bot ({self.path}); se mantiene la versión anterior: {e}")
+        finally:
+            self._lock.release()
+
+    def respond(self, user_message, user_id="default_user", chat=None, pending_states=None, pending_actions=None):
+        """
+        Respuesta del bot a un mensaje. Con `pending_states`/`pending_actions`, los cambios
+        de estado y las filas de las acciones (pedidos, cambios de control) se acumulan ahí y
+        se confirman junto con los mensajes; sin ellos se guardan al momento.
+        """
+        self._maybe_reload()
+        flow = self._flow
+        processed_message = user_message.lower().strip()
+        state_key = (_tenant_id(chat), user_id) # Un flujo en curso por usuario y número
+        current_state = state_store.load(state_key, pending_states)
+
+        # Paso de un flujo en curso (p. ej. recogida de datos del pedido)
+        if current_state is not None and current_state.action in flow.flows:
+            step = flow.steps.get((current_state.action, current_state.step))
+            if step is None:
+                return flow.fallback.render()
+            values = current_state.order_details
+            for field, setter in step.setters:
+                values[field] = setter.value(processed_message, user_message, values)
+            if step.action is not None:
+                _run_action(step.action, user_id, chat, values, pending_actions)
+            if step.next is None:
+                current_state = None # Finaliza el flujo
+            else:
+                current_state.step = step.next
+            # Dentro del webhook el estado se confirma junto con los mensajes
+            state_store.save(state_key, current_state, pending_states)
+            return step.response.render(values, user_message)
+
+        # Menú principal y opciones
+        intent = flow.intents.get(processed_message)
+        if intent is None:
+            return flow.fallback.render()
+        if intent.action is not None:
+            _run_action(intent.action, user_id, chat, {}, pending_actions)
+        if intent.start is not None:
+            state_store.save(state_key, state_store.ConversationState(*intent.start), pending_states)
+        return intent.response.render()
+
+
+def flow_path(flow_file=None):
+    """
+    Ruta del archivo de flujo de un tenant (`flow_file` relativo a flows/; None es
+    BOT_FLOW_FILE). Lanza ValueError si apunta fuera de flows/.
+    """
+    if not flow_file:
+        return BOT_FLOW_FILE
+    path = os.path.normpath(os.path.join(FLOWS_DIR, flow_file))
+    if not path.startswith(FLOWS_DIR + os.sep):
+        raise ValueError(f"El archivo de flujo debe estar dentro de flows/: {flow_file!r}")
+    return path
+
+
+_engines = {} # ruta -> FlowEngine (los tenants con el mismo flujo comparten motor)
+_engine_lock = threading.Lock()
+
+
+def get_engine(flow_file=None):
+    """Devuelve el motor del archivo de flujo indicado (ver flow_path), cargándolo en el primer uso."""
+    engine = _engines.get(flow_file)
+    if engine is None:
+        with _engine_lock:
+            engine = _engines.get(flow_file)
+            if engine is None:
+                path = flow_path(flow_file)
+                engine = next((e for e in _engines.values() if e.path == path), None) or FlowEngine(path)
+                _engines[flow_file] = engine
+    return engine
@@ -0,0 +1,634 @@
+# chatbot/services/inbound.py
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from collections import ChainMap
+
+from services import admission
+from services import bot_logic
+from services import db_manager
+from services import inbox
+from services import logging_setup
+from services import metrics
+from services import outbound
+from services import state_store
+from services import tenants
+from services import triage
+from services import whatsapp
+from services.workers import ShardedExecutor, LatencyRecorder
+
+logger = logging.getLogger(__name__)
+
+# Configuración del procesamiento de mensajes entrantes en segundo plano
+INBOUND_ASYNC = os.getenv("INBOUND_ASYNC", "true").lower() == "true" # false = procesar dentro de la petición del webhook
+INBOUND_WORKERS = int(os.getenv("INBOUND_WORKERS", str(max(4, 2 * (os.cpu_count() or 1)))))
+INBOUND_QUEUE_SIZE = int(os.getenv("INBOUND_QUEUE_SIZE", "500")) # Por worker
+INBOUND_ENQUEUE_TIMEOUT = float(os.getenv("INBOUND_ENQUEUE_TIMEOUT", "0.5")) # Segundos antes de dejarlo al barrido del inbox
+INBOUND_SHUTDOWN_TIMEOUT = float(os.getenv("INBOUND_SHUTDOWN_TIMEOUT", "20"))
+INBOUND_DRAIN_INTERVAL = float(os.getenv("INBOUND_DRAIN_INTERVAL", "1")) # Segundos entre reintentos de los mensajes aplazados (0 = solo el barrido del inbox)
+
+
+def extract_user_message(message_data):
+    """
+    Extrae el contenido de un mensaje de WhatsApp y el tipo con el que se guarda en la DB.
+    Devuelve (None, None) para los tipos que el bot no maneja.
+    """
+    message_type_from_whatsapp = message_data.get("type")
+    user_message_content = ""
+    msg_db_type = "text" # Tipo para guardar en la DB
+
+    if message_type_from_whatsapp == "text":
+        user_message_content = message_data["text"]["body"]
+        msg_db_type = "text"
+    elif message_type_from_whatsapp == "interactive":
+        interactive_response = message_data.get("interactive", {})
+        interactive_type = interactive_response.get("type")
+
+        if interactive_type == "button_reply":
+            user_message_content = interactive_response["button_reply"]["id"]
+            msg_db_type = "interactive_button"
+            logger.debug("Respuesta de botón recibida: ID='%s'", user_message_content)
+        elif interactive_type == "list_reply":
+            user_message_content = interactive_response["list_reply"]["id"]
+            msg_db_type = "interactive_list"
+            logger.debug("Respuesta de lista recibida: ID='%s'", user_message_content)
+        else:
+            logger.info(f"Tipo de respuesta interactiva '{interactive_type}' no manejada explícitamente y será ignorada.")
+            return None, None # Ignorar otros tipos interactivos por ahora
+    else:
+        logger.info(f"Mensaje de tipo '{message_type_from_whatsapp}' ignorado.")
+        return None, None # Ignorar otros tipos de mensajes de WhatsApp (audio, imagen, etc.)
+
+    if not user_message_content:
+        logger.warning("No se pudo extraer contenido del mensaje del usuario.")
+        return None, None
+    return user_message_content, msg_db_type
+
+
+def route(message_data):
+    """Tenant del número que recibió el mensaje, o None si no debe procesarse (ver tenants)."""
+    return tenants.for_phone_number(message_data.get(triage.ROUTING_KEY))
+
+
+def _shard_key(message_data):
+    # El orden importa por conversación: mismo usuario con el mismo número
+    return (message_data.get(triage.ROUTING_KEY), message_data.get("from"))
+
+
+def send_reply(chat_id, recipient_phone_number, bot_response_data, tenant=None):
+    """
+    Encola el envío de la respuesta del bot desde el número del `tenant` que recibió el
+    mensaje. El mensaje del bot se guarda cuando se conoce
+    el resultado del envío, con el wamid que devuelve WhatsApp (para unirlo a sus estados
+    de entrega); si no se pudo encolar se guarda igualmente, sin wamid.
+    """
+    response_text_body = bot_response_data.get("text")
+    response_type = bot_response_data.get("message_type", "text")
+    response_buttons = bot_response_data.get("buttons")
+    response_list_options = bot_response_data.get("list_options")
+
+    if response_type == "list" and response_list_options:
+        msg_db_type = 'interactive_list'
+    elif response_type == "buttons" and response_buttons:
+        msg_db_type = 'interactive_button'
+    else:
+        msg_db_type = 'text'
+
+    def on_result(result):
+        db_manager.save_message(chat_id, 'bot', msg_db_type, response_text_body, wamid=whatsapp.extract_wamid(result))
+
+    # El envío a WhatsApp lo realizan los workers de salida,
+    # así el webhook responde 200 sin esperar a la API de Meta.
+    if msg_db_type == 'interactive_list':
+        queued = outbound.enqueue_interactive_list_message(
+            recipient_phone_number=recipient_phone_number,
+            body_text=response_text_body,
+            list_button_title=response_list_options.get("button_title", "Opciones"),
+            sections=response_list_options.get("sections", []),
+            header_text=response_list_options.get("header_text"),
+            footer_text=response_list_options.get("footer_text"),
+            on_result=on_result,
+            tenant=tenant
+        )
+    elif msg_db_type == 'interactive_button':
+        queued = outbound.enqueue_interactive_buttons_message(
+            recipient_phone_number=recipient_phone_number,
+            body_text=response_text_body,
+            buttons=response_buttons,
+            on_result=on_result,
+            tenant=tenant
+        )
+    else:
+        queued = outbound.enqueue_text_message(recipient_phone_number, response_text_body, on_result=on_result, tenant=tenant)
+    if not queued:
+        on_result(None)
+
+
+def process_message(message_data, pending_rows, pending_states=None, pending_replies=None, pending_actions=None):
+    """
+    Ejecuta el pipeline completo para un mensaje entrante: resolver el chat, generar la
+    respuesta del bot y preparar su envío. El mensaje del usuario se añade a `pending_rows`,
+    los cambios de estado conversacional a `pending_states` y las filas de las acciones del
+    flujo (pedidos, paso a agente) a `pending_actions`, para escribirlos juntos en una sola
+    transacción; las respuestas se añaden a `pending_replies` para enviarlas
+    después de confirmarla (sin `pending_replies` se envían de inmediato).
+    Devuelve False si el mensaje no pudo procesarse y debe reintentarse.
+    """
+    from_phone_number = message_data["from"]
+    user_message_content, msg_db_type = extract_user_message(message_data)
+    if user_message_content is None:
+        return True
+    tenant = route(message_data)
+    if tenant is None:
+        # El número se desactivó después de recibir el mensaje
+        logger.warning(f"Mensaje {message_data.get('id')} descartado: el número {message_data.get(triage.ROUTING_KEY)} no está activo.")
+        metrics.UNROUTED_MESSAGES.inc("inactive")
+        return True
+
+    # Registro de alto volumen: muestreado y formateado en el hilo de logging
+    logger.info("Procesando entrada: '%s' de %s", user_message_content, from_phone_number, extra={"event": "inbound_message"})
+
+    # 1. Resolver el chat del usuario con este número (id, modo de control, agente) en un solo round trip
+    chat = db_manager.resolve_chat(from_phone_number, tenant.id)
+    if not chat:
+        logger.error(f"No se pudo obtener/crear chat_id para {from_phone_number}. No se procesará el mensaje.")
+        return False
+    chat_id = chat.chat_id
+    if pending_actions:
+        # Un paso a agente de un mensaje anterior del mismo payload aún no está confirmado
+        for kind, row in pending_actions:
+            if kind == db_manager.CONTROL_ROW and row[:2] == (tenant.id, from_phone_number):
+                chat = chat._replace(control_mode=row[2])
+
+    # 2. Guardar el mensaje del usuario (con su wamid) en la base de datos, al final del payload
+    pending_rows.append((chat_id, 'user', msg_db_type, user_message_content, message_data.get("id")))
+
+    # 3. Obtener la respuesta del bot (o indicar que está en modo agente)
+    actions_before = len(pending_actions) if pending_actions is not None else 0
+    bot_response_data = bot_logic.get_parsed_bot_response(
+        user_message_content, user_id=from_phone_number, chat=chat, pending_states=pending_states, tenant=tenant,
+        pending_actions=pending_actions
+    )
+    if pending_actions is not None:
+        # Los pedidos llevan el wamid del mensaje que los cerró: si se reprocesa no se duplican
+        pending_actions[actions_before:] = [
+            db_manager.with_source_wamid(action, message_data.get("id")) for action in pending_actions[actions_before:]
+        ]
+
+    # Solo envía un mensaje si el bot_logic genera uno (no si está en modo agente)
+    if bot_response_data.get("message_type", "text") != "none" and bot_response_data.get("text"): # 'none' es la nueva señal para no responder
+        if pending_replies is None:
+            send_reply(chat_id, from_phone_number, bot_response_data, tenant)
+        else:
+            pending_replies.append((chat_id, from_phone_number, bot_response_data, tenant))
+    else:
+        logger.info("Bot no generó respuesta para %s (modo agente o respuesta vacía).", from_phone_number, extra={"event": "no_reply"})
+    return True
+
+
+def persist(rows, states, actions=(), claims=()):
+    """
+    Confirma en una sola transacción los mensajes de un payload, sus estados
+    conversacionales, las acciones del flujo y los mensajes del inbox procesados
+    (`claims`, pares (inbox_id, claimed_at)).
+    """
+    store = state_store.get_store()
+    extra = list(store.prepare(states) or ()) if states else []
+    extra.extend(actions)
+    extra.extend((db_manager.INBOX_DONE_ROW, claim) for claim in claims)
+    if not db_manager.persist_messages(rows, durable=True, extra=extra):
+        return False
+    if states:
+        store.committed(states)
+    return True
+
+
+def _claim(inbox_id, claimed_at=None):
+    # Reclamación del mensaje al empezar a procesarlo; None si lo tomó otro worker
+    if claimed_at is None:
+        return inbox.claim([inbox_id]).get(inbox_id)
+    return inbox.renew_claim(inbox_id, claimed_at)
+
+
+def process_inbox_message(inbox_id, message_data, claimed_at=None):
+    """
+    Procesa un solo mensaje: pipeline, commit de sus filas y estados, inbox y envío de la
+    respuesta. `inbox_id` es None si el inbox no estaba disponible al recibirlo;
+    `claimed_at`, la reclamación del barrido si viene de él. Antes del pipeline se
+    reclama (o renueva) el mensaje: si ya lo tomó otro worker no se procesa.
+    """
+    if inbox_id is not None:
+        claimed_at = _claim(inbox_id, claimed_at)
+        if claimed_at is None:
+            logger.info("Mensaje %s del inbox (id %s) ya reclamado por otro worker; no se procesa.",
+                        message_data.get("id"), inbox_id, extra={"event": "inbox_claim_lost"})
+            return True
+    rows = []
+    states = {}
+    replies = []
+    actions = []
+    try:
+        processed = process_message(message_data, rows, states, replies, actions)
+    except Exception as e:
+        logger.error(f"Error procesando el mensaje {message_data.get('id')} del inbox: {e}", exc_info=True)
+        if inbox_id is not None:
+            inbox.mark_failed(inbox_id, claimed_at, str(e))
+        return False
+    if not processed:
+        if inbox_id is not None:
+            inbox.mark_failed(inbox_id, claimed_at, "No se pudo resolver el chat")
+        return False
+    # El inbox se marca como procesado en la misma sentencia que todo lo demás
+    claims = [(inbox_id, claimed_at)] if inbox_id is not None else []
+    if (rows or states or actions or claims) and not persist(rows, states, actions, claims):
+        if inbox_id is not None:
+            inbox.mark_failed(inbox_id, claimed_at, "No se pudieron guardar los mensajes")
+        return False
+    for reply in replies:
+        send_reply(*reply)
+    return True
+
+
+def process_batch(recorded):
+    """
+    Procesa en la petición del webhook los mensajes ya registrados en el inbox, como
+    lista de (inbox_id, message_data). Se reclaman todos en una sentencia y se omiten
+    los que ya tomó el barrido. Todos se guardan en una única transacción y el
+    inbox se marca como procesado en esa misma transacción; las respuestas se envían
+    después de confirmarla: si falla, el reintento desde el inbox no duplica nada.
+    """
+    claims = inbox.claim(inbox_id for inbox_id, _ in recorded if inbox_id is not None)
+    rows = []
+    states = {}
+    replies = []
+    actions = []
+    done = []
+    for inbox_id, message_data in recorded:
+        claimed_at = claims.get(inbox_id)
+        if inbox_id is not None and claimed_at is None:
+            logger.info("Mensaje %s del inbox (id %s) ya reclamado por otro worker; no se procesa.",
+                        message_data.get("id"), inbox_id, extra={"event": "inbox_claim_lost"})
+            continue
+        rows_before, replies_before, actions_before = len(rows), len(replies), len(actions)
+        # Los cambios de estado del mensaje se aplican al payload solo si se procesó entero;
+        # los mensajes siguientes del mismo usuario ven los de los anteriores.
+        message_states = ChainMap({}, states)
+        try:
+            processed = process_message(message_data, rows, message_states, replies, actions)
+        except Exception as e:
+            del rows[rows_before:] # Se guardarán al reprocesarlo desde el inbox
+            del replies[replies_before:]
+            del actions[actions_before:]
+            logger.error(f"Error procesando el mensaje {message_data.get('id')}: {e}", exc_info=True)
+            if inbox_id is not None:
+                inbox.mark_failed(inbox_id, claimed_at, str(e))
+            continue
+        states.update(message_states.maps[0])
+        if inbox_id is None:
+            # El inbox no está disponible: se procesa igualmente, sin garantía de reanudación.
+            continue
+        if processed:
+            done.append((inbox_id, claimed_at))
+        else:
+            inbox.mark_failed(inbox_id, claimed_at, "No se pudo resolver el chat")
+
+    if (rows or states or actions or done) and not persist(rows, states, actions, done):
+        logger.error(f"No se pudieron guardar {len(rows)} mensajes del payload; quedan pendientes en el inbox.")
+        for inbox_id, claimed_at in done:
+            inbox.mark_failed(inbox_id, claimed_at, "No se pudieron guardar los mensajes")
+        return
+    for reply in replies:
+        send_reply(*reply)
+
+
+class InboundEngine:
+    """
+    Procesa los mensajes entrantes fuera de la petición del webhook, repartidos por
+    conversación (número que lo recibió y usuario) entre un pool de workers
+    (ShardedExecutor) compartido por todos los números.
+
+    - Los mensajes de un mismo usuario a un número van a la misma cola y se procesan en orden
+      estricto (el flujo de pedido depende del estado que dejó el mensaje anterior);
+      usuarios distintos avanzan en paralelo.
+    - Contrapresión: si la cola del usuario sigue llena tras INBOUND_ENQUEUE_TIMEOUT, el
+      mensaje se queda pendiente en el inbox (aplazado).
+    - Los aplazados (por contrapresión o por el control de admisión) se reintentan cada
+      INBOUND_DRAIN_INTERVAL segundos, en orden y pasando otra vez por admission.check;
+      el barrido del inbox solo los retoma si este proceso ya no los tiene.
+    - `shutdown` deja de aceptar mensajes y procesa los que ya estaban en cola.
+    """
+
+    def __init__(self, num_workers=INBOUND_WORKERS, queue_size=INBOUND_QUEUE_SIZE,
+                 enqueue_timeout=INBOUND_ENQUEUE_TIMEOUT, process_fn=process_inbox_message,
+                 defer_ttl=inbox.INBOX_RECOVERY_AGE + 2 * inbox.INBOX_RECOVERY_INTERVAL,
+                 drain_interval=INBOUND_DRAIN_INTERVAL):
+        self._executor = ShardedExecutor(num_workers, queue_size, name="inbound")
+        self._process_fn = process_fn
+        self.enqueue_timeout = enqueue_timeout
+        self.pid = os.getpid()
+        self._queued = set()  # inbox_ids en cola: el barrido no los encola dos veces
+        self._deferred = {}  # (número, usuario) -> [{inbox_id: (message_data, claimed_at)} en orden de llegada, desde]
+        self.defer_ttl = defer_ttl
+        self.drain_interval = drain_interval
+        self._drain_thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._counters = {"submitted": 0, "processed": 0, "failed": 0, "deferred": 0, "duplicates": 0, "drained": 0}
+        self.queue_wait = LatencyRecorder()
+        self.processing_time = LatencyRecorder()
+
+    def submit(self, inbox_id, message_data, recovered=False, claimed_at=None):
+        """
+        Encola un mensaje en la cola de su usuario. Devuelve False si se aplazó por
+        contrapresión (queda pendiente en el inbox).
+
+        Mientras un usuario tenga mensajes aplazados, los siguientes también se aplazan
+        para no adelantarlos; el drenaje (o el barrido del inbox, `recovered=True`) los
+        encola en orden de llegada y, al encolar el último, el usuario vuelve a la cola directa.
+        """
+        conversation = _shard_key(message_data)
+        with self._lock:
+            if inbox_id is not None and inbox_id in self._queued:
+                self._counters["duplicates"] += 1
+                if recovered:
+                    self._undefer(conversation, inbox_id)
+                return True
+            deferred = self._deferred.get(conversation)
+            if deferred is not None and time.monotonic() - deferred[1] > self.defer_ttl:
+                # Los aplazados los retomó otro proceso: no esperar indefinidamente
+                del self._deferred[conversation]
+                deferred = None
+            if deferred is not None and not recovered and inbox_id is not None:
+                deferred[0][inbox_id] = (message_data, claimed_at)
+                self._counters["deferred"] += 1
+                return False
+            self._queued.add(inbox_id)
+        try:
+            # Sin inbox el mensaje no se puede retomar después: se espera a que haya sitio.
+            timeout = self.enqueue_timeout if inbox_id is not None else None
+            self._executor.submit(conversation, self._run, inbox_id, message_data, time.monotonic(), claimed_at, timeout=timeout)
+        except (queue.Full, RuntimeError) as e:
+            with self._lock:
+                self._queued.discard(inbox_id)
+                self._counters["deferred"] += 1
+                if inbox_id is not None:
+                    self._defer(conversation, inbox_id, message_data, claimed_at)
+            if inbox_id is None:
+                logger.error(f"Mensaje {message_data.get('id')} descartado (sin inbox): {e}")
+            else:
+                logger.warning(f"Mensaje {message_data.get('id')} aplazado; queda pendiente en el inbox: {str(e) or 'cola llena'}")
+            return False
+        with self._lock:
+            self._counters["submitted"] += 1
+            if recovered:
+                self._undefer(conversation, inbox_id)
+        return True
+
+    def defer(self, inbox_id, message_data, claimed_at=None):
+        """
+        Deja un mensaje pendiente en el inbox sin encolarlo (control de admisión). Los
+        siguientes del mismo usuario se aplazan detrás de él hasta que lo encole el drenaje.
+        `claimed_at` es la reclamación del barrido si el mensaje viene de él.
+        """
+        with self._lock:
+            self._defer(_shard_key(message_data), inbox_id, message_data, claimed_at)
+
+    def is_deferred(self, conversation):
+        with self._lock:
+            return conversation in self._deferred
+
+    def _defer(self, conversation, inbox_id, message_data, claimed_at):
+        # Con self._lock tomado. Un mensaje ya aplazado conserva su posición.
+        self._deferred.setdefault(conversation, [{}, time.monotonic()])[0][inbox_id] = (message_data, claimed_at)
+        if self._drain_thread is None and self.drain_interval > 0:
+            self._drain_thread = threading.Thread(target=self._drain_loop, name="inbound-drain", daemon=True)
+            self._drain_thread.start()
+
+    def _undefer(self, conversation, inbox_id):
+        # Con self._lock tomado
+        deferred = self._deferred.get(conversation)
+        if deferred is not None:
+            deferred[0].pop(inbox_id, None)
+            if not deferred[0]:
+                del self._deferred[conversation]
+
+    def drain(self):
+        """
+        Encola los mensajes aplazados que ahora pasan el control de admisión, en orden por
+        conversación: el primero que no se admite deja esperando a los siguientes de su
+        usuario. Devuelve cuántos se encolaron.
+        """
+        controller = admission.get_controller()
+        with self._lock:
+            pending = [(conversation, list(deferred[0].items())) for conversation, deferred in self._deferred.items()]
+        drained = 0
+        for conversation, messages in pending:
+            for inbox_id, (message_data, claimed_at) in messages:
+                if controller.check(conversation, self.in_flight()) is not None:
+                    break
+                with logging_setup.request_context(logging_setup.new_request_id()):
+                    if not self.submit(inbox_id, message_data, recovered=True, claimed_at=claimed_at):
+                        controller.refund(conversation) # Sigue aplazado: el token se cobra al encolarlo
+                        break
+                drained += 1
+        if drained:
+            with self._lock:
+                self._counters["drained"] += drained
+        return drained
+
+    def _drain_loop(self):
+        while not self._stop.wait(self.drain_interval):
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error(f"Error al encolar los mensajes aplazados: {e}", exc_info=True)
+
+    def in_flight(self):
+        """Mensajes encolados o en proceso."""
+        with self._lock:
+            return self._counters["submitted"] - self._counters["processed"] - self._counters["failed"]
+
+    def _run(self, inbox_id, message_data, enqueued_at, claimed_at=None):
+        started = time.monotonic()
+        self.queue_wait.record(started - enqueued_at)
+        ok = False
+        try:
+            ok = self._process_fn(inbox_id, message_data, claimed_at)
+        finally:
+            elapsed = time.monotonic() - started
+            self.processing_time.record(elapsed)
+            metrics.INBOUND_MESSAGE_SECONDS.observe(elapsed, "ok" if ok else "failed")
+            with self._lock:
+                self._queued.discard(inbox_id)
+                self._counters["processed" if ok else "failed"] += 1
+
+    def wait_idle(self, timeout=None, interval=0.005):
+        """Espera a que se hayan procesado todos los mensajes encolados (benchmarks y pruebas)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                idle = self._counters["processed"] + self._counters["failed"] >= self._counters["submitted"]
+            if idle:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+
+    def shutdown(self, timeout=INBOUND_SHUTDOWN_TIMEOUT):
+        """Procesa los mensajes en cola antes de salir; lo que no termine (y los aplazados) sigue en el inbox."""
+        self._stop.set()
+        return self._executor.shutdown(drain=True, timeout=timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["deferred_users"] = len(self._deferred)
+            stats["deferred_pending"] = sum(len(deferred[0]) for deferred in self._deferred.values())
+            stats["in_flight"] = stats["submitted"] - stats["processed"] - stats["failed"]
+        stats["queue"] = self._executor.stats()
+        stats["queue_wait"] = self.queue_wait.stats()
+        stats["processing_time"] = self.processing_time.stats()
+        return stats
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Devuelve el motor de procesamiento del proceso (None si INBOUND_ASYNC está desactivado)."""
+    global _engine
+    if not INBOUND_ASYNC:
+        return None
+    engine = _engine
+    if engine is not None and engine.pid == os.getpid():
+        return engine
+    with _engine_lock:
+        if _engine is None or _engine.pid != os.getpid():
+            # El despachador de salida se crea antes para que al salir (atexit va en orden
+            # inverso) se detenga después de drenar los mensajes entrantes, que aún responden.
+            outbound.get_dispatcher()
+            _engine = InboundEngine()
+            atexit.register(_engine.shutdown)
+        return _engine
+
+
+def _recover(inbox_id, message_data, claimed_at):
+    # Barrido del inbox: el mensaje recuperado va a la cola de su usuario, detrás de los suyos.
+    # También pasa el control de admisión; si no se admite, sigue reclamado y lo retoma el
+    # drenaje de aplazados (o, sin motor, el siguiente barrido).
+    engine = get_engine()
+    conversation = _shard_key(message_data)
+    if engine is None:
+        if admission.get_controller().check(conversation, _in_request) is not None:
+            return False
+        return process_inbox_message(inbox_id, message_data, claimed_at)
+    if engine.is_deferred(conversation) or admission.get_controller().check(conversation, engine.in_flight()) is not None:
+        engine.defer(inbox_id, message_data, claimed_at)
+        return False
+    with logging_setup.request_context(logging_setup.new_request_id()):
+        return engine.submit(inbox_id, message_data, recovered=True, claimed_at=claimed_at)
+
+
+_in_request = 0 # Mensajes procesándose dentro de peticiones del webhook (INBOUND_ASYNC=false)
+_in_request_lock = threading.Lock()
+
+
+def _in_flight(engine):
+    if engine is not None:
+        return engine.in_flight()
+    return _in_request
+
+
+def admit(messages, engine):
+    """
+    Control de admisión de un payload, antes de tocar la DB (ver services.admission).
+    Devuelve los mensajes que se registran en el inbox, en su orden de llegada, y los ids
+    (`id()`) de los que se registran aplazados. Los rechazados con ADMISSION_POLICY=drop
+    no se devuelven.
+    """
+    controller = admission.get_controller()
+    in_flight = _in_flight(engine)
+    accepted, deferred = [], set()
+    for message_data in messages:
+        # Mismo bucket que la cola: por conversación (número que lo recibió y usuario)
+        reason = controller.check(_shard_key(message_data), in_flight)
+        if reason is None:
+            accepted.append(message_data)
+            in_flight += 1
+            continue
+        action = "deferred" if controller.policy == "defer" else "dropped"
+        metrics.ADMISSION_REJECTED.inc(reason, action)
+        # INFO y no WARNING: en una avalancha el registro se muestrea; el total va en las métricas
+        logger.info("Mensaje %s de %s no admitido (%s): %s.", message_data.get("id"), message_data.get("from"),
+                    reason, "queda pendiente en el inbox" if action == "deferred" else "descartado",
+                    extra={"event": "admission_rejected"})
+        if action == "deferred":
+            accepted.append(message_data)
+            deferred.add(id(message_data))
+    return accepted, deferred
+
+
+def handle_messages(messages):
+    """
+    Registra los mensajes de un payload en el inbox (descartando duplicados) y procesa
+    solo los nuevos. Los reenvíos de Meta no vuelven a pasar por el pipeline.
+    Con INBOUND_ASYNC el webhook responde en cuanto los mensajes están en el inbox y se
+    procesan en segundo plano, en orden por usuario; si no, dentro de la petición.
+    Los mensajes a números sin tenant activo se descartan antes de llegar al inbox.
+    Los que no pasan el control de admisión se descartan también antes del inbox o se
+    registran sin procesarlos: con INBOUND_ASYNC los retoma en orden el drenaje de
+    aplazados del motor; sin él, el barrido de recuperación.
+    """
+    global _in_request
+    routed = []
+    for message_data in messages:
+        metrics.MESSAGES_RECEIVED.inc(message_data.get("type") or "unknown")
+        if route(message_data) is None:
+            logger.warning(f"Mensaje {message_data.get('id')} descartado: el número {message_data.get(triage.ROUTING_KEY)} no tiene un tenant activo.")
+            metrics.UNROUTED_MESSAGES.inc("unknown_number")
+            continue
+        routed.append(message_data)
+    if not routed:
+        return
+    engine = get_engine()
+    accepted, deferred = admit(routed, engine)
+    if not accepted:
+        return
+    inbox.start_recovery(_recover)
+    recorded = []
+    for inbox_id, message_data in inbox.record_messages(accepted):
+        if id(message_data) not in deferred:
+            recorded.append((inbox_id, message_data))
+        elif inbox_id is None:
+            logger.error(f"Mensaje {message_data.get('id')} descartado: no admitido y sin inbox para retomarlo.")
+        elif engine is not None:
+            engine.defer(inbox_id, message_data)
+    if engine is None:
+        with _in_request_lock:
+            _in_request += len(recorded)
+        try:
+            process_batch(recorded)
+        finally:
+            with _in_request_lock:
+                _in_request -= len(recorded)
+        return
+    # Cada mensaje lleva su propio request_id (`<id de la petición>.<n>`) a los hilos que lo procesan
+    request_id = logging_setup.get_request_id() or logging_setup.new_request_id()
+    for n, (inbox_id, message_data) in enumerate(recorded, 1):
+        with logging_setup.request_context(f"{request_id}.{n}"):
+            if not engine.submit(inbox_id, message_data):
+                # Aplazado por contrapresión: el drenaje lo vuelve a pasar por la admisión
+                admission.get_controller().refund(_shard_key(message_data))
+
+
+def get_stats():
+    engine = _engine
+    if engine is None or engine.pid != os.getpid():
+        return {"enabled": INBOUND_ASYNC, "submitted": 0, "in_flight": _in_request}
+    stats = engine.stats()
+    stats["enabled"] = True
+    return stats
@@ -0,0 +1,280 @@
+# chatbot/services/inbox.py
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+from psycopg2 import extras
+
+from services import db_manager
+
+logger = logging.getLogger(__name__)
+
+# Configuración del inbox de mensajes entrantes (idempotencia por wamid)
+INBOX_RECENT_IDS = int(os.getenv("INBOX_RECENT_IDS", "50000")) # wamids recordados en memoria
+INBOX_RECOVERY_INTERVAL = float(os.getenv("INBOX_RECOVERY_INTERVAL", "30")) # Segundos entre barridos
+INBOX_RECOVERY_AGE = int(os.getenv("INBOX_RECOVERY_AGE", "60")) # Segundos sin terminar para considerar un mensaje abandonado
+INBOX_MAX_ATTEMPTS = int(os.getenv("INBOX_MAX_ATTEMPTS", "5"))
+INBOX_RECOVERY_BATCH = int(os.getenv("INBOX_RECOVERY_BATCH", "100"))
+
+
+class RecentIdFilter:
+    """Conjunto acotado de ids vistos recientemente (descarta los más antiguos)."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def __contains__(self, message_id):
+        with self._lock:
+            if message_id in self._ids:
+                self.hits += 1
+                return True
+            return False
+
+    def add_many(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                self._ids[message_id] = None
+                self._ids.move_to_end(message_id)
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+    def __len__(self):
+        return len(self._ids)
+
+
+_recent_ids = RecentIdFilter(INBOX_RECENT_IDS)
+_counters = {"received": 0, "duplicates_memory": 0, "duplicates_db": 0, "recovered": 0}
+_counters_lock = threading.Lock()
+
+
+def _count(key, value=1):
+    with _counters_lock:
+        _counters[key] += value
+
+
+def record_messages(messages):
+    """
+    Registra los mensajes entrantes en `webhook_inbox` y devuelve solo los nuevos como
+    lista de (inbox_id, message_data). Los duplicados se descartan primero en memoria
+    y después por la restricción única sobre el wamid, todo en un único INSERT.
+    Si la DB no está disponible, devuelve (None, message_data) para los no vistos.
+    """
+    fresh = OrderedDict()
+    without_id = []
+    for message_data in messages:
+        message_id = message_data.get("id")
+        _count("received")
+        if not message_id:
+            without_id.append((None, message_data))
+        elif message_id in _recent_ids or message_id in fresh:
+            _count("duplicates_memory")
+            logger.info(f"Mensaje duplicado {message_id} descartado (filtro en memoria).")
+        else:
+            fresh[message_id] = message_data
+    if not fresh:
+        return without_id
+
+    rows = [(message_id, message_data.get("from"), extras.Json(message_data)) for message_id, message_data in fresh.items()]
+    unrecorded = without_id + [(None, message_data) for message_data in fresh.values()]
+
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return unrecorded
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            inserted = extras.execute_values(
+                cur,
+                """
+                INSERT INTO webhook_inbox (wamid, whatsapp_user_id, payload) VALUES %s
+                ON CONFLICT (wamid) DO NOTHING
+                RETURNING id, wamid
+                """,
+                rows,
+                fetch=True,
+            )
+    except Exception as e:
+        logger.error(f"Error al registrar {len(rows)} mensajes en el inbox: {e}")
+        return unrecorded
+    finally:
+        db_manager.release_db_connection(conn)
+
+    _recent_ids.add_many(fresh.keys())
+    duplicates = len(rows) - len(inserted)
+    if duplicates:
+        _count("duplicates_db", duplicates)
+        logger.info(f"{duplicates} mensajes duplicados descartados por el inbox.")
+    return without_id + [(inbox_id, fresh[wamid]) for inbox_id, wamid in inserted]
+
+
+def _update_status(sql, params, description):
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return False
+    try:
+        conn.autocommit = True # Una sola sentencia: sin BEGIN/COMMIT adicionales
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            return True
+    except Exception as e:
+        logger.error(f"Error al {description}: {e}")
+        return False
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def _claim(sql, params, description):
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return {}
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            return dict(cur.fetchall())
+    except Exception as e:
+        logger.error(f"Error al {description}: {e}")
+        return {}
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def claim(inbox_ids):
+    """
+    Reclama mensajes recién registrados justo antes de procesarlos. Solo se reclaman los
+    que siguen 'pending': si un mensaje esperó en memoria más de INBOX_RECOVERY_AGE y el
+    barrido de otro worker ya lo tomó, no se procesa dos veces. Devuelve
+    {inbox_id: claimed_at}; `claimed_at` identifica la reclamación en mark_failed y al marcarlo
+    como procesado (db_manager.INBOX_DONE_ROW, en la transacción de sus mensajes).
+    """
+    inbox_ids = list(inbox_ids)
+    if not inbox_ids:
+        return {}
+    return _claim(
+        """
+        UPDATE webhook_inbox SET status = 'processing', claimed_at = clock_timestamp()
+        WHERE id = ANY(%s) AND status = 'pending'
+        RETURNING id, claimed_at
+        """,
+        (inbox_ids,),
+        f"reclamar {len(inbox_ids)} mensajes del inbox",
+    )
+
+
+def renew_claim(inbox_id, claimed_at):
+    """
+    Renueva la reclamación de un mensaje tomado por el barrido al empezar a procesarlo
+    (pudo esperar en cola). Devuelve el nuevo `claimed_at` o None si ya lo reclamó otro.
+    """
+    return _claim(
+        """
+        UPDATE webhook_inbox SET claimed_at = clock_timestamp()
+        WHERE id = %s AND status = 'processing' AND claimed_at = %s
+        RETURNING id, claimed_at
+        """,
+        (inbox_id, claimed_at),
+        f"renovar la reclamación del mensaje {inbox_id} del inbox",
+    ).get(inbox_id)
+
+
+def mark_failed(inbox_id, claimed_at, error):
+    """Registra un intento fallido; tras INBOX_MAX_ATTEMPTS el mensaje queda como 'failed'."""
+    return _update_status(
+        """
+        UPDATE webhook_inbox
+        SET attempts = attempts + 1,
+            status = CASE WHEN attempts + 1 >= %s THEN 'failed' ELSE 'pending' END,
+            last_error = %s
+        WHERE id = %s AND claimed_at = %s AND status = 'processing'
+        """,
+        (INBOX_MAX_ATTEMPTS, error[:1000], inbox_id, claimed_at),
+        f"registrar el fallo del mensaje {inbox_id} del inbox",
+    )
+
+
+def claim_abandoned(limit=INBOX_RECOVERY_BATCH):
+    """
+    Reclama mensajes que quedaron sin terminar (p. ej. el worker murió a mitad del
+    pipeline). SKIP LOCKED permite que varios workers barran el inbox a la vez.
+    """
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return []
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE webhook_inbox SET status = 'processing', claimed_at = clock_timestamp()
+                WHERE id IN (
+                    SELECT id FROM webhook_inbox
+                    WHERE status IN ('pending', 'processing')
+                      AND COALESCE(claimed_at, received_at) < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, payload, claimed_at
+                """,
+                (INBOX_RECOVERY_AGE, limit)
+            )
+            claimed = sorted(cur.fetchall())
+            conn.commit()
+            return claimed
+    except Exception as e:
+        logger.error(f"Error al reclamar mensajes abandonados del inbox: {e}")
+        conn.rollback()
+        return []
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def recover_pending(process_fn):
+    """
+    Reprocesa (en orden de llegada) los mensajes abandonados con
+    `process_fn(inbox_id, message_data, claimed_at)`. Devuelve cuántos se reclamaron.
+    """
+    claimed = claim_abandoned()
+    for inbox_id, message_data, claimed_at in claimed:
+        logger.warning(f"Reanudando el mensaje {message_data.get('id')} del inbox (id {inbox_id}).")
+        process_fn(inbox_id, message_data, claimed_at)
+    if claimed:
+        _count("recovered", len(claimed))
+    return len(claimed)
+
+
+_recovery_thread = None
+_recovery_pid = None
+_recovery_lock = threading.Lock()
+
+
+def start_recovery(process_fn):
+    """Arranca (una vez por proceso) el hilo que barre el inbox periódicamente."""
+    global _recovery_thread, _recovery_pid
+    if _recovery_thread is not None and _recovery_pid == os.getpid():
+        return
+    with _recovery_lock:
+        if _recovery_thread is not None and _recovery_pid == os.getpid():
+            return
+
+        def _loop():
+            stop = threading.Event()
+            while not stop.wait(INBOX_RECOVERY_INTERVAL):
+                try:
+                    recover_pending(process_fn)
+                except Exception as e:
+                    logger.error(f"Error en el barrido del inbox: {e}", exc_info=True)
+
+        _recovery_thread = threading.Thread(target=_loop, name="inbox-recovery", daemon=True)
+        _recovery_pid = os.getpid()
+        _recovery_thread.start()
+
+
+def get_stats():
+    with _counters_lock:
+        stats = dict(_counters)
+    stats["recent_ids"] = len(_recent_ids)
+    return stats
@@ -0,0 +1,262 @@
+# chatbot/services/logging_setup.py
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+import logging.handlers
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Configuración del logging de la aplicación
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json") # 'json' (una línea JSON por registro) o 'text'
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000")) # Registros pendientes antes de descartar
+LOG_SAMPLE_PER_SECOND = float(os.getenv("LOG_SAMPLE_PER_SECOND", "5")) # Registros por segundo y evento de alto volumen (0 = todos)
+LOG_REDACT = os.getenv("LOG_REDACT", "true").lower() == "true"
+
+# Atributos estándar de LogRecord: el resto se consideran campos extra del registro
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+# Redacción de datos personales: teléfonos (WhatsApp IDs) y direcciones
+_PHONE_RE = re.compile(r"(?<![\w.])\+?\d{7,11}(\d{4})(?!\w)")
+_ADDRESS_RE = re.compile(r"((?:direcci[oó]n|address)\s*[:=]\s*)[^\n\"}]+", re.IGNORECASE)
+_REDACTED_KEYS = frozenset({
+    "from", "to", "wa_id", "recipient_id", "phone", "display_phone_number",
+    "address", "delivery_address", "name", "customer_name", "profile",
+})
+
+
+def redact_text(text):
+    """Enmascara teléfonos (se conservan los 4 últimos dígitos) y direcciones en un texto."""
+    text = _PHONE_RE.sub(r"***\1", text)
+    return _ADDRESS_RE.sub(r"\1[REDACTADO]", text)
+
+
+def redact(value):
+    """Copia de un payload con los campos personales enmascarados."""
+    if isinstance(value, dict):
+        return {
+            key: ("[REDACTADO]" if key in _REDACTED_KEYS and item is not None else redact(item))
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+# Identificador de la petición (o del mensaje entrante) en curso: se añade a cada registro
+# para unir los de un mismo mensaje aunque pasen por varios hilos (ver workers.ShardedExecutor).
+_request_id = contextvars.ContextVar("request_id", default=None)
+_REQUEST_ID_RE = re.compile(r"^[\w.\-]{1,64}$")
+
+
+def new_request_id(incoming=None):
+    """Devuelve `incoming` (p. ej. la cabecera X-Request-ID) si es válido, o uno nuevo."""
+    if incoming and _REQUEST_ID_RE.match(incoming):
+        return incoming
+    return uuid.uuid4().hex[:16]
+
+
+def get_request_id():
+    return _request_id.get()
+
+
+def set_request_id(request_id):
+    """Fija el identificador del contexto actual; devuelve el token para `reset_request_id`."""
+    return _request_id.set(request_id)
+
+
+def reset_request_id(token):
+    _request_id.reset(token)
+
+
+@contextmanager
+def request_context(request_id):
+    token = _request_id.set(request_id)
+    try:
+        yield request_id
+    finally:
+        _request_id.reset(token)
+
+
+class RequestIdFilter(logging.Filter):
+    """Añade `request_id` al registro en el hilo que lo emite (antes de pasar a la cola)."""
+
+    def filter(self, record):
+        request_id = _request_id.get()
+        if request_id is not None:
+            record.request_id = request_id
+        return True
+
+
+class LazyJson:
+    """
+    Envuelve un payload para registrarlo con `logger.debug("... %s", LazyJson(data))`:
+    solo se serializa (y redacta) si el registro llega a emitirse, en el hilo de logging.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        value = redact(self.value) if LOG_REDACT else self.value
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class RateSampler(logging.Filter):
+    """
+    Deja pasar como mucho `rate` registros por segundo de cada evento de alto volumen
+    (los que llevan `extra={"event": ...}`); el siguiente registro emitido indica cuántos
+    se omitieron. Los registros sin `event` y los WARNING o superiores pasan siempre.
+    """
+
+    def __init__(self, rate=LOG_SAMPLE_PER_SECOND):
+        super().__init__()
+        self.rate = rate
+        self._buckets = {}  # evento -> [tokens, último_relleno, omitidos]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        event = getattr(record, "event", None)
+        if event is None or self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(event)
+            if bucket is None:
+                bucket = self._buckets[event] = [self.rate, now, 0]
+            bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1.0
+            if bucket[2]:
+                record.sampled_out = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro, con los campos extra y los datos personales redactados."""
+
+    def format(self, record):
+        message = record.getMessage()
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact_text(message) if LOG_REDACT else message,
+            "thread": record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formato de texto clásico de la aplicación, con la misma redacción que el JSON."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def format(self, record):
+        text = super().format(record)
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            text = f"[{request_id}] {text}"
+        return redact_text(text) if LOG_REDACT else text
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Entrega los registros al hilo de logging sin formatearlos en el hilo que los emite
+    (el mensaje se compone en el listener). Si la cola está llena el registro se descarta
+    en lugar de bloquear la petición.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Los argumentos del mensaje no se copian: los payloads registrados no se modifican después.
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if _pid != os.getpid():
+            # Proceso hijo (p. ej. worker de gunicorn): el hilo de logging no sobrevive al fork.
+            configure_logging()
+            if _handler is not self:
+                _handler.enqueue(record)
+                return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_handler = None
+_pid = None
+_lock = threading.Lock()
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """
+    Configura el logging del proceso una sola vez (y otra vez tras un fork): los
+    registros pasan por una cola acotada a un hilo que los formatea y escribe en stdout.
+    """
+    global _listener, _handler, _pid
+    with _lock:
+        if _pid == os.getpid():
+            return
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        handler = NonBlockingQueueHandler(log_queue)
+        handler.addFilter(RequestIdFilter())
+        handler.addFilter(RateSampler())
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(level)
+
+        listener = logging.handlers.QueueListener(log_queue, output)
+        listener.start()
+        if _listener is None:
+            atexit.register(_stop_listener)
+        _listener, _handler, _pid = listener, handler, os.getpid()
+
+
+def _stop_listener():
+    # Escribe los registros pendientes antes de salir.
+    if _listener is not None and _pid == os.getpid():
+        _listener.stop()
+
+
+def get_stats():
+    handler = _handler
+    if handler is None:
+        return {"configured": False}
+    return {"configured": True, "queue_depth": handler.queue.qsize(), "dropped": handler.dropped}
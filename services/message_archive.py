@@ -0,0 +1,284 @@
+# chatbot/services/message_archive.py
+"""
+Retención de mensajes: las particiones mensuales de `messages` más antiguas que
+MESSAGES_RETENTION_MONTHS se escriben en un CSV comprimido con gzip y se eliminan de la
+base de datos. Los archivos quedan registrados en `message_archives` (y sus chats en
+`message_archive_chats`) para consultarlos bajo demanda.
+
+Pensado para ejecutarse periódicamente (p. ej. una vez al día desde cron):
+    python -m services.message_archive [--retention-months 12] [--dry-run]
+"""
+import os
+import csv
+import gzip
+import hashlib
+import logging
+import argparse
+from collections import deque
+from datetime import datetime
+
+from services import db_manager
+from services import logging_setup
+
+logger = logging.getLogger(__name__)
+
+# Configuración de la retención de mensajes
+MESSAGES_RETENTION_MONTHS = int(os.getenv("MESSAGES_RETENTION_MONTHS", "12")) # Meses completos que se mantienen en la DB
+MESSAGES_ARCHIVE_DIR = os.getenv("MESSAGES_ARCHIVE_DIR", "archive/messages")
+
+# Columnas de los archivos (las mismas claves que devuelve db_manager.get_messages_for_chat).
+# Cada archivo está ordenado por chat y fecha, así la lectura de un chat se detiene al pasarlo.
+ARCHIVE_COLUMNS = ("id", "chat_id", "sender_type", "message_type", "content", "timestamp", "wamid", "delivery_status")
+_ARCHIVE_COPY_SQL = """
+    COPY (
+        SELECT m.id, m.chat_id, m.sender_type, m.message_type, m.content, m.timestamp, m.wamid, s.status
+        FROM {partition} m LEFT JOIN message_statuses s ON s.wamid = m.wamid
+        ORDER BY m.chat_id, m.timestamp, m.id
+    ) TO STDOUT WITH (FORMAT csv, HEADER)
+"""
+
+
+def archive_path(partition_name, archive_dir=None):
+    return os.path.join(archive_dir or MESSAGES_ARCHIVE_DIR, f"{partition_name}.csv.gz")
+
+
+def _file_digest(path):
+    """(sha256, filas) del archivo; leerlo completo comprueba también que el gzip es válido."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as raw:
+        for block in iter(lambda: raw.read(1 << 20), b""):
+            digest.update(block)
+    with gzip.open(path, "rt", encoding="utf-8", newline="") as text:
+        rows = sum(1 for _ in csv.reader(text)) - 1 # Sin la cabecera
+    return digest.hexdigest(), rows
+
+
+def archive_partition(partition_name, archive_dir=None):
+    """
+    Archiva una partición: la copia a disco (bloqueándola solo para escrituras), verifica el
+    archivo y, en una transacción corta, la registra y la elimina. Devuelve el número de
+    mensajes archivados o None si hubo un error (la partición sigue intacta).
+    """
+    bounds = db_manager.message_partition_range(partition_name)
+    if bounds is None:
+        raise ValueError(f"Partición de mensajes inválida: {partition_name!r}")
+    path = archive_path(partition_name, archive_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cur:
+            # 1. Copia a un archivo temporal con la partición bloqueada para escrituras
+            cur.execute(f"LOCK TABLE {partition_name} IN SHARE MODE")
+            cur.execute(f"SELECT COUNT(*) FROM {partition_name}")
+            row_count = cur.fetchone()[0]
+            tmp_path = path + ".tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8", newline="") as out:
+                cur.copy_expert(_ARCHIVE_COPY_SQL.format(partition=partition_name), out)
+            cur.execute(f"""
+                SELECT chat_id, COUNT(*), MIN(timestamp), MAX(timestamp)
+                FROM {partition_name} GROUP BY chat_id
+            """)
+            chats = cur.fetchall()
+            conn.commit()
+
+            sha256, archived_rows = _file_digest(tmp_path)
+            if archived_rows != row_count:
+                raise RuntimeError(f"El archivo tiene {archived_rows} filas y la partición {row_count}")
+            with open(tmp_path, "rb") as tmp:
+                os.fsync(tmp.fileno())
+            os.replace(tmp_path, path)
+
+            # 2. Registro y eliminación (DETACH bloquea `messages`: esta transacción es corta)
+            cur.execute(f"SELECT COUNT(*) FROM {partition_name}")
+            if cur.fetchone()[0] != row_count:
+                raise RuntimeError(f"La partición {partition_name} cambió durante el archivado")
+            cur.execute(
+                "INSERT INTO message_archives (partition_name, range_start, range_end, file_path, row_count, file_bytes, sha256) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                (partition_name, *bounds, os.path.abspath(path), row_count, os.path.getsize(path), sha256)
+            )
+            if chats:
+                db_manager.extras.execute_values(
+                    cur,
+                    "INSERT INTO message_archive_chats (chat_id, message_count, first_message_at, last_message_at, partition_name) VALUES %s",
+                    chats, template=f"(%s, %s, %s, %s, '{partition_name}')",
+                )
+            cur.execute(f"ALTER TABLE messages DETACH PARTITION {partition_name}")
+            cur.execute(f"DROP TABLE {partition_name}")
+            conn.commit()
+            logger.info(f"Partición {partition_name} archivada en {path} ({row_count} mensajes)")
+            return row_count
+    except Exception as e:
+        logger.error(f"Error al archivar la partición {partition_name}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def expired_partitions(retention_months=MESSAGES_RETENTION_MONTHS):
+    """Particiones cuyo mes terminó antes del periodo de retención, de la más antigua a la más reciente."""
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT date_trunc('month', CURRENT_TIMESTAMP)::date")
+            cutoff = db_manager._add_months(cur.fetchone()[0], -retention_months)
+            cur.execute("""
+                SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'messages'::regclass
+            """)
+            names = [row[0] for row in cur.fetchall()]
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Error al listar las particiones de mensajes: {e}")
+        conn.rollback()
+        return None
+    finally:
+        db_manager.release_db_connection(conn)
+    expired = []
+    for name in names:
+        bounds = db_manager.message_partition_range(name)
+        if bounds is not None and bounds[1] <= cutoff:
+            expired.append(name)
+    return sorted(expired)
+
+
+def run_retention(retention_months=MESSAGES_RETENTION_MONTHS, archive_dir=None, dry_run=False):
+    """
+    Job de mantenimiento: crea las particiones de los próximos meses y archiva las vencidas.
+    Devuelve {partición: mensajes archivados (None si falló)}.
+    """
+    db_manager.ensure_message_partitions()
+    expired = expired_partitions(retention_months)
+    if expired is None:
+        return {}
+    if dry_run:
+        return {name: 0 for name in expired}
+    return {name: archive_partition(name, archive_dir) for name in expired}
+
+
+# --- Lectura de mensajes archivados ---
+
+def _parse_row(row):
+    message = dict(zip(ARCHIVE_COLUMNS, row))
+    message["id"] = int(message["id"])
+    message["chat_id"] = int(message["chat_id"])
+    message["timestamp"] = datetime.fromisoformat(message["timestamp"])
+    # En CSV un NULL es un campo vacío; wamid y estado nunca son cadenas vacías
+    message["wamid"] = message["wamid"] or None
+    message["delivery_status"] = message["delivery_status"] or None
+    return message
+
+
+def _read_chat(path, chat_id, before, limit):
+    """Los `limit` mensajes del chat anteriores a `before` (timestamp, id) en un archivo, en orden."""
+    rows = deque(maxlen=limit)
+    with gzip.open(path, "rt", encoding="utf-8", newline="") as text:
+        reader = csv.reader(text)
+        next(reader, None)
+        for row in reader:
+            row_chat = int(row[1])
+            if row_chat < chat_id:
+                continue
+            if row_chat > chat_id:
+                break # El archivo está ordenado por chat
+            message = _parse_row(row)
+            if before is not None and (message["timestamp"], message["id"]) >= before:
+                break
+            rows.append(message)
+    return list(rows)
+
+
+def get_archived_messages(chat_id, before=None, limit=50):
+    """
+    Mensajes archivados de un chat anteriores a `before` (timestamp, id), como mucho
+    `limit`, en orden cronológico. Devuelve (mensajes, hay_más) o None si hubo un error.
+    """
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cur:
+            query = (
+                "SELECT a.file_path FROM message_archive_chats c JOIN message_archives a USING (partition_name) "
+                "WHERE c.chat_id = %s"
+            )
+            params = [chat_id]
+            if before is not None:
+                query += " AND c.first_message_at <= %s"
+                params.append(before[0])
+            cur.execute(query + " ORDER BY a.range_start DESC", tuple(params))
+            paths = [row[0] for row in cur.fetchall()]
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Error al consultar los archivos de mensajes del chat {chat_id}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        db_manager.release_db_connection(conn)
+
+    # Del archivo más reciente hacia atrás hasta completar la página (+1 para saber si hay más)
+    messages = []
+    for path in paths:
+        try:
+            older = _read_chat(path, chat_id, before, limit + 1 - len(messages))
+        except OSError as e:
+            logger.error(f"No se pudo leer el archivo de mensajes {path}: {e}")
+            return None
+        messages = older + messages
+        if len(messages) > limit:
+            break
+    has_more = len(messages) > limit
+    return messages[len(messages) - limit:] if has_more else messages, has_more
+
+
+def get_messages_with_archive(chat_id, limit=None, before=None):
+    """
+    Como db_manager.get_messages_for_chat hacia atrás (sin cursor o con `before`), pero al
+    agotar los mensajes de la base de datos sigue con los archivados, con los mismos cursores.
+    """
+    limit = db_manager.clamp_page_size(limit)
+    page = db_manager.get_messages_for_chat(chat_id, limit=limit, before=before)
+    if page.next_cursor is not None:
+        return page
+    if page.items:
+        oldest = page.items[0]
+        cursor = (oldest["timestamp"], oldest["id"])
+    else:
+        cursor = db_manager.decode_cursor(before) if before else None
+    archived = get_archived_messages(chat_id, before=cursor, limit=limit - len(page.items) or 1)
+    if archived is None:
+        return page
+    older, has_more = archived
+    if len(page.items) == limit:
+        # Página completa: solo hace falta saber si quedan mensajes archivados más antiguos
+        return db_manager.Page(page.items, db_manager.encode_cursor(*cursor) if older else None, page.prev_cursor)
+    items = older + page.items
+    if not items:
+        return db_manager.Page([], None, None)
+    next_cursor = db_manager.encode_cursor(items[0]["timestamp"], items[0]["id"]) if has_more else None
+    prev_cursor = page.prev_cursor or db_manager.encode_cursor(items[-1]["timestamp"], items[-1]["id"])
+    return db_manager.Page(items, next_cursor, prev_cursor)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--retention-months", type=int, default=MESSAGES_RETENTION_MONTHS)
+    parser.add_argument("--archive-dir", default=MESSAGES_ARCHIVE_DIR)
+    parser.add_argument("--dry-run", action="store_true", help="Solo lista las particiones que se archivarían")
+    args = parser.parse_args()
+    logging_setup.configure_logging()
+    results = run_retention(args.retention_months, args.archive_dir, args.dry_run)
+    for name, count in results.items():
+        print(f"{name}: {'pendiente (dry run)' if args.dry_run else count if count is not None else 'ERROR'}")
+    if not results:
+        print("No hay particiones vencidas.")
+    return 1 if any(count is None for count in results.values()) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
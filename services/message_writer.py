@@ -0,0 +1,158 @@
+# chatbot/services/message_writer.py
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingGroup:
+    """Filas enviadas juntas; siempre se confirman en la misma transacción."""
+
+    __slots__ = ("rows", "extra", "durable", "done", "ok")
+
+    def __init__(self, rows, extra, durable):
+        self.rows = rows
+        self.extra = extra
+        self.durable = durable
+        self.done = threading.Event()
+        self.ok = False
+
+
+class MessageBatchWriter:
+    """
+    Escritor con commit agrupado (group commit).
+
+    Acumula filas y las entrega a `flush_fn(rows, extra) -> bool` en un único lote cuando
+    se juntan `max_batch` filas o la más antigua lleva `max_delay` segundos esperando.
+    Un solo hilo escribe, así cada lote es un INSERT multi-fila y un COMMIT.
+
+    - `submit(rows, durable=True)` bloquea hasta que el lote que contiene esas filas
+      se haya confirmado y devuelve si tuvo éxito. Si hay alguien esperando, el lote
+      se escribe sin esperar a `max_delay`: lo que llega mientras dura un COMMIT
+      forma el siguiente lote.
+    - `submit(rows, durable=False)` vuelve de inmediato.
+    - `extra` son filas de otro tipo (p. ej. estados conversacionales) que se escriben
+      en el mismo lote que `rows`.
+    - `close()` escribe lo pendiente antes de detener el hilo.
+    """
+
+    def __init__(self, flush_fn, max_batch=50, max_delay=0.02, max_pending=10000, name="message-writer"):
+        self._flush_fn = flush_fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._groups = deque()
+        self._pending_rows = 0
+        self._oldest = None
+        self._closed = False
+        self._in_flight = None  # Último grupo del lote que se está escribiendo
+        self._durable_pending = 0
+        self.pid = os.getpid()
+        self._counters = {"rows": 0, "batches": 0, "failed_rows": 0, "durable_waits": 0}
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, rows, durable=False, timeout=None, extra=None):
+        rows = list(rows)
+        extra = list(extra or ())
+        if not rows and not extra:
+            return True
+        group = _PendingGroup(rows, extra, durable)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("El escritor de mensajes está cerrado.")
+            # Contrapresión: no acumular sin límite si la DB va lenta.
+            while self._pending_rows >= self.max_pending and not self._closed:
+                self._cond.wait(self.max_delay)
+            self._groups.append(group)
+            self._pending_rows += len(rows)
+            if durable:
+                self._durable_pending += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._cond.notify_all()
+        if not durable:
+            return True
+        with self._cond:
+            self._counters["durable_waits"] += 1
+        if not group.done.wait(timeout):
+            logger.error(f"Tiempo de espera agotado confirmando {len(rows)} mensajes.")
+            return False
+        return group.ok
+
+    def _take_batch(self):
+        """Espera a que haya un lote listo y lo saca del buffer (sin partir grupos)."""
+        with self._cond:
+            while True:
+                if self._groups:
+                    age = time.monotonic() - self._oldest
+                    if (self._pending_rows >= self.max_batch or age >= self.max_delay
+                            or self._durable_pending or self._closed):
+                        break
+                    self._cond.wait(self.max_delay - age)
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+            batch, size = [], 0
+            while self._groups and (size < self.max_batch or not batch):
+                group = self._groups.popleft()
+                batch.append(group)
+                size += len(group.rows)
+                if group.durable:
+                    self._durable_pending -= 1
+            self._pending_rows -= size
+            self._oldest = time.monotonic() if self._groups else None
+            self._in_flight = batch[-1]
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            rows = [row for group in batch for row in group.rows]
+            extra = [row for group in batch for row in group.extra]
+            try:
+                ok = bool(self._flush_fn(rows, extra))
+            except Exception as e:
+                logger.error(f"Error al escribir un lote de {len(rows)} mensajes: {e}", exc_info=True)
+                ok = False
+            with self._cond:
+                self._counters["batches"] += 1
+                self._counters["rows"] += len(rows)
+                if not ok:
+                    self._counters["failed_rows"] += len(rows)
+            for group in batch:
+                group.ok = ok
+                group.done.set()
+
+    def flush(self, timeout=None):
+        """Bloquea hasta que todo lo enviado antes de esta llamada esté escrito."""
+        with self._cond:
+            if self._groups:
+                last = self._groups[-1]
+                self._oldest = 0.0 # Fuerza la escritura inmediata
+                self._cond.notify_all()
+            else:
+                last = self._in_flight
+        return last is None or last.done.wait(timeout)
+
+    def close(self, timeout=10.0):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        return not self._groups
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats["pending_rows"] = self._pending_rows
+        stats["avg_batch_size"] = round(stats["rows"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
@@ -0,0 +1,246 @@
+# chatbot/services/metrics.py
+import os
+import time
+import bisect
+import logging
+import threading
+import functools
+
+logger = logging.getLogger(__name__)
+
+# Configuración de las métricas internas (expuestas en /metrics, formato de Prometheus)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_PREFIX = "chatbot_"
+
+# Límites de los buckets de los histogramas de tiempo (segundos)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _ThreadShard:
+    """Valores de las métricas escritos por un solo hilo: se actualizan sin locks."""
+
+    __slots__ = ("thread", "values")
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.values = {}  # (métrica, etiquetas) -> float (contador) o lista (histograma)
+
+
+_local = threading.local()
+_shards = []
+_retired = _ThreadShard(None) # Acumulado de los hilos que ya terminaron
+_registry = []
+_collectors = []
+_lock = threading.Lock()
+
+
+def _shard():
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        shard = _local.shard = _ThreadShard(threading.current_thread())
+        with _lock:
+            _shards.append(shard)
+    return shard
+
+
+class Counter:
+    """
+    Contador monotónico con etiquetas opcionales. Cada hilo suma en su propio dict y el
+    total se combina solo al leer /metrics, así `inc` no toma ningún lock.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = METRICS_PREFIX + name + "_total"
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        with _lock:
+            _registry.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        if not METRICS_ENABLED:
+            return
+        values = _shard().values
+        key = (self, labelvalues)
+        values[key] = values.get(key, 0) + amount
+
+    @staticmethod
+    def _merge(total, value):
+        return (total or 0) + value
+
+    def _render(self, labels, value):
+        return [f"{self.name}{labels} {_number(value)}"]
+
+
+class Histogram:
+    """Histograma de duraciones (segundos) con la misma agregación por hilo que Counter."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = METRICS_PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        with _lock:
+            _registry.append(self)
+
+    def observe(self, seconds, *labelvalues):
+        if not METRICS_ENABLED:
+            return
+        values = _shard().values
+        key = (self, labelvalues)
+        data = values.get(key)
+        if data is None:
+            # Un contador por bucket (no acumulados) + el de +Inf, suma y número de observaciones
+            data = values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        data[bisect.bisect_left(self.buckets, seconds)] += 1
+        data[-2] += seconds
+        data[-1] += 1
+
+    def time(self, *labelvalues):
+        """Context manager que observa la duración del bloque."""
+        return _Timer(self, labelvalues)
+
+    @staticmethod
+    def _merge(total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def _render(self, labels, data):
+        lines = []
+        cumulative = 0
+        inner = labels[1:-1] + "," if labels else ""
+        for bound, count in zip(self.buckets + (float("inf"),), data):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else _number(bound)
+            lines.append(f'{self.name}_bucket{{{inner}le="{le}"}} {cumulative}')
+        lines.append(f"{self.name}_sum{labels} {_number(data[-2])}")
+        lines.append(f"{self.name}_count{labels} {data[-1]}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labelvalues", "started")
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labelvalues)
+
+
+def timed(histogram, *labelvalues):
+    """Decorador: observa en `histogram` la duración de cada llamada a la función."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *labelvalues)
+        return wrapper
+
+    return decorator
+
+
+def register_collector(fn):
+    """
+    Registra una función que se llama al leer /metrics y devuelve una lista de
+    (nombre, tipo, descripción, [(etiquetas_dict, valor)]) con valores que ya lleva otro
+    módulo, p. ej. profundidad de colas o del pool ('gauge') o sus contadores ('counter').
+    """
+    with _lock:
+        _collectors.append(fn)
+    return fn
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _snapshot():
+    """Suma los valores de todos los hilos (y pliega en `_retired` los de hilos terminados)."""
+    with _lock:
+        alive = []
+        for shard in _shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                for key, value in list(shard.values.items()):
+                    _retired.values[key] = key[0]._merge(_retired.values.get(key), value)
+        _shards[:] = alive
+        shards = [_retired] + alive
+    totals = {}
+    for shard in shards:
+        for key, value in list(shard.values.items()):
+            totals[key] = key[0]._merge(totals.get(key), value)
+    return totals
+
+
+def render():
+    """Todas las métricas en el formato de texto de Prometheus (versión 0.0.4)."""
+    totals = _snapshot()
+    by_metric = {}
+    for (metric, labelvalues), value in totals.items():
+        by_metric.setdefault(metric, []).append((labelvalues, value))
+    lines = []
+    for metric in list(_registry):
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for labelvalues, value in sorted(by_metric.get(metric, ()), key=lambda item: item[0]):
+            lines.extend(metric._render(_format_labels(metric.labelnames, labelvalues), value))
+    for collector in list(_collectors):
+        try:
+            families = collector()
+        except Exception as e:
+            logger.error(f"Error en un colector de métricas: {e}")
+            continue
+        for name, kind, documentation, samples in families:
+            name = METRICS_PREFIX + name
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = _format_labels(tuple(labels), tuple(labels.values()))
+                lines.append(f"{name}{label_text} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# --- Métricas de la aplicación ---
+
+WEBHOOK_PARSE_SECONDS = Histogram("webhook_parse_seconds", "Parseo y clasificación del payload del webhook")
+HTTP_REQUEST_SECONDS = Histogram("http_request_seconds", "Duración de las peticiones HTTP por endpoint", ("endpoint", "status"))
+DB_CALL_SECONDS = Histogram("db_call_seconds", "Duración de las funciones de db_manager", ("function",))
+BOT_ENGINE_SECONDS = Histogram("bot_engine_seconds", "Generación de la respuesta del bot (motor de flujos)")
+GRAPH_API_SECONDS = Histogram("graph_api_request_seconds", "Llamadas a la API de WhatsApp Cloud", ("outcome",))
+INBOUND_MESSAGE_SECONDS = Histogram("inbound_message_seconds", "Pipeline completo de un mensaje entrante en el motor por usuario", ("outcome",))
+
+MESSAGES_RECEIVED = Counter("messages_received", "Mensajes entrantes por tipo", ("type",))
+ADMISSION_REJECTED = Counter("admission_rejected", "Mensajes entrantes no admitidos por límite de usuario o sobrecarga", ("reason", "action"))
+UNROUTED_MESSAGES = Counter("unrouted_messages", "Mensajes descartados por no tener un tenant activo su número", ("reason",))
+CONTROL_MODE_SKIPS = Counter("control_mode_skips", "Mensajes sin respuesta del bot por estar el chat en modo agente")
+ORDERS_CREATED = Counter("orders_created", "Pedidos registrados")
+SEND_FAILURES = Counter("send_failures", "Envíos a WhatsApp que no se entregaron", ("reason",))
+MESSAGES_SENT = Counter("messages_sent", "Mensajes entregados a la API de WhatsApp")
+CAMPAIGN_MESSAGES = Counter("campaign_messages", "Mensajes de campañas por resultado", ("outcome",))
@@ -0,0 +1,279 @@
+# chatbot/services/migrations.py
+"""
+Migraciones versionadas del esquema de la base de datos.
+
+Cada migración es un archivo `migrations/NNNN_descripcion.sql` o `.py` (con una función
+`upgrade(cur)`); NNNN es su versión y se aplican en orden, cada una en su propia
+transacción junto con su fila en `schema_migrations`. Si una migración no puede ir en una
+transacción (p. ej. `CREATE INDEX CONCURRENTLY`), el `.sql` empieza con la línea
+`-- migrate: no-transaction` y contiene una sola sentencia (en un `.py`,
+`TRANSACTIONAL = False`); debe poder repetirse si falla a medias.
+
+Las migraciones se aplican una vez por despliegue, antes de arrancar los workers:
+    python -m services.migrations upgrade
+    python -m services.migrations status
+
+Un advisory lock de sesión serializa las ejecuciones simultáneas: la segunda espera y
+encuentra todo aplicado. Los workers no crean nada al arrancar; solo comparan la versión
+de la base de datos con la del código (`check_schema_on_startup`).
+"""
+import os
+import re
+import time
+import hashlib
+import logging
+import argparse
+import importlib.util
+
+import psycopg2
+from psycopg2 import errors
+
+from services import db_manager
+from services import logging_setup
+
+logger = logging.getLogger(__name__)
+
+# Configuración de las migraciones
+MIGRATIONS_DIR = os.getenv("MIGRATIONS_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations"))
+MIGRATIONS_LOCK_ID = 7311000 # Clave de pg_advisory_lock (una sola ejecución de migraciones a la vez)
+MIGRATIONS_LOCK_TIMEOUT = os.getenv("MIGRATIONS_LOCK_TIMEOUT", "30s") # Espera máxima por los locks de cada DDL (lock_timeout)
+SCHEMA_CHECK_ON_STARTUP = os.getenv("SCHEMA_CHECK_ON_STARTUP", "warn").lower() # 'warn', 'strict', 'migrate' u 'off'
+SCHEMA_CHECK_TIMEOUT = int(os.getenv("SCHEMA_CHECK_TIMEOUT", "2")) # Segundos para conectar en la comprobación de arranque
+
+_FILE_PATTERN = re.compile(r"^(\d{4})_(\w+)\.(sql|py)$")
+_NO_TRANSACTION = "-- migrate: no-transaction"
+
+_CREATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        checksum VARCHAR(64) NOT NULL, -- sha256 del archivo aplicado
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        duration_ms INTEGER
+    )
+"""
+
+
+class Migration:
+    """Un archivo de migración: versión, nombre y cómo aplicarlo."""
+
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+        with open(path, "rb") as f:
+            self.source = f.read()
+        self.checksum = hashlib.sha256(self.source).hexdigest()
+        if path.endswith(".sql"):
+            self.transactional = not self.source.decode("utf-8").lstrip().startswith(_NO_TRANSACTION)
+        else:
+            self.transactional = getattr(self._module(), "TRANSACTIONAL", True)
+
+    def _module(self):
+        module = getattr(self, "_loaded", None)
+        if module is None:
+            spec = importlib.util.spec_from_file_location(f"migrations.m{self.version:04d}_{self.name}", self.path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self._loaded = module
+        return module
+
+    def apply(self, cur):
+        if self.path.endswith(".sql"):
+            cur.execute(self.source.decode("utf-8"))
+        else:
+            self._module().upgrade(cur)
+
+    def __repr__(self):
+        return f"{self.version:04d}_{self.name}"
+
+
+def discover(migrations_dir=None):
+    """Migraciones del directorio ordenadas por versión. Lanza ValueError si hay versiones repetidas."""
+    migrations_dir = migrations_dir or MIGRATIONS_DIR
+    found = {}
+    for filename in sorted(os.listdir(migrations_dir)):
+        match = _FILE_PATTERN.match(filename)
+        if not match:
+            continue
+        version = int(match.group(1))
+        if version in found:
+            raise ValueError(f"Versión de migración repetida: {found[version].path} y {filename}")
+        found[version] = Migration(version, match.group(2), os.path.join(migrations_dir, filename))
+    return [found[version] for version in sorted(found)]
+
+
+def latest_version(migrations_dir=None):
+    """Versión más alta disponible en el código, sin leer los archivos (ni tocar la DB)."""
+    versions = [int(m.group(1)) for m in map(_FILE_PATTERN.match, os.listdir(migrations_dir or MIGRATIONS_DIR)) if m]
+    return max(versions, default=0)
+
+
+def _applied(cur):
+    cur.execute("SELECT version, checksum FROM schema_migrations ORDER BY version")
+    return dict(cur.fetchall())
+
+
+def upgrade(target=None, migrations_dir=None):
+    """
+    Aplica las migraciones pendientes hasta `target` (por defecto, todas) bajo el advisory
+    lock y crea las particiones de mensajes de los próximos meses. Devuelve la lista de
+    migraciones aplicadas o None si hubo un error (las anteriores quedan aplicadas).
+    """
+    migrations = discover(migrations_dir)
+    try:
+        conn = db_manager.open_dedicated_connection()
+    except Exception as e:
+        logger.error(f"No se pudo conectar a la DB para aplicar las migraciones: {e}")
+        return None
+    applied_now = []
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            started = time.perf_counter()
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+            waited = time.perf_counter() - started
+            if waited > 1:
+                logger.info(f"Lock de migraciones obtenido tras esperar {waited:.1f} s a otra ejecución.")
+            cur.execute(_CREATE_TABLE_SQL)
+            cur.execute("SELECT set_config('lock_timeout', %s, false)", (MIGRATIONS_LOCK_TIMEOUT,))
+            applied = _applied(cur)
+            for migration in migrations:
+                if migration.version in applied:
+                    if applied[migration.version] != migration.checksum:
+                        logger.warning(f"La migración {migration} cambió después de aplicarse; no se vuelve a aplicar.")
+                    continue
+                if target is not None and migration.version > target:
+                    break
+                _apply(conn, cur, migration)
+                applied_now.append(migration)
+        if target is None or target >= latest_version(migrations_dir):
+            db_manager.ensure_message_partitions()
+        if applied_now:
+            logger.info(f"Migraciones aplicadas: {', '.join(map(str, applied_now))}")
+        else:
+            logger.info("El esquema de la base de datos ya está al día.")
+        return applied_now
+    except Exception as e:
+        logger.error(f"Error al aplicar las migraciones: {e}")
+        return None
+    finally:
+        conn.close() # Libera el advisory lock
+
+
+def _apply(conn, cur, migration):
+    logger.info(f"Aplicando la migración {migration}...")
+    started = time.perf_counter()
+    if migration.transactional:
+        conn.autocommit = False
+        try:
+            migration.apply(cur)
+            _record(cur, migration, started)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+    else:
+        migration.apply(cur)
+        _record(cur, migration, started)
+
+
+def _record(cur, migration, started):
+    cur.execute(
+        "INSERT INTO schema_migrations (version, name, checksum, duration_ms) VALUES (%s, %s, %s, %s)",
+        (migration.version, migration.name, migration.checksum, int((time.perf_counter() - started) * 1000))
+    )
+
+
+def current_version(connect_timeout=None):
+    """
+    Versión aplicada en la base de datos (0 si nunca se migró), con una conexión propia y
+    una sola consulta. Devuelve None si la DB no responde.
+    """
+    try:
+        kwargs = {} if connect_timeout is None else {"connect_timeout": connect_timeout}
+        conn = psycopg2.connect(**dict(db_manager.connect_kwargs(), **kwargs))
+    except Exception as e:
+        logger.warning(f"No se pudo conectar a la DB para comprobar la versión del esquema: {e}")
+        return None
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            return cur.fetchone()[0]
+    except errors.UndefinedTable:
+        return 0
+    except Exception as e:
+        logger.warning(f"No se pudo leer la versión del esquema: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def schema_status(migrations_dir=None):
+    """Versión esperada por el código, la aplicada y las migraciones pendientes (para /api/stats)."""
+    expected = latest_version(migrations_dir)
+    current = current_version()
+    pending = None
+    if current is not None:
+        pending = [str(m) for m in discover(migrations_dir) if m.version > current]
+    return {"expected_version": expected, "current_version": current, "pending": pending,
+            "up_to_date": current is not None and current >= expected}
+
+
+def check_schema_on_startup(mode=None):
+    """
+    Comprobación de arranque de cada worker: una conexión y una consulta (ninguna con
+    SCHEMA_CHECK_ON_STARTUP=off). Con 'warn' un esquema atrasado solo se registra; con
+    'strict' lanza RuntimeError y el worker no arranca; con 'migrate' aplica las
+    migraciones pendientes (instalaciones de un solo proceso o desarrollo). Si la DB no
+    responde el worker arranca igualmente: el pool se conecta en la primera petición.
+    """
+    mode = mode or SCHEMA_CHECK_ON_STARTUP
+    if mode == "off":
+        return None
+    if mode == "migrate":
+        return upgrade()
+    started = time.perf_counter()
+    expected = latest_version()
+    current = current_version(connect_timeout=SCHEMA_CHECK_TIMEOUT)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if current is None:
+        logger.warning("Versión del esquema sin verificar: la base de datos no responde.")
+    elif current < expected:
+        message = (f"El esquema de la base de datos está en la versión {current} y el código espera la {expected}: "
+                   "ejecuta `python -m services.migrations upgrade`.")
+        if mode == "strict":
+            raise RuntimeError(message)
+        logger.error(message)
+    else:
+        logger.info(f"Esquema de la base de datos en la versión {current} (verificado en {elapsed_ms:.1f} ms).")
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    upgrade_parser = subparsers.add_parser("upgrade", help="Aplica las migraciones pendientes")
+    upgrade_parser.add_argument("--target", type=int, default=None, help="Aplicar solo hasta esta versión")
+    subparsers.add_parser("status", help="Muestra las migraciones aplicadas y pendientes")
+    args = parser.parse_args()
+    logging_setup.configure_logging()
+
+    if args.command == "upgrade":
+        return 0 if upgrade(args.target) is not None else 1
+
+    status = schema_status()
+    if status["current_version"] is None:
+        print("No se pudo leer la versión del esquema.")
+        return 1
+    print(f"Versión aplicada: {status['current_version']} (el código espera la {status['expected_version']})")
+    for name in status["pending"]:
+        print(f"Pendiente: {name}")
+    return 0 if status["up_to_date"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
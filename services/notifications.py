@@ -0,0 +1,148 @@
+# chatbot/services/notifications.py
+import os
+import select
+import socket
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+LISTENER_POLL_INTERVAL = float(os.getenv("PG_LISTENER_POLL_INTERVAL", "5")) # Segundos entre comprobaciones de la conexión
+LISTENER_RECONNECT_DELAY = float(os.getenv("PG_LISTENER_RECONNECT_DELAY", "2"))
+
+
+class PgListener:
+    """
+    Hilo que mantiene una conexión dedicada con LISTEN sobre varios canales de
+    PostgreSQL y entrega cada NOTIFY a los callbacks suscritos.
+
+    Cada worker de gunicorn tiene su propio listener, así un NOTIFY emitido por
+    cualquier proceso llega a todos. Si la conexión se pierde, al reconectar se
+    llama a los callbacks `on_reconnect` (las notificaciones perdidas no se recuperan).
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._callbacks = {}       # canal -> [callback(payload)]
+        self._reconnect_hooks = []
+        self._lock = threading.Lock()
+        self._conn = None
+        self._listening = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.pid = os.getpid()
+        self.notifications_received = 0
+
+    def subscribe(self, channel, callback, on_reconnect=None):
+        # Los canales nuevos se escuchan en la siguiente vuelta del hilo.
+        with self._lock:
+            self._callbacks.setdefault(channel, []).append(callback)
+            if on_reconnect is not None:
+                self._reconnect_hooks.append(on_reconnect)
+        self.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="pg-listener", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_listening(self):
+        return self._listening.is_set()
+
+    def wait_until_listening(self, timeout=None):
+        return self._listening.wait(timeout)
+
+    def _listen_all(self, conn):
+        with self._lock:
+            channels = list(self._callbacks)
+        with conn.cursor() as cur:
+            for channel in channels:
+                cur.execute(f'LISTEN "{channel}"')
+        return set(channels)
+
+    def _run(self):
+        first_connection = True
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                listened = self._listen_all(conn)
+                self._conn = conn
+                self._listening.set()
+                if not first_connection:
+                    # Las notificaciones emitidas mientras no había conexión se perdieron.
+                    logger.info("Listener de PostgreSQL reconectado; invalidando cachés locales.")
+                    for hook in list(self._reconnect_hooks):
+                        hook()
+                first_connection = False
+
+                while not self._stop.is_set():
+                    with self._lock:
+                        pending = set(self._callbacks) - listened
+                    if pending:
+                        listened = self._listen_all(conn)
+                    if select.select([conn], [], [], LISTENER_POLL_INTERVAL) == ([], [], []):
+                        # Sin actividad: comprobar que la conexión sigue viva.
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT 1")
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.notifications_received += 1
+                        self._dispatch(notify.channel, notify.payload)
+            except Exception as e:
+                logger.warning(f"Listener de PostgreSQL desconectado: {e}")
+            finally:
+                self._listening.clear()
+                self._conn = None
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self._stop.wait(LISTENER_RECONNECT_DELAY)
+
+    def _dispatch(self, channel, payload):
+        with self._lock:
+            callbacks = list(self._callbacks.get(channel, ()))
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.error(f"Error en el callback de NOTIFY para el canal '{channel}': {e}", exc_info=True)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_listener(connect):
+    """Devuelve el listener del proceso (uno por worker), creándolo si hace falta."""
+    global _listener
+    with _listener_lock:
+        if _listener is None or _listener.pid != os.getpid():
+            _listener = PgListener(connect)
+        return _listener
+
+
+def origin():
+    """Identificador de este proceso, para ignorar las notificaciones que emitió él mismo."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def notify(cur, channel, payload):
+    """Emite un NOTIFY dentro de la transacción del cursor; se entrega al hacer commit."""
+    cur.execute("SELECT pg_notify(%s, %s)", (channel, payload))
+
+
+def notify_many(cur, channel, payloads):
+    """Como notify, pero emite todos los payloads en un solo round trip."""
+    if payloads:
+        cur.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload", (channel, list(payloads)))
@@ -0,0 +1,63 @@
+# chatbot/services/order_notifications.py
+import logging
+import threading
+import contextvars
+
+from services import db_manager
+from services import outbound
+from services import tenants
+from services import whatsapp
+
+logger = logging.getLogger(__name__)
+
+# Mensaje al cliente por estado nuevo del pedido ({order_id} y {product} se reemplazan)
+ORDER_STATUS_MESSAGES = {
+    "confirmed": "¡Tu pedido #{order_id} ({product}) fue confirmado! Te avisaremos cuando salga.",
+    "shipped": "Tu pedido #{order_id} ({product}) ya va en camino. 🚚",
+    "delivered": "Tu pedido #{order_id} ({product}) fue entregado. ¡Gracias por tu compra!",
+    "cancelled": "Tu pedido #{order_id} ({product}) fue cancelado. Escríbenos si tienes alguna duda.",
+}
+
+
+def render_message(template, order_id, product):
+    """Compone el texto de la notificación. Lanza ValueError si la plantilla no es válida."""
+    try:
+        return template.format(order_id=order_id, product=product or "")
+    except (KeyError, IndexError, ValueError, AttributeError) as e:
+        raise ValueError(f"Plantilla de mensaje inválida: {e}")
+
+
+def queue_status_notifications(results, new_status, template=None):
+    """
+    Avisa por WhatsApp a los clientes de los pedidos actualizados (OrderStatusResult con
+    resultado 'updated'). Los envíos se encolan desde un hilo aparte en el despachador de
+    salida, así la respuesta HTTP no espera ni a la cola ni a la API. Devuelve el número
+    de notificaciones que se enviarán.
+    """
+    template = template or ORDER_STATUS_MESSAGES.get(new_status)
+    targets = [result for result in results if result.result == db_manager.ORDER_UPDATED and result.whatsapp_user_id]
+    if not template or not targets:
+        return 0
+    render_message(template, 0, "") # Validar la plantilla antes de responder
+    context = contextvars.copy_context() # Conservar el request_id en los logs de los envíos
+    threading.Thread(
+        target=context.run, args=(_enqueue_all, targets, template), name="order-notifications", daemon=True
+    ).start()
+    return len(targets)
+
+
+def _enqueue_all(targets, template):
+    failed = 0
+    for target in targets:
+        text = render_message(template, target.order_id, target.product_name)
+
+        def on_result(result, chat_id=target.chat_id, text=text):
+            # La notificación queda en el historial del chat, con su wamid para los estados de entrega
+            db_manager.save_message(chat_id, 'bot', 'text', text, wamid=whatsapp.extract_wamid(result))
+
+        # Desde el número (tenant) con el que el cliente hizo el pedido
+        tenant = tenants.get_tenant(target.tenant_id)
+        if not outbound.enqueue_text_message(target.whatsapp_user_id, text, on_result=on_result, tenant=tenant):
+            failed += 1
+    if failed:
+        logger.warning(f"No se pudieron encolar {failed} de {len(targets)} avisos de cambio de estado de pedido.")
@@ -0,0 +1,257 @@
+# chatbot/services/outbound.py
+import os
+import time
+import random
+import atexit
+import logging
+import threading
+
+import requests
+from urllib3.exceptions import ProtocolError
+
+from services import metrics
+from services import tenants
+from services import whatsapp
+from services.logging_setup import LazyJson
+from services.workers import ShardedExecutor, LatencyRecorder
+
+logger = logging.getLogger(__name__)
+
+# Configuración del despachador de mensajes salientes
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "8"))
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "1000")) # Por worker
+OUTBOUND_ENQUEUE_TIMEOUT = float(os.getenv("OUTBOUND_ENQUEUE_TIMEOUT", "1")) # Segundos
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "5"))
+OUTBOUND_BACKOFF_BASE = float(os.getenv("OUTBOUND_BACKOFF_BASE", "0.5")) # Segundos
+OUTBOUND_BACKOFF_MAX = float(os.getenv("OUTBOUND_BACKOFF_MAX", "30"))
+OUTBOUND_RATE_PER_SECOND = float(os.getenv("OUTBOUND_RATE_PER_SECOND", "80")) # Por phone_number_id y proceso (tenants sin rate_per_second)
+OUTBOUND_SHUTDOWN_TIMEOUT = float(os.getenv("OUTBOUND_SHUTDOWN_TIMEOUT", "10"))
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Resultado que recibe `on_result` si el envío falló con la petición ya enviada (timeout de
+# lectura, 5xx sin reintentar): el mensaje puede haber llegado o no.
+UNKNOWN = object()
+
+
+def failed_before_send(error):
+    """
+    Si un error de red ocurrió antes de que la petición saliera (timeout o rechazo al
+    conectar). Con cualquier otro (timeout de lectura, conexión cortada a mitad) Meta
+    puede haber aceptado el mensaje y reintentar lo enviaría dos veces.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        # "Connection aborted" (ProtocolError): la conexión se cortó con la petición ya escrita
+        cause = error.args[0] if error.args else None
+        return not isinstance(cause, ProtocolError)
+    return False
+
+
+class RateLimiter:
+    """
+    Token bucket por clave; `acquire` bloquea hasta que haya un token disponible. Cada
+    clave puede tener su propio ritmo (`rate`, p. ej. el nivel de envío de cada número).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # clave -> [tokens, último_relleno]
+        self._lock = threading.Lock()
+
+    def acquire(self, key, rate=None):
+        rate = rate or self.rate
+        if rate <= 0:
+            return 0.0
+        burst = self.burst or max(1.0, rate)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = [burst, now]
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                if bucket[0] >= 1.0:
+                    bucket[0] -= 1.0
+                    return waited
+                delay = (1.0 - bucket[0]) / rate
+            time.sleep(delay)
+            waited += delay
+
+
+class OutboundDispatcher:
+    """
+    Cola de envíos a la API de WhatsApp atendida por un pool de workers.
+
+    - Los mensajes de un mismo destinatario se envían en orden (misma cola).
+    - 429 y 5xx se reintentan con backoff exponencial (respetando Retry-After), igual que
+      los errores de red al conectar. Un error después de enviar la petición (timeout de
+      lectura) no se reintenta: el mensaje puede haber llegado.
+    - El caudal se limita por phone_number_id con un token bucket: al `rate_per_second`
+      del despachador si se indica (campañas) o, si no, al de cada tenant.
+    - Un mismo pool de workers atiende a todos los números.
+    """
+
+    def __init__(self, num_workers=OUTBOUND_WORKERS, queue_size=OUTBOUND_QUEUE_SIZE,
+                 rate_per_second=None, max_retries=OUTBOUND_MAX_RETRIES,
+                 backoff_base=OUTBOUND_BACKOFF_BASE, backoff_max=OUTBOUND_BACKOFF_MAX,
+                 post=None, retry_status_codes=RETRYABLE_STATUS_CODES):
+        self._executor = ShardedExecutor(num_workers, queue_size, name="outbound")
+        self.rate_per_second = rate_per_second
+        self._limiter = RateLimiter(rate_per_second or OUTBOUND_RATE_PER_SECOND)
+        self._post = post or whatsapp.post_message_payload
+        self.pid = os.getpid()
+        self.max_retries = max_retries
+        self.retry_status_codes = retry_status_codes
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._counters = {"sent": 0, "failed": 0, "retries": 0, "rejected": 0, "rate_limited_wait_s": 0.0}
+        self.send_time = LatencyRecorder() # Duración de cada llamada a la API
+        self.delivery_time = LatencyRecorder() # Desde que se encola hasta el resultado final (con reintentos)
+
+    def enqueue(self, recipient_phone_number, payload, tenant=None, on_result=None):
+        """
+        Encola un payload para enviarlo en segundo plano desde el número del `tenant` (por
+        defecto, el tenant por defecto). `on_result(respuesta_json | None | UNKNOWN)` se
+        llama desde el worker al terminar. Devuelve False si la cola está llena.
+        """
+        if payload is None:
+            return False
+        tenant = tenant or tenants.default_tenant()
+        if not tenant.is_configured:
+            logger.error(f"El tenant {tenant.id} ({tenant.name}) no tiene phone_number_id o token configurados.")
+            metrics.SEND_FAILURES.inc("not_configured")
+            return False
+        try:
+            self._executor.submit(
+                (tenant.phone_number_id, recipient_phone_number), self._deliver, recipient_phone_number, payload,
+                tenant, on_result, time.monotonic(), timeout=OUTBOUND_ENQUEUE_TIMEOUT,
+            )
+            return True
+        except Exception as e:
+            self._count("rejected")
+            metrics.SEND_FAILURES.inc("queue_full")
+            logger.error(f"No se pudo encolar el mensaje para {recipient_phone_number}: {e}")
+            return False
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._counters[key] += value
+
+    def _backoff(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(self.backoff_max, float(retry_after))
+            except ValueError:
+                pass
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2) # Jitter para no sincronizar reintentos
+
+    def _deliver(self, recipient_phone_number, payload, tenant, on_result, enqueued_at):
+        result = None
+        ambiguous = False # La petición salió y no hay respuesta válida: puede haber llegado
+        body = whatsapp.serialize_payload(payload) # Serializar una vez para todos los intentos
+        phone_number_id, access_token = tenant.phone_number_id, tenant.access_token
+        rate = self.rate_per_second or tenant.rate_per_second
+        for attempt in range(self.max_retries + 1):
+            waited = self._limiter.acquire(phone_number_id, rate)
+            if waited:
+                self._count("rate_limited_wait_s", waited)
+            response = None
+            try:
+                started = time.monotonic()
+                response = self._post(payload, phone_number_id=phone_number_id, body=body, access_token=access_token)
+                self.send_time.record(time.monotonic() - started)
+                if response.status_code < 300:
+                    try:
+                        result = response.json()
+                    except ValueError:
+                        # Meta aceptó el mensaje aunque la respuesta no se pueda leer (sin wamid)
+                        logger.warning(f"Mensaje a {recipient_phone_number} aceptado con una respuesta ilegible: {response.text[:200]!r}")
+                        result = {}
+                    self._count("sent")
+                    metrics.MESSAGES_SENT.inc()
+                    logger.info("Mensaje enviado a %s. Respuesta: %s", recipient_phone_number, LazyJson(result), extra={"event": "outbound_sent"})
+                    break
+                if response.status_code not in self.retry_status_codes:
+                    ambiguous = response.status_code >= 500
+                    logger.error(f"Error enviando mensaje a {recipient_phone_number}: HTTP {response.status_code} - {response.text}")
+                    break
+                logger.warning(f"Envío a {recipient_phone_number} rechazado con HTTP {response.status_code} (intento {attempt + 1}).")
+            except requests.exceptions.RequestException as e:
+                if not failed_before_send(e):
+                    ambiguous = True
+                    logger.error(f"Error de red enviando a {recipient_phone_number} con la petición ya enviada; no se reintenta: {e}")
+                    break
+                logger.warning(f"Error de red enviando a {recipient_phone_number} (intento {attempt + 1}): {e}")
+            if attempt < self.max_retries:
+                self._count("retries")
+                time.sleep(self._backoff(attempt, response))
+        if result is None:
+            self._count("failed")
+            metrics.SEND_FAILURES.inc(whatsapp.failure_reason(response))
+        self.delivery_time.record(time.monotonic() - enqueued_at)
+        if on_result is not None:
+            on_result(UNKNOWN if result is None and ambiguous else result)
+
+    def shutdown(self, timeout=OUTBOUND_SHUTDOWN_TIMEOUT):
+        """Espera a que se envíen los mensajes pendientes antes de salir."""
+        return self._executor.shutdown(drain=True, timeout=timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["rate_limited_wait_s"] = round(stats["rate_limited_wait_s"], 3)
+        stats["queue"] = self._executor.stats()
+        stats["send_time"] = self.send_time.stats()
+        stats["delivery_time"] = self.delivery_time.stats()
+        return stats
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """
+    Devuelve el despachador del proceso, creándolo en el primer uso. Tras un fork
+    (gunicorn --preload) se crea otro: los hilos de los workers no pasan al hijo.
+    """
+    global _dispatcher
+    dispatcher = _dispatcher
+    if dispatcher is not None and dispatcher.pid == os.getpid():
+        return dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None or _dispatcher.pid != os.getpid():
+            _dispatcher = OutboundDispatcher()
+            atexit.register(_dispatcher.shutdown)
+        return _dispatcher
+
+
+def enqueue_text_message(recipient_phone_number, text, on_result=None, tenant=None):
+    payload = whatsapp.build_text_payload(recipient_phone_number, text)
+    return get_dispatcher().enqueue(recipient_phone_number, payload, tenant=tenant, on_result=on_result)
+
+
+def enqueue_interactive_buttons_message(recipient_phone_number, body_text, buttons, header_text=None, footer_text=None, on_result=None, tenant=None):
+    payload = whatsapp.build_interactive_buttons_payload(recipient_phone_number, body_text, buttons, header_text, footer_text)
+    return get_dispatcher().enqueue(recipient_phone_number, payload, tenant=tenant, on_result=on_result)
+
+
+def enqueue_interactive_list_message(recipient_phone_number, body_text, list_button_title, sections, header_text=None, footer_text=None, on_result=None, tenant=None):
+    payload = whatsapp.build_interactive_list_payload(recipient_phone_number, body_text, list_button_title, sections, header_text, footer_text)
+    return get_dispatcher().enqueue(recipient_phone_number, payload, tenant=tenant, on_result=on_result)
+
+
+def get_stats():
+    """Estadísticas del despachador sin crearlo (para /metrics y /api/stats)."""
+    dispatcher = _dispatcher
+    if dispatcher is None or dispatcher.pid != os.getpid():
+        return {"sent": 0, "failed": 0, "queue": {"queue_depth": 0}}
+    return dispatcher.stats()
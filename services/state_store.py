@@ -0,0 +1,322 @@
+# chatbot/services/state_store.py
+import os
+import abc
+import json
+import time
+import logging
+import threading
+
+from services import db_manager
+from services import notifications
+from services.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Configuración del almacén de estado conversacional (flujo de pedido de cada usuario)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "write_through") # 'memory', 'postgres' o 'write_through'
+STATE_TTL = int(os.getenv("STATE_TTL", "86400")) # Segundos sin actividad antes de descartar un flujo abandonado
+STATE_CACHE_MAX_SIZE = int(os.getenv("STATE_CACHE_MAX_SIZE", "50000"))
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "300")) # Segundos en la caché en memoria del modo write_through
+STATE_PURGE_INTERVAL = float(os.getenv("STATE_PURGE_INTERVAL", "300")) # Segundos entre borrados de estados expirados
+
+_NO_STATE = object() # Marca en caché de "el usuario no tiene flujo en curso"
+
+
+class ConversationState:
+    """Estado del flujo de un usuario. Con __slots__ cada instancia ocupa lo mínimo."""
+
+    __slots__ = ("action", "step", "order_details")
+
+    def __init__(self, action, step, order_details=None):
+        self.action = action
+        self.step = step
+        self.order_details = order_details if order_details is not None else {}
+
+    def copy(self):
+        return ConversationState(self.action, self.step, dict(self.order_details))
+
+    def to_json(self):
+        return json.dumps(
+            {"action": self.action, "step": self.step, "order_details": self.order_details},
+            ensure_ascii=False, separators=(",", ":")
+        )
+
+    @classmethod
+    def from_json(cls, value):
+        if isinstance(value, str):
+            value = json.loads(value)
+        return cls(value.get("action"), value.get("step"), value.get("order_details"))
+
+    def __repr__(self):
+        return f"ConversationState(action={self.action!r}, step={self.step!r})"
+
+
+class StateStore(abc.ABC):
+    """
+    Interfaz de los almacenes de estado conversacional.
+
+    Las claves son tuplas (tenant_id, usuario): el mismo cliente puede tener un flujo en
+    curso con cada número. Además de `get`/`set`/`delete`, el pipeline de mensajes agrupa
+    los cambios de un payload en un dict clave -> estado (None para borrarlo) y los confirma junto con
+    los mensajes: `prepare(changes)` devuelve las filas que se escriben en esa
+    transacción, como pares (db_manager.STATE_ROW, fila), o None; `committed(changes)`
+    se llama cuando se confirmó.
+    """
+
+    @abc.abstractmethod
+    def get(self, key):
+        """Devuelve el estado de la clave o None."""
+
+    @abc.abstractmethod
+    def set(self, key, state):
+        """Guarda el estado de la clave."""
+
+    @abc.abstractmethod
+    def delete(self, key):
+        """Borra el estado de la clave."""
+
+    def prepare(self, changes):
+        return None
+
+    def committed(self, changes):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class MemoryStateStore(StateStore):
+    """Estados en memoria del proceso (LRU + TTL). No se comparte entre workers."""
+
+    def __init__(self, maxsize=STATE_CACHE_MAX_SIZE, ttl=STATE_TTL):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, state):
+        self.cache.set(key, state)
+
+    def delete(self, key):
+        self.cache.invalidate(key)
+
+    def committed(self, changes):
+        for key, state in changes.items():
+            if state is None:
+                self.delete(key)
+            else:
+                self.set(key, state)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class PostgresStateStore(StateStore):
+    """
+    Estados en la tabla `conversation_states`, compartidos por todos los workers y
+    persistentes entre reinicios. Los expirados se ignoran al leer y se borran en lote
+    como mucho cada STATE_PURGE_INTERVAL segundos (índice sobre expires_at).
+    """
+
+    def __init__(self, ttl=STATE_TTL, purge_interval=STATE_PURGE_INTERVAL):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._last_purge = time.monotonic()
+        self._lock = threading.Lock()
+        self._counters = {"reads": 0, "writes": 0, "purged": 0}
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._counters[key] += value
+
+    def get(self, key):
+        tenant_id, user_id = key
+        self._count("reads")
+        conn = db_manager.get_db_connection()
+        if not conn:
+            return None
+        try:
+            conn.autocommit = True # Una sola sentencia: sin BEGIN/COMMIT adicionales
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT state FROM conversation_states "
+                    "WHERE tenant_id = %s AND whatsapp_user_id = %s AND expires_at > CURRENT_TIMESTAMP",
+                    (tenant_id, user_id)
+                )
+                row = cur.fetchone()
+                return ConversationState.from_json(row[0]) if row else None
+        except Exception as e:
+            logger.error(f"Error al leer el estado conversacional de {user_id} (tenant {tenant_id}): {e}")
+            return None
+        finally:
+            db_manager.release_db_connection(conn)
+
+    def set(self, key, state):
+        self._write({key: state})
+
+    def delete(self, key):
+        self._write({key: None})
+
+    def _write(self, changes):
+        """Escribe cambios fuera del pipeline de mensajes (misma sentencia que save_messages)."""
+        return db_manager.save_messages([], self.prepare(changes))
+
+    def prepare(self, changes):
+        self._count("writes", len(changes))
+        return [
+            (db_manager.STATE_ROW, (*key, state.to_json() if state is not None else None, self.ttl))
+            for key, state in changes.items()
+        ]
+
+    def committed(self, changes):
+        self.purge_expired()
+
+    def purge_expired(self, force=False):
+        """Borra los estados expirados (como mucho una vez por intervalo)."""
+        with self._lock:
+            if not force and time.monotonic() - self._last_purge < self.purge_interval:
+                return 0
+            self._last_purge = time.monotonic()
+        conn = db_manager.get_db_connection()
+        if not conn:
+            return 0
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM conversation_states WHERE expires_at <= CURRENT_TIMESTAMP")
+                purged = cur.rowcount
+        except Exception as e:
+            logger.error(f"Error al borrar estados conversacionales expirados: {e}")
+            return 0
+        finally:
+            db_manager.release_db_connection(conn)
+        if purged:
+            self._count("purged", purged)
+            logger.info(f"{purged} estados conversacionales expirados eliminados.")
+        return purged
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+class WriteThroughStateStore(StateStore):
+    """
+    Caché en memoria delante de Postgres. Las escrituras van a la DB y después a la
+    caché; los demás workers invalidan su copia con LISTEN/NOTIFY. Como la caché de
+    chats, solo se usa mientras el listener está conectado.
+    """
+
+    def __init__(self, postgres, memory):
+        self.postgres = postgres
+        self.memory = memory
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def _on_invalidation(self, payload):
+        # "origen tenant_id usuario"; sin tenant (workers anteriores a la migración 0002) es el por defecto
+        sender, _, rest = payload.partition(" ")
+        tenant_id, _, user_id = rest.rpartition(" ")
+        if sender != notifications.origin(): # Los cambios propios ya están en la caché
+            self.memory.delete((int(tenant_id or db_manager.DEFAULT_TENANT_ID), user_id))
+
+    def _cache_active(self):
+        listener = notifications.get_listener(db_manager.open_dedicated_connection)
+        if listener is not self._listener:
+            with self._lock:
+                if listener is not self._listener:
+                    self.memory.cache.clear()
+                    listener.subscribe(
+                        db_manager.CONVERSATION_STATE_CHANNEL, self._on_invalidation, on_reconnect=self.memory.cache.clear
+                    )
+                    self._listener = listener
+        return listener.is_listening()
+
+    def get(self, key):
+        use_cache = self._cache_active()
+        if use_cache:
+            cached = self.memory.cache.get(key)
+            if cached is not None:
+                return None if cached is _NO_STATE else cached
+        epoch = self.memory.cache.epoch
+        state = self.postgres.get(key)
+        if use_cache:
+            # También se cachea la ausencia de estado: es el caso más frecuente.
+            self.memory.cache.set(key, _NO_STATE if state is None else state, epoch=epoch)
+        return state
+
+    def set(self, key, state):
+        self.postgres.set(key, state)
+        self.committed({key: state})
+
+    def delete(self, key):
+        self.postgres.delete(key)
+        self.committed({key: None})
+
+    def prepare(self, changes):
+        return self.postgres.prepare(changes)
+
+    def committed(self, changes):
+        if self._cache_active():
+            for key, state in changes.items():
+                self.memory.cache.set(key, _NO_STATE if state is None else state)
+        self.postgres.committed(changes)
+
+    def stats(self):
+        stats = {"cache": self.memory.stats(), "postgres": self.postgres.stats()}
+        stats["cache"]["listening"] = self._listener is not None and self._listener.is_listening()
+        return stats
+
+
+def create_store(backend=STATE_BACKEND):
+    if backend == "memory":
+        return MemoryStateStore()
+    if backend == "postgres":
+        return PostgresStateStore()
+    if backend == "write_through":
+        return WriteThroughStateStore(PostgresStateStore(), MemoryStateStore(ttl=STATE_CACHE_TTL))
+    raise ValueError(f"Backend de estado conversacional desconocido: {backend!r}")
+
+
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Devuelve el almacén de estado del proceso, creándolo en el primer uso."""
+    global _store, _store_pid
+    if _store is None or _store_pid != os.getpid():
+        with _store_lock:
+            if _store is None or _store_pid != os.getpid():
+                _store = create_store()
+                _store_pid = os.getpid()
+    return _store
+
+
+def load(key, pending=None):
+    """
+    Devuelve una copia del estado de la clave (tenant_id, usuario) o None. `pending` son los cambios aún no
+    confirmados del payload en curso, que tienen prioridad sobre lo guardado.
+    """
+    if pending is not None and key in pending:
+        state = pending[key]
+    else:
+        state = get_store().get(key)
+    return state.copy() if state is not None else None
+
+
+def save(key, state, pending=None):
+    """Guarda (o borra, con `state=None`) el estado; si hay `pending`, se difiere al commit de los mensajes."""
+    if pending is not None:
+        pending[key] = state
+    elif state is None:
+        get_store().delete(key)
+    else:
+        get_store().set(key, state)
+
+
+def get_stats():
+    stats = get_store().stats()
+    stats["backend"] = STATE_BACKEND
+    return stats
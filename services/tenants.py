@@ -0,0 +1,324 @@
+# chatbot/services/tenants.py
+"""
+Varios números de WhatsApp (tenants) servidos por el mismo despliegue.
+
+Cada tenant tiene su phone_number_id, su token, su archivo de flujo y su límite de envío
+(tabla `tenants`, migración 0002). Los webhooks se enrutan por `metadata.phone_number_id`
+y chats, pedidos, estados conversacionales y campañas llevan su `tenant_id`.
+
+La configuración de todos los tenants se lee de una vez y se guarda en memoria: buscar el
+tenant de un mensaje no consulta la DB. Se vuelve a leer cada TENANT_CACHE_TTL segundos o
+al recibir un NOTIFY por un cambio hecho desde la API. El tenant 1 ('default') usa
+WHATSAPP_PHONE_NUMBER_ID y WHATSAPP_ACCESS_TOKEN del entorno si no tiene valores propios.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+from psycopg2 import errors
+
+from services import db_manager
+from services import flow_engine
+from services import notifications
+from services import whatsapp
+
+logger = logging.getLogger(__name__)
+
+# Configuración de los tenants
+TENANT_CACHE_TTL = float(os.getenv("TENANT_CACHE_TTL", "60")) # Segundos entre relecturas de la tabla tenants
+TENANT_RETRY_INTERVAL = float(os.getenv("TENANT_RETRY_INTERVAL", "5")) # Segundos antes de reintentar si la DB no respondió
+TENANT_UNKNOWN_NUMBER = os.getenv("TENANT_UNKNOWN_NUMBER", "default").lower() # 'default' o 'reject': números sin tenant
+TENANT_CACHE_CHANNEL = "tenant_invalidate"
+
+_COLUMNS = "id, name, phone_number_id, access_token, flow_file, rate_per_second, is_active"
+_UPDATABLE = ("name", "phone_number_id", "access_token", "flow_file", "rate_per_second", "is_active")
+
+
+class Tenant:
+    """
+    Configuración de un número. `phone_number_id` y `access_token` se resuelven contra
+    el entorno al leerlos, así el tenant por defecto sigue los cambios de configuración.
+    """
+
+    __slots__ = ("id", "name", "_phone_number_id", "_access_token", "flow_file", "rate_per_second", "is_active")
+
+    def __init__(self, id, name, phone_number_id=None, access_token=None, flow_file=None,
+                 rate_per_second=None, is_active=True):
+        self.id = id
+        self.name = name
+        self._phone_number_id = phone_number_id
+        self._access_token = access_token
+        self.flow_file = flow_file
+        self.rate_per_second = rate_per_second
+        self.is_active = is_active
+
+    @property
+    def phone_number_id(self):
+        if self._phone_number_id is None and self.id == db_manager.DEFAULT_TENANT_ID:
+            return whatsapp.WHATSAPP_PHONE_NUMBER_ID
+        return self._phone_number_id
+
+    @property
+    def access_token(self):
+        return self._access_token or whatsapp.WHATSAPP_TOKEN
+
+    @property
+    def is_configured(self):
+        """Si tiene número y token para enviar mensajes."""
+        return bool(self.phone_number_id and self.access_token)
+
+    def to_dict(self):
+        """Representación para la API (sin el token)."""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "phone_number_id": self.phone_number_id,
+            "has_own_access_token": self._access_token is not None,
+            "flow_file": self.flow_file,
+            "rate_per_second": self.rate_per_second,
+            "is_active": self.is_active,
+            "is_configured": self.is_configured,
+        }
+
+    def __repr__(self):
+        return f"Tenant(id={self.id!r}, name={self.name!r})"
+
+
+def _env_default():
+    # Si la tabla no se puede leer, el despliegue sigue funcionando con un solo número.
+    return Tenant(db_manager.DEFAULT_TENANT_ID, "default")
+
+
+class TenantRegistry:
+    """
+    Instantánea en memoria de la tabla `tenants`, indexada por id y por phone_number_id.
+    Si la relectura falla se mantiene la instantánea anterior.
+    """
+
+    def __init__(self, ttl=TENANT_CACHE_TTL, retry_interval=TENANT_RETRY_INTERVAL):
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._by_id = {db_manager.DEFAULT_TENANT_ID: _env_default()}
+        self._by_phone = {}
+        self._expires_at = 0.0
+        self._loaded = False
+        self._listener = None
+        self._counters = {"reloads": 0, "load_errors": 0, "unknown_numbers": 0}
+
+    def invalidate(self, payload=None):
+        self._expires_at = 0.0
+
+    def _subscribe(self):
+        listener = notifications.get_listener(db_manager.open_dedicated_connection)
+        if listener is not self._listener:
+            listener.subscribe(TENANT_CACHE_CHANNEL, self.invalidate, on_reconnect=self.invalidate)
+            self._listener = listener
+
+    def _refresh(self):
+        if time.monotonic() < self._expires_at:
+            return
+        # Otro hilo ya la está releyendo: mientras, vale la instantánea actual (salvo en la
+        # primera carga, en la que todavía no hay ninguna)
+        if not self._lock.acquire(blocking=not self._loaded):
+            return
+        if time.monotonic() < self._expires_at:
+            self._lock.release()
+            return
+        try:
+            self._subscribe()
+            self._reload()
+        finally:
+            self._lock.release()
+
+    def _reload(self):
+        conn = db_manager.get_db_connection()
+        if not conn:
+            self._failed("sin conexión")
+            return
+        try:
+            conn.autocommit = True # Una sola sentencia: sin BEGIN/COMMIT adicionales
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT {_COLUMNS} FROM tenants")
+                rows = cur.fetchall()
+        except Exception as e:
+            self._failed(e)
+            return
+        finally:
+            db_manager.release_db_connection(conn)
+        by_id = {row[0]: Tenant(*row) for row in rows}
+        by_id.setdefault(db_manager.DEFAULT_TENANT_ID, _env_default())
+        # Se reemplazan los dos índices de una vez: los lectores no toman el lock.
+        self._by_phone = {t._phone_number_id: t for t in by_id.values() if t._phone_number_id}
+        self._by_id = by_id
+        self._loaded = True
+        self._expires_at = time.monotonic() + self.ttl
+        self._counters["reloads"] += 1
+        logger.debug(f"{len(by_id)} tenants cargados.")
+
+    def _failed(self, error):
+        self._counters["load_errors"] += 1
+        self._expires_at = time.monotonic() + self.retry_interval
+        logger.warning(f"No se pudo leer la tabla de tenants; se mantiene la configuración anterior: {error}")
+
+    def get(self, tenant_id):
+        self._refresh()
+        return self._by_id.get(tenant_id)
+
+    def for_phone_number(self, phone_number_id, unknown=TENANT_UNKNOWN_NUMBER):
+        """
+        Tenant al que pertenece un número entrante, o None si el mensaje no debe
+        procesarse (tenant inactivo o número desconocido con TENANT_UNKNOWN_NUMBER=reject).
+        """
+        self._refresh()
+        tenant = self._by_phone.get(phone_number_id) if phone_number_id else None
+        if tenant is None:
+            default = self._by_id.get(db_manager.DEFAULT_TENANT_ID)
+            if phone_number_id is None or phone_number_id == default.phone_number_id:
+                tenant = default
+            else:
+                self._counters["unknown_numbers"] += 1
+                if unknown != "default":
+                    return None
+                tenant = default
+        return tenant if tenant.is_active else None
+
+    def all(self):
+        self._refresh()
+        return sorted(self._by_id.values(), key=lambda tenant: tenant.id)
+
+    def stats(self):
+        return dict(self._counters, tenants=len(self._by_id), numbers=len(self._by_phone))
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Devuelve el registro de tenants del proceso, creándolo en el primer uso."""
+    global _registry
+    registry = _registry
+    if registry is not None and registry.pid == os.getpid():
+        return registry
+    with _registry_lock:
+        if _registry is None or _registry.pid != os.getpid():
+            _registry = TenantRegistry()
+        return _registry
+
+
+def get_tenant(tenant_id):
+    """Devuelve el Tenant con ese id o None si no existe."""
+    return get_registry().get(tenant_id)
+
+
+def default_tenant():
+    return get_registry().get(db_manager.DEFAULT_TENANT_ID)
+
+
+def for_phone_number(phone_number_id):
+    """Tenant de un mensaje entrante según el `metadata.phone_number_id` del webhook (ver TenantRegistry)."""
+    return get_registry().for_phone_number(phone_number_id)
+
+
+def list_tenants():
+    return get_registry().all()
+
+
+def _validate(fields):
+    """Normaliza los campos de un tenant. Lanza ValueError si alguno no es válido."""
+    unknown = set(fields) - set(_UPDATABLE)
+    if unknown:
+        raise ValueError(f"Campos desconocidos: {', '.join(sorted(unknown))}")
+    if "name" in fields and not (isinstance(fields["name"], str) and fields["name"].strip()):
+        raise ValueError("El nombre del tenant no puede estar vacío.")
+    for key in ("phone_number_id", "access_token", "flow_file"):
+        if fields.get(key) is not None and not isinstance(fields[key], str):
+            raise ValueError(f"{key} debe ser un texto.")
+    if fields.get("rate_per_second") is not None:
+        try:
+            fields["rate_per_second"] = float(fields["rate_per_second"])
+        except (TypeError, ValueError):
+            raise ValueError(f"rate_per_second inválido: {fields['rate_per_second']!r}")
+        if fields["rate_per_second"] <= 0:
+            raise ValueError("rate_per_second debe ser mayor que 0.")
+    if "is_active" in fields and not isinstance(fields["is_active"], bool):
+        raise ValueError("is_active debe ser true o false.")
+    if fields.get("flow_file"):
+        # Un flujo inválido se rechaza aquí y no al llegar el primer mensaje
+        path = flow_engine.flow_path(fields["flow_file"])
+        try:
+            with open(path, encoding="utf-8") as f:
+                flow_engine.compile_flow(json.load(f))
+        except (OSError, ValueError, KeyError) as e:
+            raise ValueError(f"Archivo de flujo inválido ({fields['flow_file']}): {e}")
+    return fields
+
+
+def _write(query, params):
+    conn = db_manager.get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            row = cur.fetchone()
+            if row is not None:
+                notifications.notify(cur, TENANT_CACHE_CHANNEL, str(row[0]))
+            conn.commit()
+            get_registry().invalidate()
+            return Tenant(*row) if row is not None else False
+    except errors.UniqueViolation:
+        conn.rollback()
+        raise ValueError("Ya existe un tenant con ese phone_number_id.")
+    except Exception as e:
+        logger.error(f"Error al guardar el tenant: {e}")
+        conn.rollback()
+        return None
+    finally:
+        db_manager.release_db_connection(conn)
+
+
+def create_tenant(name, phone_number_id, **fields):
+    """
+    Registra un número. Devuelve el Tenant creado o None si hubo un error. Lanza
+    ValueError si los datos no son válidos o el número ya existe.
+    """
+    if not phone_number_id:
+        raise ValueError("Se requiere el phone_number_id del número.")
+    fields = _validate(dict(fields, name=name, phone_number_id=phone_number_id))
+    columns = list(fields)
+    query = (f"INSERT INTO tenants ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) "
+             f"RETURNING {_COLUMNS}")
+    tenant = _write(query, [fields[column] for column in columns])
+    if tenant:
+        logger.info(f"Tenant {tenant.id} ({tenant.name}) creado para el número {tenant.phone_number_id}.")
+    return tenant
+
+
+def update_tenant(tenant_id, **fields):
+    """
+    Cambia la configuración de un tenant. Devuelve el Tenant actualizado, False si no existe
+    o None si hubo un error. Lanza ValueError si los datos no son válidos.
+    """
+    fields = _validate(fields)
+    if not fields:
+        raise ValueError("No hay campos que actualizar.")
+    if tenant_id != db_manager.DEFAULT_TENANT_ID and "phone_number_id" in fields and not fields["phone_number_id"]:
+        raise ValueError("Solo el tenant por defecto puede usar el número del entorno.")
+    assignments = ", ".join(f"{column} = %s" for column in fields)
+    query = f"UPDATE tenants SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING {_COLUMNS}"
+    tenant = _write(query, [*fields.values(), tenant_id])
+    if tenant:
+        logger.info(f"Tenant {tenant_id} actualizado: {', '.join(fields)}")
+    return tenant
+
+
+def get_stats():
+    registry = _registry
+    if registry is None or registry.pid != os.getpid():
+        return {"tenants": 0}
+    return registry.stats()
@@ -0,0 +1,57 @@
+# chatbot/services/triage.py
+import threading
+
+# Clases de payload del webhook
+MESSAGE = "message" # Trae al menos un mensaje de usuario: pasa por el pipeline del bot
+STATUS = "status" # Solo estados de entrega (sent/delivered/read/failed)
+UNSUPPORTED = "unsupported" # Otros eventos de la cuenta: se confirman y se ignoran
+
+# Clave que se añade a cada mensaje con el `metadata.phone_number_id` de su `value`: el
+# número (tenant) que lo recibió. No viene de Meta; se guarda con el mensaje en el inbox
+# para enrutarlo también al recuperarlo.
+ROUTING_KEY = "_phone_number_id"
+
+
+class Triage:
+    """Resultado de clasificar un payload: su clase y los mensajes y estados que trae."""
+
+    __slots__ = ("kind", "messages", "statuses")
+
+    def __init__(self, kind, messages, statuses):
+        self.kind = kind
+        self.messages = messages
+        self.statuses = statuses
+
+
+_counters = {MESSAGE: 0, STATUS: 0, UNSUPPORTED: 0}
+_counters_lock = threading.Lock()
+
+
+def classify(data):
+    """
+    Clasifica un payload del webhook sin tocar la base de datos ni el bot. Devuelve None
+    si no es un evento de una cuenta de WhatsApp Business. Cada mensaje se marca con el
+    número que lo recibió (ROUTING_KEY).
+    """
+    if not isinstance(data, dict) or data.get("object") != "whatsapp_business_account":
+        return None
+    messages, statuses = [], []
+    for entry in data.get("entry") or ():
+        for change in entry.get("changes") or ():
+            if change.get("field") != "messages":
+                continue
+            value = change.get("value") or {}
+            phone_number_id = (value.get("metadata") or {}).get("phone_number_id")
+            for message in value.get("messages") or ():
+                message[ROUTING_KEY] = phone_number_id
+                messages.append(message)
+            statuses.extend(value.get("statuses") or ())
+    kind = MESSAGE if messages else STATUS if statuses else UNSUPPORTED
+    with _counters_lock:
+        _counters[kind] += 1
+    return Triage(kind, messages, statuses)
+
+
+def get_stats():
+    with _counters_lock:
+        return dict(_counters)
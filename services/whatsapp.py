@@ -2,53 +2,176 @@
 import requests
 import json
 import os
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from requests.adapters import HTTPAdapter
+
+from services import metrics
+from services.logging_setup import LazyJson
 
 logger = logging.getLogger(__name__)
 
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_ACCESS_TOKEN")
 WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
 WHATSAPP_API_VERSION = os.getenv("WHATSAPP_API_VERSION", "v19.0") # O la versión que uses
+WHATSAPP_API_BASE_URL = os.getenv("WHATSAPP_API_BASE_URL", "https://graph.facebook.com") # Permite apuntar a un servidor falso en pruebas
+
+# Configuración del cliente HTTP (sesión keep-alive compartida por todos los hilos)
+WHATSAPP_HTTP_POOL_SIZE = int(os.getenv("WHATSAPP_HTTP_POOL_SIZE", "32")) # Conexiones keep-alive por host
+WHATSAPP_CONNECT_TIMEOUT = float(os.getenv("WHATSAPP_CONNECT_TIMEOUT", "3.05")) # Segundos
+WHATSAPP_READ_TIMEOUT = float(os.getenv("WHATSAPP_READ_TIMEOUT", "10")) # Segundos
+WHATSAPP_BATCH_CONCURRENCY = int(os.getenv("WHATSAPP_BATCH_CONCURRENCY", "16"))
 
-def send_whatsapp_message_payload(recipient_phone_number, message_payload):
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def get_session():
     """
-    Envía un payload de mensaje genérico a través de la API de WhatsApp Cloud.
+    Devuelve la sesión HTTP del proceso. Reutiliza las conexiones TLS con
+    graph.facebook.com en lugar de hacer un handshake nuevo por mensaje.
     """
-    if not WHATSAPP_TOKEN or not WHATSAPP_PHONE_NUMBER_ID:
-        logger.error("WHATSAPP_TOKEN o WHATSAPP_PHONE_NUMBER_ID no están configurados.")
-        return None
+    global _session, _session_pid
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            # Sin reintentos a nivel de urllib3: los reintentos los decide outbound.py.
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=WHATSAPP_HTTP_POOL_SIZE, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session, _session_pid = session, os.getpid()
+        return _session
 
-    url = f"https://graph.facebook.com/{WHATSAPP_API_VERSION}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
+@lru_cache(maxsize=1024)
+def _request_state(base_url, api_version, phone_number_id, token):
+    """URL y cabeceras precalculadas por número y token (se construyen una sola vez por tenant)."""
+    url = f"{base_url}/{api_version}/{phone_number_id}/messages"
     headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
+        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
     }
-    
+    return url, headers
+
+def serialize_payload(message_payload):
+    """Serializa el payload a bytes una sola vez (JSON compacto en UTF-8)."""
+    return json.dumps(message_payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def post_message_payload(message_payload, phone_number_id=None, body=None, access_token=None):
+    """
+    Envía el payload a la API de WhatsApp Cloud y devuelve la respuesta HTTP sin interpretarla.
+    `phone_number_id` y `access_token` son los del tenant (por defecto, los del entorno); todos
+    los números comparten la sesión HTTP y sus conexiones keep-alive con graph.facebook.com.
+    `body` permite pasar el payload ya serializado. Lanza requests.exceptions.RequestException
+    si falla la conexión o se agota el tiempo de espera.
+    """
+    url, headers = _request_state(
+        WHATSAPP_API_BASE_URL, WHATSAPP_API_VERSION, phone_number_id or WHATSAPP_PHONE_NUMBER_ID, access_token or WHATSAPP_TOKEN
+    )
+    if body is None:
+        body = serialize_payload(message_payload)
+    started = time.perf_counter()
+    outcome = "error" # Sin respuesta HTTP (conexión o tiempo de espera)
+    try:
+        response = get_session().post(
+            url, headers=headers, data=body, timeout=(WHATSAPP_CONNECT_TIMEOUT, WHATSAPP_READ_TIMEOUT)
+        )
+        outcome = f"{response.status_code // 100}xx"
+        return response
+    finally:
+        metrics.GRAPH_API_SECONDS.observe(time.perf_counter() - started, outcome)
+
+def send_whatsapp_message_payload(recipient_phone_number, message_payload, phone_number_id=None, access_token=None):
+    """
+    Envía un payload de mensaje genérico a través de la API de WhatsApp Cloud, desde el
+    número indicado (por defecto, el del entorno).
+    """
+    if not (access_token or WHATSAPP_TOKEN) or not (phone_number_id or WHATSAPP_PHONE_NUMBER_ID):
+        logger.error("WHATSAPP_TOKEN o WHATSAPP_PHONE_NUMBER_ID no están configurados.")
+        metrics.SEND_FAILURES.inc("not_configured")
+        return None
+
     try:
-        logger.debug(f"Enviando a {recipient_phone_number} payload: {json.dumps(message_payload, indent=2)}")
-        response = requests.post(url, headers=headers, data=json.dumps(message_payload))
+        body = serialize_payload(message_payload)
+        logger.debug("Enviando a %s payload: %s", recipient_phone_number, LazyJson(message_payload))
+        response = post_message_payload(message_payload, phone_number_id=phone_number_id, body=body, access_token=access_token)
         response.raise_for_status() 
-        logger.info(f"Mensaje enviado a {recipient_phone_number}. Respuesta: {response.json()}")
-        return response.json()
+        result = response.json()
+        metrics.MESSAGES_SENT.inc()
+        logger.info("Mensaje enviado a %s. Respuesta: %s", recipient_phone_number, LazyJson(result), extra={"event": "outbound_sent"})
+        return result
     except requests.exceptions.RequestException as e:
+        metrics.SEND_FAILURES.inc(failure_reason(e.response))
         logger.error(f"Error enviando mensaje a {recipient_phone_number}: {e}")
         if e.response is not None:
             logger.error(f"Detalles del error: {e.response.text}")
         return None
 
-def send_text_message(recipient_phone_number, text):
-    payload = {
+def failure_reason(response):
+    """Motivo de un envío fallido para las métricas: `http_<código>` o `network`."""
+    return f"http_{response.status_code}" if response is not None else "network"
+
+def extract_wamid(result):
+    """Devuelve el wamid del mensaje enviado a partir de la respuesta de la API (o None)."""
+    try:
+        return result["messages"][0]["id"]
+    except (TypeError, KeyError, IndexError):
+        return None
+
+def send_payloads_batch(messages, max_workers=WHATSAPP_BATCH_CONCURRENCY, phone_number_id=None, access_token=None):
+    """
+    Envía muchos payloads en paralelo sobre la sesión compartida, todos desde el mismo
+    número (`phone_number_id` y `access_token` del tenant; por defecto, los del entorno).
+    `messages` es una lista de tuplas (recipient_phone_number, payload).
+    Devuelve los resultados en el mismo orden (respuesta JSON o None si falló).
+    """
+    messages = list(messages)
+    if not messages:
+        return []
+    workers = max(1, min(max_workers, len(messages)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wa-batch") as executor:
+        return list(executor.map(
+            lambda item: send_whatsapp_message_payload(*item, phone_number_id=phone_number_id, access_token=access_token),
+            messages,
+        ))
+
+def build_text_payload(recipient_phone_number, text):
+    return {
         "messaging_product": "whatsapp",
         "to": recipient_phone_number,
         "type": "text",
         "text": {"body": text},
     }
-    return send_whatsapp_message_payload(recipient_phone_number, payload)
 
-def send_interactive_buttons_message(recipient_phone_number, body_text, buttons, header_text=None, footer_text=None):
+def build_template_payload(recipient_phone_number, template_name, language_code="es", body_parameters=None):
+    """
+    Mensaje de plantilla aprobada en WhatsApp Manager: el único tipo que se puede enviar
+    fuera de la ventana de 24 horas desde el último mensaje del usuario.
+    `body_parameters` son los textos de las variables {{1}}, {{2}}... del cuerpo.
+    """
+    template = {"name": template_name, "language": {"code": language_code}}
+    if body_parameters:
+        template["components"] = [{
+            "type": "body",
+            "parameters": [{"type": "text", "text": str(value)} for value in body_parameters],
+        }]
+    return {
+        "messaging_product": "whatsapp",
+        "to": recipient_phone_number,
+        "type": "template",
+        "template": template,
+    }
+
+def build_interactive_buttons_payload(recipient_phone_number, body_text, buttons, header_text=None, footer_text=None):
+    """Construye un mensaje de botones; sin botones devuelve un mensaje de texto."""
     if not buttons or len(buttons) == 0:
         logger.warning("Se intentó enviar un mensaje de botones sin botones. Enviando solo texto.")
-        return send_text_message(recipient_phone_number, body_text)
+        return build_text_payload(recipient_phone_number, body_text)
         
     if len(buttons) > 3:
         logger.warning("WhatsApp solo soporta hasta 3 botones de respuesta. Se usarán los primeros 3.")
@@ -65,17 +188,16 @@ def send_interactive_buttons_message(recipient_phone_number, body_text, buttons,
     if footer_text:
         interactive_payload_content["footer"] = {"text": footer_text}
 
-    payload = {
+    return {
         "messaging_product": "whatsapp",
         "to": recipient_phone_number,
         "type": "interactive",
         "interactive": interactive_payload_content,
     }
-    return send_whatsapp_message_payload(recipient_phone_number, payload)
 
-def send_interactive_list_message(recipient_phone_number, body_text, list_button_title, sections, header_text=None, footer_text=None):
+def build_interactive_list_payload(recipient_phone_number, body_text, list_button_title, sections, header_text=None, footer_text=None):
     """
-    Envía un mensaje de lista interactiva.
+    Construye un mensaje de lista interactiva (None si no hay filas).
     'sections' es una lista de diccionarios de sección, cada uno con "title" (opcional) y "rows".
     Cada "row" es un dict con "id", "title" (max 24 chars), y "description" (opcional, max 72 chars).
     Máximo 10 filas en total en todas las secciones.
@@ -98,13 +220,29 @@ def send_interactive_list_message(recipient_phone_number, body_text, list_button
     if footer_text:
         interactive_payload_content["footer"] = {"text": footer_text}
     
-    payload = {
+    return {
         "messaging_product": "whatsapp",
         "to": recipient_phone_number,
         "type": "interactive",
         "interactive": interactive_payload_content
     }
-    return send_whatsapp_message_payload(recipient_phone_number, payload)
+
+def send_text_message(recipient_phone_number, text, phone_number_id=None, access_token=None):
+    payload = build_text_payload(recipient_phone_number, text)
+    return send_whatsapp_message_payload(recipient_phone_number, payload, phone_number_id, access_token)
+
+def send_interactive_buttons_message(recipient_phone_number, body_text, buttons, header_text=None, footer_text=None,
+                                     phone_number_id=None, access_token=None):
+    payload = build_interactive_buttons_payload(recipient_phone_number, body_text, buttons, header_text, footer_text)
+    return send_whatsapp_message_payload(recipient_phone_number, payload, phone_number_id, access_token)
+
+def send_interactive_list_message(recipient_phone_number, body_text, list_button_title, sections, header_text=None, footer_text=None,
+                                  phone_number_id=None, access_token=None):
+    """Envía un mensaje de lista interactiva. Ver build_interactive_list_payload."""
+    payload = build_interactive_list_payload(recipient_phone_number, body_text, list_button_title, sections, header_text, footer_text)
+    if payload is None:
+        return None
+    return send_whatsapp_message_payload(recipient_phone_number, payload, phone_number_id, access_token)
 
 
 if __name__ == "__main__":
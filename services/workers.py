@@ -0,0 +1,153 @@
+# chatbot/services/workers.py
+import time
+import queue
+import logging
+import threading
+import zlib
+import contextvars
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ShardedExecutor:
+    """
+    Pool de hilos donde cada tarea se asigna a un worker según su clave.
+
+    Todas las tareas con la misma clave (p. ej. el número del destinatario) caen en
+    la misma cola y se ejecutan en orden estricto; claves distintas avanzan en paralelo.
+    Las colas son acotadas: `submit` bloquea hasta `timeout` y lanza queue.Full si
+    siguen llenas (contrapresión). Cada tarea se ejecuta con las contextvars de quien
+    la encoló (p. ej. el request_id de los logs).
+    """
+
+    def __init__(self, num_workers=4, queue_size=1000, name="worker"):
+        if num_workers < 1:
+            raise ValueError("num_workers debe ser >= 1")
+        self.name = name
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(num_workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._accepting = True
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        for index, shard in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(shard,), name=f"{name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    @staticmethod
+    def _shard_index(key, shards):
+        # crc32 es estable entre procesos (hash() de str cambia con PYTHONHASHSEED).
+        return zlib.crc32(str(key).encode("utf-8")) % shards
+
+    def submit(self, key, fn, *args, block=True, timeout=None, **kwargs):
+        if not self._accepting:
+            raise RuntimeError(f"El executor '{self.name}' se está deteniendo y no acepta tareas.")
+        shard = self._queues[self._shard_index(key, len(self._queues))]
+        shard.put((contextvars.copy_context(), fn, args, kwargs), block=block, timeout=timeout)
+        with self._lock:
+            self.submitted += 1
+
+    def _run(self, shard):
+        while True:
+            item = shard.get()
+            try:
+                if item is _STOP:
+                    return
+                context, fn, args, kwargs = item
+                try:
+                    context.run(fn, *args, **kwargs)
+                    with self._lock:
+                        self.completed += 1
+                except Exception as e:
+                    with self._lock:
+                        self.failed += 1
+                    logger.error(f"Error en una tarea de '{self.name}': {e}", exc_info=True)
+            finally:
+                shard.task_done()
+
+    def shutdown(self, drain=True, timeout=None):
+        """Deja de aceptar tareas y, si `drain`, espera a que se procesen las pendientes."""
+        with self._lock:
+            if not self._accepting:
+                return True # Ya detenido (p. ej. a mano y otra vez desde atexit)
+            self._accepting = False
+        if not drain:
+            for shard in self._queues:
+                try:
+                    while True:
+                        shard.get_nowait()
+                        shard.task_done()
+                except queue.Empty:
+                    pass
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for shard in self._queues:
+            shard.put(_STOP)
+        for thread in self._threads:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            thread.join(remaining)
+        pending = sum(shard.qsize() for shard in self._queues)
+        if pending:
+            logger.warning(f"El executor '{self.name}' se detuvo con {pending} tareas pendientes.")
+        return pending == 0
+
+    def stats(self):
+        depths = [shard.qsize() for shard in self._queues]
+        with self._lock:
+            return {
+                "workers": len(self._queues),
+                "queue_depth": sum(depths),
+                "queue_depth_max": max(depths),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+
+class LatencyRecorder:
+    """Latencias de las últimas `window` operaciones (percentiles aproximados sin guardar historia)."""
+
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def stats(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count, total, maximum = self.count, self.total, self.max
+        if not samples:
+            return {"count": count}
+
+        def percentile(p):
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 3)
+
+        return {
+            "count": count,
+            "avg_ms": round(total / count * 1000, 3),
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(maximum * 1000, 3),
+        }
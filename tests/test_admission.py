@@ -0,0 +1,67 @@
+# chatbot/tests/test_admission.py
+"""
+Control de admisión: el token bucket de cada conversación rechaza lo que supera la
+ráfaga sin afectar a las demás, y un mensaje que no llegó a encolarse no paga su token.
+
+Uso:
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import admission  # noqa: E402
+
+ABUSER = ("phone-1", "573000000001")
+OTHER = ("phone-1", "573000000002")
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def make_controller(self, **kwargs):
+        # Ritmo muy bajo: durante el test no se rellena ningún token
+        options = {"user_rate": 0.001, "user_burst": 3, "max_in_flight": 0}
+        options.update(kwargs)
+        return admission.AdmissionController(**options)
+
+    def test_over_budget_key_is_rejected(self):
+        controller = self.make_controller()
+        results = [controller.check(ABUSER) for _ in range(5)]
+        self.assertEqual(results, [None, None, None, admission.USER_RATE, admission.USER_RATE])
+        stats = controller.stats()
+        self.assertEqual((stats["admitted"], stats["rejected_user_rate"]), (3, 2))
+
+    def test_other_keys_keep_their_budget(self):
+        controller = self.make_controller()
+        for _ in range(5):
+            controller.check(ABUSER)
+        self.assertIsNone(controller.check(OTHER))
+
+    def test_overload_does_not_consume_the_bucket(self):
+        controller = self.make_controller(max_in_flight=10)
+        self.assertEqual(controller.check(ABUSER, in_flight=10), admission.OVERLOADED)
+        self.assertEqual([controller.check(ABUSER) for _ in range(3)], [None, None, None])
+
+    def test_refund_returns_the_token(self):
+        controller = self.make_controller()
+        for _ in range(3):
+            controller.check(ABUSER)
+        controller.refund(ABUSER)
+        self.assertIsNone(controller.check(ABUSER))
+        self.assertEqual(controller.check(ABUSER), admission.USER_RATE)
+        self.assertEqual(controller.stats()["refunded"], 1)
+
+    def test_zero_rate_disables_the_user_limit(self):
+        controller = self.make_controller(user_rate=0)
+        self.assertTrue(all(controller.check(ABUSER) is None for _ in range(100)))
+        self.assertEqual(controller.stats()["tracked_users"], 0)
+
+    def test_invalid_policy_is_rejected(self):
+        with self.assertRaises(ValueError):
+            admission.AdmissionController(policy="queue")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+# chatbot/tests/test_cache.py
+"""
+Caché TTL: una lectura de la DB que empezó antes de una invalidación no debe
+volver a guardar el valor obsoleto.
+
+Uso:
+    python -m pytest tests
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.cache import TTLCache  # noqa: E402
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_set_after_invalidation_is_rejected(self):
+        cache = TTLCache()
+        epoch = cache.epoch  # se lee la DB...
+        cache.invalidate("chat")  # ...y mientras tanto otro worker cambia la fila
+        self.assertFalse(cache.set("chat", "obsoleto", epoch=epoch))
+        self.assertIsNone(cache.get("chat"))
+
+    def test_clear_also_rejects_older_reads(self):
+        cache = TTLCache()
+        epoch = cache.epoch
+        cache.clear()
+        self.assertFalse(cache.set("chat", "obsoleto", epoch=epoch))
+        self.assertEqual(len(cache), 0)
+
+    def test_set_with_current_epoch_is_stored(self):
+        cache = TTLCache()
+        cache.invalidate("otro")
+        self.assertTrue(cache.set("chat", "fresco", epoch=cache.epoch))
+        self.assertEqual(cache.get("chat"), "fresco")
+
+    def test_expired_entries_are_misses(self):
+        cache = TTLCache(ttl=0.01)
+        cache.set("chat", "valor")
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("chat"))
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TTLCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+# chatbot/tests/test_db_pool.py
+"""
+Pool de conexiones con conexiones simuladas (sin base de datos): reutilización LIFO
+y cierre de las conexiones inactivas que sobran por encima de minconn.
+
+Uso:
+    python -m pytest tests
+"""
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+from psycopg2 import extensions
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import db_pool  # noqa: E402
+
+
+class FakeConnection:
+    """Conexión sin servidor: siempre sin transacción abierta."""
+
+    def __init__(self, **connect_kwargs):
+        self.closed = 0
+        self.autocommit = False
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(db_pool.psycopg2, "connect", FakeConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuses_the_most_recently_returned_connection(self):
+        pool = db_pool.ConnectionPool(minconn=0, maxconn=3)
+        first, second, third = pool.getconn(), pool.getconn(), pool.getconn()
+        for conn in (first, second, third):
+            pool.putconn(conn)
+        self.assertIs(pool.getconn(), third)
+        self.assertIs(pool.getconn(), second)
+        self.assertEqual(pool.stats()["opened"], 3)
+
+    def test_idle_connections_above_minconn_are_closed(self):
+        pool = db_pool.ConnectionPool(minconn=1, maxconn=3, max_idle_time=0.01)
+        conns = [pool.getconn() for _ in range(3)]
+        for conn in conns:
+            pool.putconn(conn)
+        time.sleep(0.02)
+        # Al devolver la más reciente se cierran las que llevan más de max_idle_time inactivas
+        pool.putconn(pool.getconn())
+        self.assertEqual([conn.closed for conn in conns], [1, 1, 0])
+        self.assertEqual(pool.stats()["idle"], 1)
+
+    def test_busy_connections_are_not_trimmed(self):
+        pool = db_pool.ConnectionPool(minconn=0, maxconn=2, max_idle_time=0.01)
+        busy, idle = pool.getconn(), pool.getconn()
+        pool.putconn(idle)
+        time.sleep(0.02)
+        pool.putconn(busy)
+        self.assertTrue(idle.closed)
+        self.assertFalse(busy.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
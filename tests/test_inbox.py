@@ -0,0 +1,112 @@
+# chatbot/tests/test_inbox.py
+"""
+Inbox de mensajes entrantes sin base de datos: el filtro de wamids recientes olvida
+los más antiguos, y un payload solo procesa los mensajes que pudo reclamar y marca
+como procesados, en la misma escritura que sus filas, los que terminaron bien.
+
+Uso:
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import db_manager, inbound, inbox  # noqa: E402
+
+
+class RecentIdFilterTest(unittest.TestCase):
+
+    def test_oldest_ids_are_evicted(self):
+        recent = inbox.RecentIdFilter(maxsize=3)
+        recent.add_many(["a", "b", "c", "d"])
+        self.assertNotIn("a", recent)
+        self.assertIn("d", recent)
+        self.assertEqual(len(recent), 3)
+
+    def test_re_adding_an_id_refreshes_it(self):
+        recent = inbox.RecentIdFilter(maxsize=2)
+        recent.add_many(["a", "b"])
+        recent.add_many(["a", "c"])
+        self.assertIn("a", recent)
+        self.assertNotIn("b", recent)
+
+    def test_hits_count_only_known_ids(self):
+        recent = inbox.RecentIdFilter(maxsize=10)
+        recent.add_many(["a"])
+        self.assertIn("a", recent)
+        self.assertNotIn("b", recent)
+        self.assertEqual(recent.hits, 1)
+
+    def test_seen_ids_are_not_recorded_again(self):
+        recent = inbox.RecentIdFilter(maxsize=10)
+        recent.add_many(["wamid.1"])
+        messages = [{"id": "wamid.1"}, {"id": "wamid.2"}, {"id": "wamid.2"}]
+        with mock.patch.object(inbox, "_recent_ids", recent), \
+                mock.patch.object(inbox.db_manager, "get_db_connection", return_value=None):
+            recorded = inbox.record_messages(messages)
+        # Sin DB se devuelven sin inbox_id, pero sin los ya vistos ni los repetidos del payload
+        self.assertEqual(recorded, [(None, {"id": "wamid.2"})])
+
+
+class ProcessBatchClaimTest(unittest.TestCase):
+
+    def setUp(self):
+        self.processed = []
+        self.persisted = []
+        self.failed = []
+        patches = [
+            mock.patch.object(inbound, "process_message", side_effect=self.process_message),
+            mock.patch.object(inbound, "persist", side_effect=self.persist),
+            mock.patch.object(inbound, "send_reply"),
+            mock.patch.object(inbound.inbox, "mark_failed", side_effect=lambda *args: self.failed.append(args[:2])),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def process_message(self, message_data, rows, states, replies, actions):
+        self.processed.append(message_data["id"])
+        rows.append((1, "user", "text", message_data["id"], message_data["id"]))
+        actions.append(db_manager.order_row(1, "573000000000", {"product": message_data["id"]}))
+        if message_data.get("boom"):
+            raise RuntimeError("fallo en el pipeline")
+        return True
+
+    def persist(self, rows, states, actions=(), claims=()):
+        self.persisted.append((list(rows), list(actions), list(claims)))
+        return True
+
+    def test_only_claimed_messages_are_processed_and_marked_done(self):
+        recorded = [(1, {"id": "m1"}), (2, {"id": "m2"}), (3, {"id": "m3"})]
+        with mock.patch.object(inbound.inbox, "claim", return_value={1: "t1", 3: "t3"}):
+            inbound.process_batch(recorded)
+        self.assertEqual(self.processed, ["m1", "m3"]) # m2 ya lo reclamó el barrido
+        [(rows, actions, claims)] = self.persisted
+        self.assertEqual([row[4] for row in rows], ["m1", "m3"])
+        self.assertEqual(claims, [(1, "t1"), (3, "t3")])
+
+    def test_failed_message_leaves_nothing_behind(self):
+        recorded = [(1, {"id": "m1"}), (2, {"id": "m2", "boom": True})]
+        with mock.patch.object(inbound.inbox, "claim", return_value={1: "t1", 2: "t2"}):
+            inbound.process_batch(recorded)
+        [(rows, actions, claims)] = self.persisted
+        # El pedido del mensaje que falló no se escribe: se reprocesa desde el inbox
+        self.assertEqual([row[4] for row in rows], ["m1"])
+        self.assertEqual([row[2] for _, row in actions], ["m1"])
+        self.assertEqual(claims, [(1, "t1")])
+        self.assertEqual(self.failed, [(2, "t2")])
+
+    def test_failed_persist_returns_claims_to_pending(self):
+        recorded = [(1, {"id": "m1"})]
+        inbound.persist.side_effect = lambda *args: False
+        with mock.patch.object(inbound.inbox, "claim", return_value={1: "t1"}):
+            inbound.process_batch(recorded)
+        self.assertEqual(self.failed, [(1, "t1")])
+        inbound.send_reply.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+# chatbot/tests/test_message_writer.py
+"""
+Escritor por lotes con una función de escritura simulada (sin base de datos): lo que
+llega mientras se escribe un lote forma el siguiente, y `submit(durable=True)` solo
+vuelve cuando su lote se confirmó, con el resultado de esa escritura.
+
+Uso:
+    python -m pytest tests
+"""
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.message_writer import MessageBatchWriter  # noqa: E402
+
+
+class RecordingFlush:
+    """Registra cada lote; el primero espera a `release` para simular un COMMIT lento."""
+
+    def __init__(self, result=True):
+        self.result = result
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, rows, extra):
+        self.batches.append((rows, extra))
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class MessageBatchWriterTest(unittest.TestCase):
+
+    def make_writer(self, flush, **kwargs):
+        writer = MessageBatchWriter(flush, max_delay=5, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_rows_submitted_during_a_commit_form_the_next_batch(self):
+        flush = RecordingFlush()
+        writer = self.make_writer(flush)
+        first = threading.Thread(target=writer.submit, args=(["a"],), kwargs={"durable": True})
+        first.start()
+        self.assertTrue(flush.started.wait(5))
+        writer.submit(["b"])
+        writer.submit(["c"], extra=["estado-c"])
+        flush.release.set()
+        first.join(5)
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(flush.batches, [(["a"], []), (["b", "c"], ["estado-c"])])
+
+    def test_durable_submit_waits_for_the_commit(self):
+        flush = RecordingFlush()
+        writer = self.make_writer(flush)
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(writer.submit(["a"], durable=True)))
+        waiter.start()
+        self.assertTrue(flush.started.wait(5))
+        waiter.join(0.05)
+        self.assertEqual(results, []) # El lote aún no está confirmado
+        flush.release.set()
+        waiter.join(5)
+        self.assertEqual(results, [True])
+
+    def test_durable_submit_reports_a_failed_commit(self):
+        for result in (False, RuntimeError("conexión perdida")):
+            flush = RecordingFlush(result)
+            flush.release.set()
+            writer = self.make_writer(flush)
+            self.assertFalse(writer.submit(["a"], durable=True, extra=["estado"]))
+            self.assertEqual(writer.stats()["failed_rows"], 1)
+
+    def test_non_durable_submit_does_not_wait(self):
+        flush = RecordingFlush()
+        writer = self.make_writer(flush)
+        self.assertTrue(writer.submit(["a"]))
+        self.assertEqual(flush.batches, [])
+        flush.release.set()
+
+    def test_groups_are_never_split(self):
+        flush = RecordingFlush()
+        flush.release.set()
+        writer = self.make_writer(flush, max_batch=2)
+        self.assertTrue(writer.submit(["a", "b", "c"], durable=True))
+        self.assertEqual(flush.batches, [(["a", "b", "c"], [])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+# chatbot/tests/test_outbound.py
+"""
+Reintentos del despachador de salida con un POST simulado (sin red ni base de datos):
+un error después de enviar la petición no debe repetir el mensaje.
+
+Uso:
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+
+import requests
+from urllib3.exceptions import ProtocolError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import outbound  # noqa: E402
+from services.tenants import Tenant  # noqa: E402
+
+
+def make_response(status_code, content):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    return response
+
+
+class StubPost:
+    """Devuelve (o lanza) en orden los resultados indicados y cuenta los POST."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def __call__(self, payload, phone_number_id=None, body=None, access_token=None):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if self.outcomes else make_response(200, b'{"messages": [{"id": "wamid.OK"}]}')
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class DeliverRetryTest(unittest.TestCase):
+
+    def deliver(self, post, **kwargs):
+        dispatcher = outbound.OutboundDispatcher(num_workers=1, rate_per_second=1000, backoff_base=0, post=post, **kwargs)
+        results = []
+        tenant = Tenant(1, "default", "phone-test", "token-test")
+        payload = {"messaging_product": "whatsapp", "to": "573000000000", "type": "text", "text": {"body": "hola"}}
+        dispatcher._deliver("573000000000", payload, tenant, results.append, 0.0)
+        dispatcher.shutdown()
+        return results[0], dispatcher.stats()
+
+    def test_read_timeout_is_not_retried(self):
+        post = StubPost(requests.exceptions.ReadTimeout("timeout de lectura"))
+        result, stats = self.deliver(post)
+        self.assertEqual(post.calls, 1)
+        self.assertIs(result, outbound.UNKNOWN)
+        self.assertEqual(stats["retries"], 0)
+
+    def test_aborted_connection_is_not_retried(self):
+        post = StubPost(requests.exceptions.ConnectionError(ProtocolError("Connection aborted.")))
+        result, _ = self.deliver(post)
+        self.assertEqual(post.calls, 1)
+        self.assertIs(result, outbound.UNKNOWN)
+
+    def test_unreadable_2xx_counts_as_sent(self):
+        post = StubPost(make_response(200, b"<html>no es JSON</html>"))
+        result, stats = self.deliver(post)
+        self.assertEqual(post.calls, 1)
+        self.assertIsNotNone(result)
+        self.assertIsNone(outbound.whatsapp.extract_wamid(result))
+        self.assertEqual(stats["sent"], 1)
+
+    def test_connect_timeout_is_retried(self):
+        post = StubPost(requests.exceptions.ConnectTimeout("timeout al conectar"))
+        result, _ = self.deliver(post)
+        self.assertEqual(post.calls, 2)
+        self.assertEqual(outbound.whatsapp.extract_wamid(result), "wamid.OK")
+
+    def test_retryable_status_is_retried(self):
+        post = StubPost(make_response(503, b"{}"))
+        result, _ = self.deliver(post)
+        self.assertEqual(post.calls, 2)
+        self.assertEqual(outbound.whatsapp.extract_wamid(result), "wamid.OK")
+
+    def test_client_error_is_a_failure(self):
+        post = StubPost(make_response(400, b'{"error": {}}'))
+        result, _ = self.deliver(post)
+        self.assertEqual(post.calls, 1)
+        self.assertIsNone(result)
+
+    def test_campaign_dispatcher_does_not_retry_server_errors(self):
+        from services import campaigns
+        post = StubPost(make_response(502, b"{}"))
+        result, _ = self.deliver(post, retry_status_codes=campaigns.CAMPAIGN_RETRY_STATUS_CODES)
+        self.assertEqual(post.calls, 1)
+        self.assertIs(result, outbound.UNKNOWN)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+# chatbot/tests/test_state_store.py
+"""
+Almacén de estado conversacional sin base de datos: `load` entrega copias y el modo
+write_through cachea también la ausencia de estado (el caso más frecuente).
+
+Uso:
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import state_store  # noqa: E402
+from services.state_store import ConversationState  # noqa: E402
+
+KEY = (1, "573000000000")
+
+
+class FakePostgresStore(state_store.StateStore):
+    """Lecturas contadas y escrituras en un dict."""
+
+    def __init__(self):
+        self.rows = {}
+        self.reads = 0
+
+    def get(self, key):
+        self.reads += 1
+        return self.rows.get(key)
+
+    def set(self, key, state):
+        self.rows[key] = state
+
+    def delete(self, key):
+        self.rows.pop(key, None)
+
+    def prepare(self, changes):
+        return list(changes.items())
+
+
+class FakeListener:
+
+    def __init__(self, listening=True):
+        self.listening = listening
+
+    def subscribe(self, channel, callback, on_reconnect=None):
+        pass
+
+    def is_listening(self):
+        return self.listening
+
+
+class LoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = state_store.MemoryStateStore()
+        patcher = mock.patch.multiple(state_store, _store=self.store, _store_pid=os.getpid())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_load_returns_a_copy(self):
+        self.store.set(KEY, ConversationState("collecting_order_data", "awaiting_name", {"product": "kit"}))
+        state = state_store.load(KEY)
+        state.step = "awaiting_address"
+        state.order_details["name"] = "Ana"
+        stored = self.store.get(KEY)
+        self.assertEqual(stored.step, "awaiting_name")
+        self.assertEqual(stored.order_details, {"product": "kit"})
+
+    def test_pending_changes_take_precedence(self):
+        self.store.set(KEY, ConversationState("collecting_order_data", "awaiting_name"))
+        pending = {}
+        state_store.save(KEY, None, pending)
+        self.assertIsNone(state_store.load(KEY, pending))
+        self.assertIsNotNone(self.store.get(KEY)) # Aún sin confirmar
+
+    def test_pending_state_is_copied_too(self):
+        pending = {KEY: ConversationState("collecting_order_data", "awaiting_name")}
+        state_store.load(KEY, pending).order_details["name"] = "Ana"
+        self.assertEqual(pending[KEY].order_details, {})
+
+
+class WriteThroughStateStoreTest(unittest.TestCase):
+
+    def make_store(self, listening=True):
+        patcher = mock.patch.object(state_store.notifications, "get_listener", return_value=FakeListener(listening))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.postgres = FakePostgresStore()
+        return state_store.WriteThroughStateStore(self.postgres, state_store.MemoryStateStore())
+
+    def test_missing_state_is_cached(self):
+        store = self.make_store()
+        self.assertIsNone(store.get(KEY))
+        self.assertIsNone(store.get(KEY))
+        self.assertEqual(self.postgres.reads, 1)
+        self.assertIs(store.memory.cache.get(KEY), state_store._NO_STATE)
+
+    def test_committed_deletion_is_cached_as_no_state(self):
+        store = self.make_store()
+        store.committed({KEY: ConversationState("collecting_order_data", "awaiting_name")})
+        self.assertEqual(store.get(KEY).step, "awaiting_name")
+        store.committed({KEY: None})
+        self.assertIsNone(store.get(KEY))
+        self.assertEqual(self.postgres.reads, 0)
+
+    def test_cache_is_bypassed_without_listener(self):
+        store = self.make_store(listening=False)
+        store.get(KEY)
+        store.get(KEY)
+        self.assertEqual(self.postgres.reads, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+# chatbot/tests/test_workers.py
+"""
+Executor por claves: las tareas de una misma clave se ejecutan en orden de llegada
+aunque otras claves avancen en paralelo, y una cola llena aplica contrapresión.
+
+Uso:
+    python -m pytest tests
+"""
+import os
+import sys
+import time
+import queue
+import random
+import threading
+import contextvars
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.workers import ShardedExecutor  # noqa: E402
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+class ShardedExecutorTest(unittest.TestCase):
+
+    def test_tasks_with_the_same_key_run_in_order(self):
+        executor = ShardedExecutor(num_workers=4, name="test")
+        seen = {f"user-{n}": [] for n in range(10)}
+
+        def task(key, n):
+            time.sleep(random.random() / 1000)
+            seen[key].append(n)
+
+        for n in range(50):
+            for key in seen:
+                executor.submit(key, task, key, n)
+        self.assertTrue(executor.shutdown(drain=True, timeout=10))
+        for key, order in seen.items():
+            self.assertEqual(order, list(range(50)), key)
+        self.assertEqual(executor.stats()["completed"], 500)
+
+    def test_full_queue_raises_after_timeout(self):
+        executor = ShardedExecutor(num_workers=1, queue_size=1, name="test")
+        release = threading.Event()
+        started = threading.Event()
+        self.addCleanup(release.set)
+        executor.submit("a", lambda: (started.set(), release.wait(5)))
+        self.assertTrue(started.wait(5))
+        executor.submit("a", lambda: None) # Ocupa la única plaza de la cola
+        with self.assertRaises(queue.Full):
+            executor.submit("a", lambda: None, timeout=0.01)
+
+    def test_failed_task_does_not_stop_its_worker(self):
+        executor = ShardedExecutor(num_workers=1, name="test")
+        done = []
+        executor.submit("a", lambda: 1 / 0)
+        executor.submit("a", done.append, "siguiente")
+        executor.shutdown(drain=True, timeout=5)
+        self.assertEqual(done, ["siguiente"])
+        self.assertEqual(executor.stats()["failed"], 1)
+
+    def test_tasks_run_with_the_submitter_context(self):
+        executor = ShardedExecutor(num_workers=2, name="test")
+        seen = []
+        token = request_id.set("req-1")
+        try:
+            executor.submit("a", lambda: seen.append(request_id.get()))
+        finally:
+            request_id.reset(token)
+        executor.shutdown(drain=True, timeout=5)
+        self.assertEqual(seen, ["req-1"])
+
+    def test_submit_after_shutdown_is_rejected(self):
+        executor = ShardedExecutor(num_workers=1, name="test")
+        executor.shutdown()
+        with self.assertRaises(RuntimeError):
+            executor.submit("a", lambda: None)
+
+
+if __name__ == "__main__":
+    unittest.main()